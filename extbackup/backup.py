@@ -1,27 +1,100 @@
 import contextlib
 import datetime
+import functools
 import os
-import shutil
+import signal
 import socket
 import subprocess
 import sys
 import tempfile
+import time
 
+from . import mysql
+from .cachedirs import CACHEDIR_SCAN_FILE
+from .cachedirs import CacheDirScanner
+from .catalog import CATALOG_FILE
+from .catalog import Catalog
+from .cgroup import BackupCgroup
+from .chunkstore import CHUNK_STORE_DIR
+from .chunkstore import ChunkStore
+from .delta import BLOCK_INDEX_DIR
+from .delta import DeltaCopy
+from .dumps import dump_providers
+from .dumps import recipe_files
+from .export import SnapshotExporter
+from .flagprobe import FlagProbe
+from .flagprobe import flag_args
 from .fstab import fstab_mount_points
+from .localcopy import STOP_AT_FORMAT
+from .localcopy import LocalCopy
+from .localcopy import parse_rsync_args
 from .mount import BindMounts
 from .mount import Mount
+from .packs import DirectoryPack
+from .packs import manifest_digest
+from .physorder import batches
+from .physorder import physical_order
+from .pressure import PressureThrottle
+from .profiles import load_profiles
+from .profiles import run_concurrently
+from .remote import RemoteTarget
+from .report import REPORT_FILE
+from .report import Report
+from .routing import ChurnRouter
+from .routing import route_filter_args
+from .routing import skip_filter_args
 from .rsync import RsyncPaths
+from .rsync import load_config
+from .rsync import parse_failed_paths
+from .schedule import DeadlineScheduler
+from .shards import ShardPlanner
+from .shards import escape_pattern
+from .shards import hide_filter_args
+from .shards import shard_filter_args
+from .sizes import format_size
+from .sizes import parse_size
+from .tiers import TierSchedule
+from .tiers import load_tiers
+from .usage import UsageCalculator
+from .writeback import WritebackLimits
 
 MOUNT_DIR = '/mnt/backup-external'
 TIMESTAMP_FORMAT = '%Y%m%d-%H%M'
 
+RSYNC_PARTIAL_ERROR = 23
+RSYNC_PARTIAL_TRANSFER = 24
+RSYNC_STOPPED = 30
+CHANGED_PREFIX = 'changed: '
+
 
 class ExternalBackup(object):
-    def __init__(self, pretend=False, config_file=None):
+    def __init__(self, pretend=False, config_file=None, mounts=None,
+                 config=None, deadline=None):
         self.pretend = pretend
+        self.deadline = deadline
         self.config_file = config_file
-        self.mounts = fstab_mount_points()
+        self.loaded_config = config
+        self.mounts = fstab_mount_points() if mounts is None else mounts
         self.rsync = None
+        self.config = {}
+        self.throttle = None
+        self.bwlimit = None
+        self.snapshot = None
+        self.report = None
+        self.cgroup = None
+        self.cgroup_leaf = None
+        self.writeback = None
+        self.remote = None
+        self.scheduler = None
+        self.link_dests = []
+        self.carried_paths = []
+        self.tier_schedule = None
+        self.carried_tiers = []
+        self.routes = []
+        self.probed_args = {}
+        self.failed_paths = {}
+        self.stop_at = None
+        self.unit_stopped = False
 
     @property
     def hostname(self):
@@ -30,14 +103,30 @@ class ExternalBackup(object):
             raise Exception('Unable to determine system hostname')
         return hostname
 
+    @property
+    def name(self):
+        return self.hostname
+
+    @property
+    def target_name(self):
+        return self.hostname
+
     @property
     def target(self):
+        if not hasattr(self, '_target') and self.remote:
+            # Only state files are kept locally, in sync with the server
+            target = os.path.join(self.remote.state_dir, self.target_name)
+            os.makedirs(target, 0o0700, exist_ok=True)
+            self._target = target
         if not hasattr(self, '_target'):
             if not os.path.ismount(MOUNT_DIR):
                 raise Exception('{} is not mounted'.format(MOUNT_DIR))
-            target = os.path.join(MOUNT_DIR, self.hostname)
+            target = os.path.join(MOUNT_DIR, self.target_name)
             if not os.path.isdir(target):
                 print('Creating directory {}'.format(target))
+                parent = os.path.dirname(target)
+                if parent != MOUNT_DIR and not os.path.isdir(parent):
+                    os.makedirs(parent, 0o0700)
                 os.mkdir(target)
             os.chmod(target, 0o0700)
             self._target = target
@@ -45,88 +134,964 @@ class ExternalBackup(object):
 
     def backup(self):
         with tempfile.TemporaryDirectory() as temp_dir:
-            self.rsync = RsyncPaths(self.config_file, temp_dir)
+            self.rsync = RsyncPaths(self.config_file, temp_dir,
+                                    config=self.loaded_config)
+            self._configure(self.rsync.config)
+            profiles = load_profiles(self.config,
+                                     host_target=self.target_name)
+            self.remote = RemoteTarget.from_config(self.config.get('remote'))
+            if self.remote:
+                self._check_remote()
+            self.cgroup = BackupCgroup.from_config(self.config.get('cgroup'))
+            self.writeback = WritebackLimits.from_config(
+                self.config.get('writeback'), self.target)
             # Mount all required filesystems
             with contextlib.ExitStack() as stack:
+                if self.remote:
+                    stack.enter_context(self.remote)
+                if self.cgroup:
+                    stack.enter_context(self.cgroup)
+                if self.writeback:
+                    stack.enter_context(self.writeback)
                 for mount_point in self.mounts:
                     stack.enter_context(Mount(mount_point))
                 # Create bind mounts
                 with BindMounts(mounts=self.mounts) as bind_mounts:
-                    self._backup_run(bind_mounts.temp_dir)
+                    if profiles:
+                        self._backup_profiles(bind_mounts.temp_dir, profiles)
+                    else:
+                        self._backup_run(bind_mounts.temp_dir)
+
+    @contextlib.contextmanager
+    def open_target(self, action, remote=False):
+        # For actions run between backups. A remote target only keeps its
+        # state files here, so they are pulled from the server first and
+        # actions reading the snapshots themselves are refused
+        config = self.loaded_config
+        if config is None and self.config_file and \
+                os.path.isfile(self.config_file):
+            # Keep stdout for the action's own output
+            with contextlib.redirect_stdout(sys.stderr):
+                config = load_config(self.config_file)
+        self._configure(config or {})
+        self.remote = RemoteTarget.from_config(self.config.get('remote'))
+        if not self.remote:
+            yield self
+            return
+        if not remote:
+            raise Exception('{} is not supported with a remote target'
+                            .format(action))
+        with self.remote:
+            self.remote.pull_state(self._storage(), self.target)
+            yield self
+
+    def _configure(self, config):
+        self.config = config
+        self.throttle = PressureThrottle.from_config(config.get('throttle'))
+        self.report = Report(self.name)
+
+    def _backup_profiles(self, bind_dir, profiles):
+        scheduler = self.config.get('scheduler') or {}
+        concurrency = scheduler.get('concurrency', 1)
+        backups = [ProfileBackup(profile, self.config, pretend=self.pretend)
+                   for profile in profiles]
+        tasks = [(self.name, lambda: self._backup_run(bind_dir))]
+        tasks += [(backup.name, backup.backup) for backup in backups]
+        if scheduler.get('bwlimit'):
+            # Split the bandwidth budget between concurrently running rsyncs
+            bwlimit = max(1, parse_size(scheduler['bwlimit']) // 1024 //
+                          min(concurrency, len(tasks)))
+            for backup in [self] + backups:
+                backup.bwlimit = bwlimit
+        for backup in backups:
+            backup.cgroup = self.cgroup
+            backup.writeback = self.writeback
+            backup.remote = self.remote
+            backup.deadline = self.deadline
+        run_concurrently(tasks, concurrency)
+
+    def _phases(self):
+        return [
+            ('versioned', self._backup_versioned),
+            ('single', self._backup_single),
+            ('dumps', lambda bind_dir: self._backup_dumps()),
+        ]
+
+    def _schedule_config(self):
+        return self.config.get('schedule') or {}
+
+    def _units(self):
+        # (name, callable, required) in priority order; priority paths are
+        # always copied in full, other units may be skipped or stopped
+        units = [('versioned:{}'.format(path),
+                  functools.partial(self._backup_priority, path=path), True)
+                 for path in self._schedule_config().get('priorities') or []]
+        units += [(phase, backup_phase, False)
+                  for phase, backup_phase in self._phases()]
+        return units
+
+    def _check_remote(self):
+        # Features that write into the target directly need it mounted
+        unsupported = [name for name, enabled in [
+            ('chunk-store', self.config.get('chunk-store')),
+            ('native-copy', self._native_copy_config() is not None),
+            ('packs', self._pack_paths()),
+            ('single-delta', self.config.get('single-delta')),
+            ('tiers', self._tiers_config()),
+            ('writeback', self.config.get('writeback')),
+        ] if enabled]
+        if unsupported:
+            raise Exception('{} not supported with a remote target'.format(
+                ', '.join(unsupported)))
+
+    def _storage(self):
+        # Where snapshots are stored: the target, or its path on the server
+        if self.remote:
+            return self.remote.join(self.target_name)
+        return self.target
+
+    @contextlib.contextmanager
+    def _snapshot_files(self):
+        # Files written into the snapshot; for a remote target they are
+        # written to a staging directory and then copied to the server
+        if not self.remote:
+            yield self.snapshot
+            return
+        with tempfile.TemporaryDirectory() as staging:
+            snapshot_dir = os.path.join(staging,
+                                        os.path.basename(self.snapshot))
+            os.mkdir(snapshot_dir)
+            yield snapshot_dir
+            if os.listdir(snapshot_dir):
+                self.remote.put(snapshot_dir, self.snapshot)
 
     def _backup_run(self, bind_dir):
-        print('Backing up {} to {}'.format(self.hostname, self.target))
-        self._backup_versioned(bind_dir)
-        self._backup_single(bind_dir)
-        self._backup_mysql()
+        if self.remote:
+            print('Backing up {} to {}'.format(
+                self.name, self.remote.url(self._storage())))
+            self.remote.makedirs(self._storage())
+            self.remote.pull_state(self._storage(), self.target)
+        else:
+            print('Backing up {} to {}'.format(self.name, self.target))
+        self._exclude_cache_dirs(bind_dir)
+        self._probe_flags(bind_dir)
+        self._route_files(bind_dir)
+        self._start_snapshot()
+        for name, backup_unit, required in self.scheduler.order(
+                self._units()):
+            if not self.scheduler.should_run(name, required):
+                continue
+            self.stop_at = None if required else self.scheduler.stop_at()
+            self.unit_stopped = False
+            try:
+                with self.report.phase(name), self._phase_cgroup(name):
+                    backup_unit(bind_dir)
+            finally:
+                self.stop_at = None
+            self.scheduler.finished(name, required,
+                                    stopped=self.unit_stopped)
+        self._save_tiers()
+        self._finish_snapshot()
+        if self.writeback and not self.pretend:
+            # Flush now so the time is reported rather than spent unmounting
+            with self.report.phase('flush'):
+                self.writeback.flush()
+        print(self.report.summary())
+        if not self.pretend:
+            with self._snapshot_files() as snapshot_dir:
+                self.report.save(os.path.join(snapshot_dir, REPORT_FILE))
+            if self.remote:
+                self.remote.push_state(self.target, self._storage())
 
-    def _backup_versioned(self, bind_dir):
+    @contextlib.contextmanager
+    def _phase_cgroup(self, phase):
+        if not self.cgroup:
+            yield
+            return
+        with self.cgroup.phase('{}-{}'.format(self.name, phase), self.report,
+                               phase) as leaf:
+            self.cgroup_leaf = leaf
+            try:
+                yield
+            finally:
+                self.cgroup_leaf = None
+
+    def _cache_exclude_config(self):
+        return self.config.get('cache-exclude')
+
+    def _exclude_cache_dirs(self, bind_dir):
+        config = self._cache_exclude_config()
+        if not config:
+            return
+        config = config if isinstance(config, dict) else {}
+        scanner = CacheDirScanner(
+            os.path.join(self.target, CACHEDIR_SCAN_FILE),
+            markers=config.get('markers'))
+        scanner.load()
+        with self.report.phase('cache-exclude'):
+            found = scanner.scan(bind_dir)
+        if not self.pretend:
+            scanner.save()
+        self.rsync.add_excludes(['/{}/'.format(escape_pattern(path))
+                                 for path, _, _ in found])
+        self.report.add('cache-exclude', 'directories', len(found))
+        for rule in sorted(set(rule for _, rule, _ in found)):
+            self.report.add('cache-exclude', '{}_bytes'.format(rule), sum(
+                size for _, found_rule, size in found if found_rule == rule))
+
+    def _flag_probe_config(self):
+        return self.config.get('flag-probe')
+
+    def _probe_sources(self, bind_dir):
+        # Each bind mount is probed and copied on its own
+        return ['/{}'.format(name) for name in sorted(os.listdir(bind_dir))
+                if os.path.isdir(os.path.join(bind_dir, name))]
+
+    def _probe_flags(self, bind_dir):
+        self.probed_args = {}
+        probe = FlagProbe.from_config(self._flag_probe_config(), self.target)
+        if not probe:
+            return
+        probe.load()
+        with self.report.phase('flag-probe'):
+            for path in self._probe_sources(bind_dir):
+                flags = probe.probe(path, os.path.join(bind_dir,
+                                                       path.strip('/')))
+                self.probed_args[path] = flag_args(flags)
+                for flag, needed in sorted(flags.needed.items()):
+                    print('{} {} for {}: {}'.format(
+                        'Keeping' if needed else 'Dropping', flag, path,
+                        flags.reasons[flag]))
+                self.report.add('flag-probe', path, ' '.join(
+                    self.probed_args[path]) or 'none dropped')
+        if not self.pretend:
+            probe.save()
+
+    def _path_flag_args(self, path):
+        # Probed options of the source containing path
+        top = '/{}'.format(path.strip('/').split('/')[0])
+        return self.probed_args.get(top, self.probed_args.get('/', []))
+
+    def _rsync_sources(self, source, dest, link_dests=None, single=False,
+                       args=None):
+        # With probed options, each source is copied by its own pass with
+        # only the metadata options it needs
+        if not self.probed_args:
+            self._rsync(source, dest, link_dests=link_dests, single=single,
+                        args=args)
+            return
+        for path, probed_args in sorted(self.probed_args.items()):
+            filter_args = shard_filter_args(path, []) if path != '/' else []
+            self._rsync(source, dest, link_dests=link_dests, single=single,
+                        args=(args or []) + probed_args + filter_args)
+
+    def _routing_config(self):
+        return self.config.get('routing')
+
+    def _route_files(self, bind_dir):
+        # Routed files are only backed up by the single-copy phase
+        self.routes = []
+        if 'single' not in dict(self._phases()):
+            return
+        router = ChurnRouter.from_config(self._routing_config(), self.target)
+        if not router:
+            return
+        self.routes = router.route(bind_dir)
+        for path in router.expired:
+            print('Returning {} to versioned backup'.format(path))
+        if router.expired:
+            self.report.add('routing', 'expired', router.expired)
+        for route in self.routes:
+            if route.new:
+                print('Routing {} ({}, {} new versions) to single-copy backup'
+                      .format(route.path, format_size(route.size),
+                              route.changes))
+        if not self.pretend:
+            router.save(self.routes)
+        if not self.routes:
+            return
+        self.rsync.add_excludes([escape_pattern(route.path)
+                                 for route in self.routes],
+                                sections=['exclude'])
+        self.report.add('routing', 'files', len(self.routes))
+        new_paths = [route.path for route in self.routes if route.new]
+        if new_paths:
+            self.report.add('routing', 'new', new_paths)
+        # Each routed file would otherwise be stored again in every snapshot
+        self.report.add('routing', 'saved_bytes',
+                        sum(route.size for route in self.routes))
+
+    def _start_snapshot(self):
         versioned_dir = datetime.datetime.now().strftime(TIMESTAMP_FORMAT)
-        target = os.path.join(self.target, versioned_dir)
-        if os.path.isdir(target):
+        target = os.path.join(self._storage(), versioned_dir)
+        versions = self.versions()
+        if versioned_dir in versions:
             raise Exception('{} already exists'.format(target))
-        self._runcmd(
-            self._rsync_cmd(bind_dir, target,
-                            link_dest=self._find_prev_version(),
-                            single=False),
-            ignore_exit_codes=[24])
+        self.scheduler = DeadlineScheduler(self.deadline, self.target,
+                                           self._estimates(versions))
+        self.link_dests = []
+        if versions:
+            self.link_dests.append(os.path.join(self._storage(),
+                                                versions[-1]))
+            last_complete = self.scheduler.last_complete
+            if last_complete in versions[:-1]:
+                # The latest snapshot is partial, so unchanged files skipped
+                # by it are linked from the last complete snapshot instead
+                self.link_dests.append(
+                    os.path.join(self._storage(), last_complete))
+        self.snapshot = target
+        if self.pretend:
+            return
+        if self.remote:
+            self.remote.makedirs(target)
+        else:
+            os.mkdir(target)
+
+    def _estimates(self, versions):
+        # Seconds each unit took in the previous run
+        if not versions:
+            return {}
+        report_file = os.path.join(self._storage(), versions[-1],
+                                   REPORT_FILE)
+        if self.remote:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                report_file = self.remote.fetch(report_file, temp_dir)
+                report = Report.load(report_file) if report_file else None
+        elif os.path.isfile(report_file):
+            report = Report.load(report_file)
+        else:
+            report = None
+        if not report:
+            return {}
+        return {phase: report.get(phase, 'seconds', 0)
+                for phase in report.order}
+
+    def _finish_snapshot(self):
+        if self.failed_paths:
+            # The snapshot is kept, with the failed paths missing from it
+            self.report.add('errors', 'status', 'complete-with-errors')
+            for kind, paths in sorted(self.failed_paths.items()):
+                self.report.add('errors', kind, paths)
+                for path, error in sorted(paths.items()):
+                    print('Unable to back up {} {}: {}'.format(kind, path,
+                                                               error))
+        if self.deadline:
+            self.report.add('schedule', 'deadline',
+                            self.deadline.isoformat(' '))
+            self.report.add('schedule', 'partial', self.scheduler.partial)
+            for key in ['skipped', 'stopped']:
+                if getattr(self.scheduler, key):
+                    self.report.add('schedule', key,
+                                    getattr(self.scheduler, key))
+        if self.pretend:
+            return
         # Copy rsync configuration files to backup directory
-        if not self.pretend:
-            self.rsync.copy_config(os.path.join(target, 'rsync-config'))
+        with self._snapshot_files() as snapshot_dir:
+            self.rsync.copy_config(os.path.join(snapshot_dir,
+                                                'rsync-config'))
+        versioned_dir = os.path.basename(self.snapshot)
+        self._update_catalog(versioned_dir, self.snapshot)
+        self.scheduler.save(versioned_dir)
+
+    def _hide_args(self):
+        # Priority paths are copied by their own units, tiers that are not
+        # due are linked from the previous snapshot and packed directories
+        # are stored as archives
+        hide_args = []
+        for path in (self._schedule_config().get('priorities') or []) + \
+                self.carried_paths + self._pack_paths():
+            hide_args += hide_filter_args(path)
+        return hide_args
+
+    def _backup_priority(self, bind_dir, path):
+        if not os.path.isdir(os.path.join(bind_dir, path.strip('/'))):
+            print('Priority path {} not found'.format(path))
+            return
+        self._rsync(bind_dir, self.snapshot, link_dests=self.link_dests,
+                    args=(self._path_flag_args(path) +
+                          shard_filter_args(path, [])))
+
+    def _tiers_config(self):
+        return self.config.get('tiers')
+
+    def _backup_versioned(self, bind_dir):
+        plans = self._plan_shards(bind_dir)
+        tiers = TierSchedule(self.target, load_tiers(self._tiers_config()))
+        prev_snapshot = self.link_dests[0] if self.link_dests else None
+        carried = tiers.carried(prev_snapshot)
+        self.tier_schedule = tiers
+        self.carried_tiers = carried
+        self.carried_paths = [path for tier in carried for path in tier.paths]
+        hide_args = self._hide_args()
+        for plan in plans:
+            hide_args += hide_filter_args(plan.path)
+        self._rsync_sources(bind_dir, self.snapshot,
+                            link_dests=self.link_dests, args=hide_args)
+        if plans:
+            self._backup_shards(bind_dir, plans)
+        if carried:
+            self._carry_forward(prev_snapshot, carried)
+        if self._pack_paths():
+            self._backup_packs(bind_dir, prev_snapshot)
+
+    def _save_tiers(self):
+        # A tier only counts as copied once the versioned unit completed,
+        # without stopping at the deadline or leaving failed paths behind
+        if self.pretend or not self.tier_schedule or \
+                'versioned' in self.scheduler.skipped or \
+                'versioned' in self.scheduler.stopped or \
+                self.failed_paths.get('versioned'):
+            return
+        self.tier_schedule.save(self.carried_tiers)
+
+    def _carry_forward(self, prev_snapshot, tiers):
+        self.report.add('versioned', 'carried_tiers',
+                        [tier.name for tier in tiers])
+        for path in [path for tier in tiers for path in tier.paths]:
+            if self.pretend:
+                print('Would link {} from {}'.format(path, prev_snapshot))
+                continue
+            dest = os.path.join(self.snapshot, path.strip('/'))
+            os.makedirs(dest, exist_ok=True)
+            self._runcmd(['cp', '-al', os.path.join(
+                prev_snapshot, path.strip('/'), '.'), dest])
+
+    def _pack_config(self):
+        return self.config.get('packs') or {}
+
+    def _pack_paths(self):
+        return self._pack_config().get('paths') or []
+
+    def _backup_packs(self, bind_dir, prev_snapshot):
+        # A packed directory is stored as a single indexed archive, rebuilt
+        # only when its manifest changed and linked from the previous
+        # snapshot otherwise
+        rebuilt = []
+        linked = []
+        # Packs hold what the versioned transfer would have copied, so the
+        # same filters, including excluded cache directories, apply
+        rsync_filter = parse_rsync_args(
+            self._source_args() +
+            self.rsync.get_exclude_include_args())['filter']
+        for path in self._pack_paths():
+            source = os.path.join(bind_dir, path.strip('/'))
+            if not os.path.isdir(source):
+                print('Pack path {} not found'.format(path))
+                continue
+            if not self._pack_included(rsync_filter, path):
+                print('Pack path {} is excluded'.format(path))
+                continue
+            included = functools.partial(self._pack_member_included,
+                                         rsync_filter, path.strip('/'))
+            digest = manifest_digest(source, included)
+            pack = DirectoryPack(self.snapshot, path)
+            prev = DirectoryPack(prev_snapshot, path) \
+                if prev_snapshot else None
+            if prev and prev.digest() == digest:
+                linked.append(path)
+                if self.pretend:
+                    print('Would link pack {} from {}'.format(
+                        path, prev_snapshot))
+                else:
+                    pack.link_from(prev)
+            else:
+                rebuilt.append(path)
+                if self.pretend:
+                    print('Would rebuild pack {}'.format(path))
+                else:
+                    print('Packing {}'.format(path))
+                    pack.build(source, digest, included)
+        self.report.add('versioned', 'packs_rebuilt', rebuilt)
+        self.report.add('versioned', 'packs_linked', linked)
+
+    @staticmethod
+    def _pack_included(rsync_filter, path):
+        # rsync does not descend into excluded directories
+        rel = ''
+        for name in path.strip('/').split('/'):
+            rel = os.path.join(rel, name)
+            if not rsync_filter.included(rel, True):
+                return False
+        return True
+
+    @staticmethod
+    def _pack_member_included(rsync_filter, pack_path, rel, is_dir):
+        return rsync_filter.included(os.path.join(pack_path, rel), is_dir)
+
+    def _sharding_config(self):
+        return self.config.get('sharding')
+
+    def _plan_shards(self, bind_dir):
+        config = self._sharding_config()
+        if not config or not config.get('paths'):
+            return []
+        planner = ShardPlanner(self.target, jobs=config.get('jobs', 4),
+                               rescan_days=config.get('rescan-days', 7))
+        return planner.plan(bind_dir, config['paths'])
+
+    def _backup_shards(self, bind_dir, plans):
+        # Each shard is a separate rsync of some of a directory's entries
+        # into the same snapshot, sharing the previous snapshot as link-dest
+        tasks = []
+        for plan in plans:
+            entries = [name for shard in plan.shards for name in shard]
+            for i, shard in enumerate(plan.shards):
+                names = set(shard)
+                others = [name for name in entries if name not in names]
+                tasks.append(('{} shard {}/{}'.format(
+                    plan.path, i + 1, len(plan.shards)),
+                    functools.partial(
+                        self._rsync, bind_dir, self.snapshot,
+                        link_dests=self.link_dests,
+                        args=(self._hide_args() +
+                              self._path_flag_args(plan.path) +
+                              shard_filter_args(plan.path, others)))))
+        self.report.add('versioned', 'shards', len(tasks))
+        print('Backing up {} shards'.format(len(tasks)))
+        run_concurrently(tasks, self._sharding_config().get('jobs', 4))
 
     def _backup_single(self, bind_dir):
-        self._runcmd(
-            self._rsync_cmd(bind_dir, os.path.join(self.target, 'single'),
-                            single=True),
-            ignore_exit_codes=[24])
+        target = os.path.join(self._storage(), 'single')
+        delta_config = self.config.get('single-delta')
+        routed_paths = [route.path for route in self.routes]
+        args = skip_filter_args(routed_paths)
+        if delta_config:
+            # Files at or above the size threshold are skipped by rsync and
+            # updated in place block by block instead
+            min_size = parse_size(delta_config.get('min-size', '1G'))
+            args.append('--max-size={}'.format(min_size - 1))
+        self._rsync_sources(bind_dir, target, single=True, args=args)
+        if delta_config:
+            self._backup_single_delta(bind_dir, target, min_size,
+                                      delta_config)
+        if routed_paths:
+            self._rsync(bind_dir, target, single=True,
+                        args=route_filter_args(routed_paths))
+
+    def _backup_single_delta(self, bind_dir, target, min_size, config):
+        with tempfile.TemporaryFile('w+') as output:
+            self._runcmd(
+                self._rsync_cmd(bind_dir, target, single=True, args=[
+                    '--dry-run', '--min-size={}'.format(min_size),
+                    '--out-format={}%n'.format(CHANGED_PREFIX)]),
+                stdout=output,
+                ignore_exit_codes=self._rsync_ignored_exit_codes())
+            output.seek(0)
+            paths = [line[len(CHANGED_PREFIX):].rstrip('\n')
+                     for line in output if line.startswith(CHANGED_PREFIX)]
+        paths = [path for path in paths if not path.endswith('/')]
+        total_size = 0
+        bytes_written = 0
+        for path in paths:
+            source = os.path.join(bind_dir, path)
+            total_size += os.path.getsize(source)
+            if self.pretend:
+                print('Would update {} in place'.format(path))
+                continue
+            print('Updating {} in place'.format(path))
+            bytes_written += DeltaCopy(
+                source, os.path.join(target, path),
+                os.path.join(self.target, BLOCK_INDEX_DIR, path),
+                block_size=parse_size(config.get('block-size', '1M')),
+                jobs=config.get('jobs', 4)).run()
+        print('Block-level copy of {} files: {} written of {}'.format(
+            len(paths), format_size(bytes_written), format_size(total_size)))
 
-    def _backup_mysql(self):
+    def _backup_dumps(self):
         if self.pretend:
             return
-        try:
-            subprocess.check_call(['which', 'mysqldump'],
-                                  stderr=open(os.devnull, 'w'))
-        except subprocess.CalledProcessError:
-            print('mysqldump not found, skipping MySQL backup')
-            return
-        with tempfile.TemporaryDirectory() as mysql_dir:
-            backup_file = os.path.join(mysql_dir, 'mysqldump.sql')
-            with open(backup_file, 'w') as f:
-                self._runcmd(['mysqldump', '--all-databases'], stdout=f)
-            self._runcmd(['gzip', backup_file])
-            backup_file = '{}.gz'.format(backup_file)
-            shutil.copy(backup_file, os.path.join(
-                self.target, os.path.basename(backup_file)))
-
-    def _find_prev_version(self):
-        for fn in sorted(os.listdir(self.target), reverse=True):
-            if fn in ['single']:
+        with self._snapshot_files() as snapshot_dir:
+            providers = dump_providers(self.config, self.target,
+                                       snapshot_dir, self._runcmd)
+            if providers:
+                run_concurrently([(provider.name, self._dump_task(provider))
+                                  for provider in providers],
+                                 len(providers))
+        # Free the chunks of dumps in snapshots that were removed
+        store = ChunkStore.from_config(self.target,
+                                       self.config.get('chunk-store'))
+        if store:
+            removed, freed = store.gc(recipe_files(self.target,
+                                                   self.versions()))
+            self.report.add('chunk-store', 'removed_chunks', removed)
+            self.report.add('chunk-store', 'freed_bytes', freed)
+
+    def _dump_task(self, provider):
+        def _dump():
+            with self.report.phase('dump-{}'.format(provider.name)):
+                provider.dump()
+        return _dump
+
+    def _update_catalog(self, versioned_dir, target):
+        if self.pretend:
+            return
+        entries = None
+        if self.remote:
+            if not self.remote.ssh:
+                print('Not indexing {}: inodes can only be listed over ssh'
+                      .format(versioned_dir))
+                return
+            entries = self.remote.walk(target)
+        with Catalog(os.path.join(self.target, CATALOG_FILE)) as catalog:
+            catalog.add_snapshot(versioned_dir, target, entries=entries)
+
+    def mysql_replay(self, snapshot, stop_datetime=None):
+        if snapshot not in self.versions():
+            raise Exception('Snapshot {} not found'.format(snapshot))
+        mysql.replay(self.target, snapshot, stop_datetime=stop_datetime)
+
+    def cat(self, recipe_file, output=None):
+        path = os.path.normpath(os.path.join(self.target, recipe_file))
+        if not path.startswith(os.path.join(self.target, '')) or \
+                not os.path.isfile(path):
+            raise Exception('{} not found'.format(recipe_file))
+        ChunkStore(os.path.join(self.target, CHUNK_STORE_DIR)).cat(
+            path, output or sys.stdout.buffer)
+
+    def find_versions(self, pattern):
+        catalog_file = os.path.join(self.target, CATALOG_FILE)
+        if not os.path.isfile(catalog_file):
+            return []
+        with Catalog(catalog_file, read_only=True) as catalog:
+            return catalog.find(pattern)
+
+    def export(self, snapshot, outfile, chunk_size=None, index=False):
+        if snapshot not in self.versions():
+            raise Exception('Snapshot {} not found'.format(snapshot))
+        return SnapshotExporter(os.path.join(self.target, snapshot), outfile,
+                                chunk_size=chunk_size, index=index).export()
+
+    def extract(self, snapshot, path, dest):
+        if snapshot not in self.versions():
+            raise Exception('Snapshot {} not found'.format(snapshot))
+        pack = DirectoryPack.find(os.path.join(self.target, snapshot), path)
+        if not pack:
+            raise Exception('No pack containing {} in {}'.format(
+                path, snapshot))
+        return pack.extract(os.path.relpath(path, pack.path), dest)
+
+    def usage(self):
+        return UsageCalculator(self.target, self.versions()).calculate()
+
+    def versions(self):
+        if self.remote:
+            names = self.remote.list_dirs(self._storage())
+        else:
+            names = [fn for fn in os.listdir(self.target)
+                     if os.path.isdir(os.path.join(self.target, fn))]
+        versions = []
+        for fn in sorted(names):
+            try:
+                datetime.datetime.strptime(fn, TIMESTAMP_FORMAT)
+            except ValueError:
                 continue
-            full_path = os.path.join(self.target, fn)
-            if os.path.isdir(full_path):
-                return full_path
+            versions.append(fn)
+        return versions
 
-    def _runcmd(self, cmd, stdout=None, ignore_exit_codes=None):
+    def _runcmd(self, cmd, stdout=None, ignore_exit_codes=None,
+                stderr_lines=None):
         print('+ {}'.format(' '.join(cmd)), file=sys.stderr)
+        if self.cgroup_leaf:
+            cmd = self.cgroup.wrap(self.cgroup_leaf, cmd)
+        if not self.throttle and stderr_lines is None:
+            try:
+                subprocess.check_call(cmd, stdout=stdout)
+            except subprocess.CalledProcessError as e:
+                if ignore_exit_codes and e.returncode in ignore_exit_codes:
+                    return e.returncode
+                raise
+            return 0
+        # Run throttled commands in their own process group so the whole
+        # group can be paused and resumed
+        proc = subprocess.Popen(
+            cmd, stdout=stdout,
+            stderr=subprocess.PIPE if stderr_lines is not None else None,
+            universal_newlines=True, errors='replace',
+            start_new_session=bool(self.throttle))
         try:
-            subprocess.check_call(cmd, stdout=stdout)
-        except subprocess.CalledProcessError as e:
-            if ignore_exit_codes and e.returncode in ignore_exit_codes:
-                return
+            with contextlib.ExitStack() as stack:
+                if self.throttle:
+                    stack.enter_context(self.throttle.watch(proc))
+                if stderr_lines is not None:
+                    # Pass errors through while keeping them for parsing
+                    for line in proc.stderr:
+                        sys.stderr.write(line)
+                        stderr_lines.append(line.rstrip('\n'))
+                returncode = proc.wait()
+        except BaseException:
+            if self.throttle:
+                os.killpg(proc.pid, signal.SIGCONT)
+                os.killpg(proc.pid, signal.SIGTERM)
+            else:
+                proc.terminate()
+            proc.wait()
             raise
+        if returncode and returncode not in (ignore_exit_codes or []):
+            raise subprocess.CalledProcessError(returncode, cmd)
+        return returncode
+
+    def _retry_config(self):
+        config = self.config.get('retry')
+        if not config:
+            return None
+        return config if isinstance(config, dict) else {}
+
+    def _rsync(self, source, dest, link_dests=None, single=False, args=None):
+        native = self._native_copy_config()
+        if self._physical_order_config() and not self.pretend and \
+                not native:
+            self._rsync_physical_order(source, dest, link_dests=link_dests,
+                                       single=single, args=args)
+            if self.unit_stopped:
+                return
+        retry = self._retry_config()
+        if retry is None and not native:
+            returncode = self._runcmd(
+                self._rsync_cmd(source, dest, link_dests=link_dests,
+                                single=single, args=args),
+                ignore_exit_codes=self._rsync_ignored_exit_codes())
+            if returncode == RSYNC_STOPPED:
+                self.unit_stopped = True
+            return
+        failed = self._transfer(source, dest, link_dests=link_dests,
+                                single=single, args=args)
+        if retry is None:
+            if failed:
+                raise Exception('{} paths failed to copy'.format(
+                    len(failed)))
+            return
+        delay = retry.get('delay', 10)
+        for _ in range(retry.get('attempts', 3)):
+            if not failed:
+                break
+            # Only the failed paths are transferred again
+            print('Retrying {} failed paths in {}s'.format(len(failed),
+                                                           delay))
+            time.sleep(delay)
+            delay *= 2
+            failed = self._transfer(source, dest, link_dests=link_dests,
+                                    single=single, args=args,
+                                    files=sorted(failed))
+        if not failed:
+            return
+        kind = 'single' if single else 'versioned'
+        self.failed_paths.setdefault(kind, {}).update(failed)
+        total = sum(len(paths) for paths in self.failed_paths.values())
+        if total > retry.get('max-failures', 100):
+            raise Exception('{} paths failed to back up'.format(total))
+
+    def _transfer(self, source, dest, link_dests=None, single=False,
+                  args=None, files=None):
+        # Returns the paths that failed to copy, with their errors
+        if self._native_copy_config():
+            return self._native_copy(source, dest, link_dests=link_dests,
+                                     single=single, args=args, files=files)
+        if files is None:
+            return self._rsync_failures(
+                self._rsync_cmd(source, dest, link_dests=link_dests,
+                                single=single, args=args),
+                source, dest)
+        with self._files_from(files) as files_from:
+            return self._rsync_failures(
+                self._rsync_cmd(source, dest, link_dests=link_dests,
+                                single=single, args=args,
+                                files_from=files_from),
+                source, dest)
 
-    def _rsync_cmd(self, source, dest, link_dest=None, single=False):
-        rsync_cmd = [
-            'ionice', '-c', '3',
+    def _native_copy_config(self):
+        config = self.config.get('native-copy')
+        if not config:
+            return None
+        return config if isinstance(config, dict) else {}
+
+    def _native_copy(self, source, dest, link_dests=None, single=False,
+                     args=None, files=None):
+        # The same filter arguments as rsync, interpreted in-process
+        print('Copying {} to {}'.format(source, dest), file=sys.stderr)
+        copy = LocalCopy(
+            source, dest,
+            args=(self._source_args() + (args or []) +
+                  self.rsync.get_exclude_include_args(single)),
+            link_dests=link_dests,
+            jobs=self._native_copy_config().get('jobs', 8),
+            stop_at=self.stop_at, pretend=self.pretend)
+        failed = copy.run(files=files)
+        if copy.stopped:
+            self.unit_stopped = True
+        return failed
+
+    def _physical_order_config(self):
+        return self.config.get('physical-order')
+
+    def _rsync_physical_order(self, source, dest, link_dests=None,
+                              single=False, args=None):
+        # rsync reads files sorted by name, so changed files are first copied
+        # in batches taken in disk order. The full pass that follows then
+        # only handles deletions, links and anything the batches missed
+        config = self._physical_order_config()
+        config = config if isinstance(config, dict) else {}
+        with tempfile.TemporaryFile('w+') as output:
+            self._runcmd(
+                self._rsync_cmd(source, dest, link_dests=link_dests,
+                                single=single,
+                                args=(args or []) + [
+                                    '--dry-run',
+                                    '--out-format={}%n'.format(
+                                        CHANGED_PREFIX)]),
+                stdout=output,
+                ignore_exit_codes=(self._rsync_ignored_exit_codes() +
+                                   [RSYNC_PARTIAL_ERROR]))
+            output.seek(0)
+            changed = [line[len(CHANGED_PREFIX):].rstrip('\n')
+                       for line in output if line.startswith(CHANGED_PREFIX)]
+        paths = physical_order(
+            source, [path for path in changed if not path.endswith('/')],
+            method=config.get('method', 'fiemap'))
+        if not paths:
+            return
+        print('Copying {} changed files in physical order'.format(len(paths)))
+        for batch in batches(paths, config.get('batch-files', 1000)):
+            if self._past_stop_at():
+                self.unit_stopped = True
+            if self.unit_stopped:
+                print('Deadline reached, not copying further batches')
+                return
+            with self._files_from(batch) as files_from:
+                returncode = self._runcmd(
+                    self._rsync_cmd(source, dest, link_dests=link_dests,
+                                    single=single, args=args,
+                                    files_from=files_from),
+                    ignore_exit_codes=(self._rsync_ignored_exit_codes() +
+                                       [RSYNC_PARTIAL_ERROR]))
+            if returncode == RSYNC_STOPPED:
+                self.unit_stopped = True
+
+    def _past_stop_at(self):
+        return bool(self.stop_at) and datetime.datetime.now() >= \
+            datetime.datetime.strptime(self.stop_at, STOP_AT_FORMAT)
+
+    @contextlib.contextmanager
+    def _files_from(self, paths):
+        with tempfile.NamedTemporaryFile(
+                'w', prefix='extbackup-files.') as files_from:
+            files_from.write(''.join('{}\0'.format(path) for path in paths))
+            files_from.flush()
+            yield files_from.name
+
+    def _rsync_failures(self, cmd, source, dest):
+        lines = []
+        returncode = self._runcmd(
+            cmd, stderr_lines=lines,
+            ignore_exit_codes=(self._rsync_ignored_exit_codes() +
+                               [RSYNC_PARTIAL_ERROR]))
+        failed = parse_failed_paths(lines, source, dest)
+        if returncode == RSYNC_STOPPED:
+            self.unit_stopped = True
+        if returncode == RSYNC_PARTIAL_ERROR and not failed:
+            raise subprocess.CalledProcessError(returncode, cmd)
+        return failed
+
+    def _source_args(self):
+        return []
+
+    def _rsync_ignored_exit_codes(self):
+        # Files vanishing during the transfer are expected, as is stopping
+        # at the deadline
+        codes = [RSYNC_PARTIAL_TRANSFER]
+        if self.stop_at:
+            codes.append(RSYNC_STOPPED)
+        return codes
+
+    def _rsync_cmd(self, source, dest, link_dests=None, single=False,
+                   args=None, files_from=None):
+        # With pressure throttling enabled, run at best-effort I/O priority
+        # and let the throttle back off under load instead
+        io_class = ['-c', '2', '-n', '7'] if self.throttle else ['-c', '3']
+        rsync_cmd = ['ionice'] + io_class + [
             'nice', '-n', '19',
             'rsync', '-P', '-avHSAX', '--numeric-ids',
-            '--delete', '--delete-excluded',
-        ]
+        ] + self._source_args()
+        if files_from:
+            # Deletion needs a recursive transfer. --files-from turns off the
+            # recursion of -a, so listed directories need -r to be copied
+            # with their contents
+            rsync_cmd += ['-r', '--from0',
+                          '--files-from={}'.format(files_from)]
+        else:
+            rsync_cmd += ['--delete', '--delete-excluded']
+        rsync_cmd += args or []
         rsync_cmd += self.rsync.get_exclude_include_args(single)
-        if link_dest:
+        for link_dest in link_dests or []:
+            if self.remote:
+                # Resolved by the receiving side, relative to the destination
+                link_dest = os.path.relpath(link_dest, dest)
             rsync_cmd.append('--link-dest={}'.format(link_dest))
+        if self.bwlimit:
+            rsync_cmd.append('--bwlimit={}'.format(self.bwlimit))
+        if self.stop_at:
+            rsync_cmd.append('--stop-at={}'.format(self.stop_at))
+        if self.remote:
+            rsync_cmd += self.remote.rsync_args()
+            dest = self.remote.url(dest)
         # Add trailing slashes to source path
         rsync_cmd += [os.path.join(source, ''), dest]
         if self.pretend:
             rsync_cmd.append('--dry-run')
         return rsync_cmd
+
+
+class ProfileBackup(ExternalBackup):
+    def __init__(self, profile, config, pretend=False):
+        super(ProfileBackup, self).__init__(pretend=pretend, mounts=[])
+        self.profile = profile
+        self.global_config = config
+
+    @property
+    def name(self):
+        return self.profile.name
+
+    @property
+    def target_name(self):
+        return self.profile.target
+
+    def backup(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.rsync = RsyncPaths(None, temp_dir,
+                                    config=self.profile.config)
+            self._configure(self.global_config)
+            if self.remote:
+                self._check_remote()
+            self._backup_run(self.profile.root)
+
+    def _sharding_config(self):
+        return self.profile.config.get('sharding')
+
+    def _pack_config(self):
+        return self.profile.config.get('packs') or {}
+
+    def _phases(self):
+        phases = [('versioned', self._backup_versioned)]
+        if any(section in self.profile.config
+               for section in ['include-single', 'exclude-single']):
+            phases.append(('single', self._backup_single))
+        return phases
+
+    def _schedule_config(self):
+        return self.profile.config.get('schedule') or {}
+
+    def _tiers_config(self):
+        return self.profile.config.get('tiers')
+
+    def _cache_exclude_config(self):
+        return self.profile.config.get('cache-exclude')
+
+    def _routing_config(self):
+        return self.profile.config.get('routing')
+
+    def _probe_sources(self, bind_dir):
+        return ['/']
+
+    def _source_args(self):
+        # Unlike the host's bind mounts, a profile root may contain other
+        # mounts such as /proc in a chroot
+        return ['--one-file-system']
@@ -0,0 +1,120 @@
+import collections
+import os
+import sqlite3
+
+CACHEDIR_TAG = 'CACHEDIR.TAG'
+CACHEDIR_SIGNATURE = b'Signature: 8a477f597d28d172789f06886806bc55'
+CACHEDIR_SCAN_FILE = '.cachedir-scan.sqlite'
+
+ScannedDir = collections.namedtuple('ScannedDir',
+                                    ['mtime', 'rule', 'size', 'subdirs'])
+
+
+def is_cachedir_tag(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(CACHEDIR_SIGNATURE)) == CACHEDIR_SIGNATURE
+    except OSError:
+        return False
+
+
+def directory_size(path):
+    size = 0
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    size += directory_size(entry.path)
+                else:
+                    size += entry.stat(follow_symlinks=False).st_size
+    except OSError:
+        pass
+    return size
+
+
+class CacheDirScanner(object):
+    # Finds cache directories, re-reading only directories whose mtime
+    # changed since the previous scan
+    def __init__(self, cache_file, markers=None):
+        self.cache_file = cache_file
+        self.markers = markers or []
+        self.cache = {}
+        self.scanned = {}
+
+    def load(self):
+        if not os.path.isfile(self.cache_file):
+            return
+        conn = sqlite3.connect(self.cache_file)
+        try:
+            for path, mtime, rule, size, subdirs in conn.execute(
+                    'SELECT path, mtime, rule, size, subdirs FROM dirs'):
+                self.cache[path] = ScannedDir(
+                    mtime, rule, size, subdirs.split('\0') if subdirs else [])
+        except sqlite3.DatabaseError:
+            self.cache = {}
+        finally:
+            conn.close()
+
+    def save(self):
+        temp_file = '{}.tmp'.format(self.cache_file)
+        if os.path.exists(temp_file):
+            os.unlink(temp_file)
+        conn = sqlite3.connect(temp_file)
+        try:
+            conn.execute('CREATE TABLE dirs (path TEXT PRIMARY KEY, '
+                         'mtime INTEGER, rule TEXT, size INTEGER, '
+                         'subdirs TEXT)')
+            conn.executemany(
+                'INSERT INTO dirs VALUES (?, ?, ?, ?, ?)',
+                ((path, d.mtime, d.rule, d.size, '\0'.join(d.subdirs))
+                 for path, d in self.scanned.items()))
+            conn.commit()
+        finally:
+            conn.close()
+        os.rename(temp_file, self.cache_file)
+
+    def scan(self, root):
+        # Return (path, rule, size) for each cache directory under root
+        found = []
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            path = os.path.join(root, rel)
+            try:
+                mtime = os.lstat(path).st_mtime_ns
+            except OSError:
+                continue
+            scanned = self.cache.get(rel)
+            if not scanned or scanned.mtime != mtime:
+                # The source root itself is never excluded
+                scanned = self._inspect(path, mtime, root=not rel)
+            self.scanned[rel] = scanned
+            if scanned.rule:
+                found.append((rel, scanned.rule, scanned.size))
+                continue
+            stack.extend(os.path.join(rel, name)
+                         for name in reversed(scanned.subdirs))
+        return sorted(found)
+
+    def _inspect(self, path, mtime, root=False):
+        names = set()
+        subdirs = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    names.add(entry.name)
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+        except OSError:
+            return ScannedDir(mtime, None, 0, [])
+        rule = None
+        if not root:
+            if CACHEDIR_TAG in names and \
+                    is_cachedir_tag(os.path.join(path, CACHEDIR_TAG)):
+                rule = CACHEDIR_TAG
+            else:
+                rule = next((marker for marker in self.markers
+                             if marker in names), None)
+        if rule:
+            return ScannedDir(mtime, rule, directory_size(path), [])
+        return ScannedDir(mtime, None, 0, sorted(subdirs))
@@ -0,0 +1,169 @@
+import os
+import pathlib
+import sqlite3
+import stat
+
+CATALOG_FILE = '.catalog.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS paths (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS versions (
+    id INTEGER PRIMARY KEY,
+    path_id INTEGER NOT NULL REFERENCES paths(id),
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    first_snapshot INTEGER NOT NULL REFERENCES snapshots(id),
+    -- NULL while the version is still in the latest snapshot
+    last_snapshot INTEGER REFERENCES snapshots(id)
+);
+CREATE INDEX IF NOT EXISTS versions_last ON versions(last_snapshot, path_id);
+CREATE INDEX IF NOT EXISTS versions_path ON versions(path_id);
+'''
+
+
+def _walk_entries(top):
+    pending = [top]
+    while pending:
+        dir_name = pending.pop()
+        try:
+            entries = list(os.scandir(dir_name))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                pending.append(entry.path)
+                continue
+            yield ('/' + os.path.relpath(entry.path, top),
+                   st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class Catalog(object):
+    BATCH_SIZE = 10000
+
+    def __init__(self, db_file, read_only=False):
+        self.db_file = db_file
+        if read_only:
+            # Queries never create or change the catalog
+            self.db = sqlite3.connect(
+                pathlib.Path(os.path.abspath(db_file)).as_uri() + '?mode=ro',
+                uri=True)
+        else:
+            self.db = sqlite3.connect(db_file)
+            self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        self.close()
+
+    def snapshots(self):
+        return [row[0] for row in self.db.execute(
+            'SELECT name FROM snapshots ORDER BY id')]
+
+    def add_snapshot(self, name, snapshot_dir, entries=None):
+        # entries lists the snapshot's files when it cannot be walked here
+        if name in self.snapshots():
+            raise Exception('Snapshot {} is already indexed'.format(name))
+        print('Indexing {}'.format(snapshot_dir))
+        prev_id = self._last_snapshot_id()
+        with self.db:
+            snapshot_id = self.db.execute(
+                'INSERT INTO snapshots (name) VALUES (?)', (name,)).lastrowid
+            self.db.execute('CREATE TEMP TABLE current ('
+                            'path TEXT PRIMARY KEY, inode INTEGER, '
+                            'size INTEGER, mtime INTEGER)')
+            try:
+                self._load_current(_walk_entries(snapshot_dir)
+                                   if entries is None else entries)
+                self._update_versions(prev_id, snapshot_id)
+            finally:
+                self.db.execute('DROP TABLE temp.current')
+        return snapshot_id
+
+    def find(self, pattern):
+        return self.db.execute(
+            'SELECT p.path, v.inode, v.size, v.mtime, '
+            'f.name, l.name '
+            'FROM versions v '
+            'JOIN paths p ON p.id = v.path_id '
+            'JOIN snapshots f ON f.id = v.first_snapshot '
+            'JOIN snapshots l ON l.id = COALESCE('
+            '  v.last_snapshot, (SELECT MAX(id) FROM snapshots)) '
+            'WHERE p.path GLOB ? '
+            'ORDER BY p.path, v.first_snapshot', (pattern,)).fetchall()
+
+    def churn(self, window, min_size):
+        # (path, size, changes) for files in the latest snapshot, counting
+        # the new versions seen over the last window snapshots
+        ids = [row[0] for row in self.db.execute(
+            'SELECT id FROM snapshots ORDER BY id DESC LIMIT ?', (window,))]
+        if len(ids) < 2:
+            return []
+        return self.db.execute(
+            'SELECT p.path, cur.size, COUNT(v.id) '
+            'FROM versions cur '
+            'JOIN paths p ON p.id = cur.path_id '
+            'LEFT JOIN versions v ON v.path_id = cur.path_id '
+            '  AND v.first_snapshot > :start '
+            'WHERE cur.last_snapshot IS NULL AND cur.size >= :min_size '
+            'GROUP BY p.path, cur.size '
+            'ORDER BY p.path',
+            {'start': ids[-1], 'min_size': min_size}).fetchall()
+
+    def _last_snapshot_id(self):
+        row = self.db.execute('SELECT MAX(id) FROM snapshots').fetchone()
+        return row[0]
+
+    def _load_current(self, entries):
+        batch = []
+        for entry in entries:
+            batch.append(entry)
+            if len(batch) >= self.BATCH_SIZE:
+                self._insert_current(batch)
+                batch = []
+        self._insert_current(batch)
+
+    def _insert_current(self, batch):
+        self.db.executemany('INSERT OR REPLACE INTO temp.current '
+                            'VALUES (?, ?, ?, ?)', batch)
+
+    def _update_versions(self, prev_id, snapshot_id):
+        # Versions whose inode is unchanged stay open and are not touched.
+        # Only versions that changed or disappeared are closed at the
+        # previous snapshot, and new versions are added for them
+        if prev_id is not None:
+            self.db.execute(
+                'UPDATE versions SET last_snapshot = :prev '
+                'WHERE last_snapshot IS NULL AND NOT EXISTS ('
+                '  SELECT 1 FROM paths p '
+                '  JOIN temp.current c ON c.path = p.path '
+                '  WHERE p.id = versions.path_id '
+                '  AND c.inode = versions.inode)',
+                {'prev': prev_id})
+        self.db.execute('INSERT OR IGNORE INTO paths (path) '
+                        'SELECT path FROM temp.current')
+        self.db.execute(
+            'INSERT INTO versions (path_id, inode, size, mtime, '
+            '                      first_snapshot, last_snapshot) '
+            'SELECT p.id, c.inode, c.size, c.mtime, :new, NULL '
+            'FROM temp.current c JOIN paths p ON p.path = c.path '
+            'WHERE NOT EXISTS ('
+            '  SELECT 1 FROM versions v '
+            '  WHERE v.path_id = p.id AND v.last_snapshot IS NULL)',
+            {'new': snapshot_id})
@@ -0,0 +1,162 @@
+import contextlib
+import os
+
+from .sizes import parse_size
+
+CGROUP_DIR = '/sys/fs/cgroup'
+CONTROLLERS = ['cpu', 'io', 'memory']
+
+
+def _read(file_name):
+    with open(file_name, 'r') as f:
+        return f.read()
+
+
+def _write(file_name, value):
+    with open(file_name, 'w') as f:
+        f.write(value)
+
+
+def parse_io_stat(text):
+    # Sum read and written bytes over all devices
+    totals = {'rbytes': 0, 'wbytes': 0}
+    for line in text.splitlines():
+        for field in line.split()[1:]:
+            key, _, value = field.partition('=')
+            if key in totals:
+                totals[key] += int(value)
+    return totals
+
+
+def io_max_line(device, limits):
+    rdev = os.stat(device).st_rdev
+    fields = []
+    for field in str(limits).split():
+        key, _, value = field.partition('=')
+        if key.endswith('bps') and value != 'max':
+            value = parse_size(value)
+        fields.append('{}={}'.format(key, value))
+    return '{}:{} {}'.format(os.major(rdev), os.minor(rdev),
+                             ' '.join(fields))
+
+
+class BackupCgroup(object):
+    # A transient cgroup v2 containing extbackup and every command it runs,
+    # with a leaf per backup phase so usage can be read back per phase
+    def __init__(self, memory_high=None, io_max=None, io_weight=None,
+                 cpu_weight=None, cgroup_dir=CGROUP_DIR):
+        self.limits = {}
+        if memory_high is not None:
+            self.limits['memory.high'] = str(parse_size(memory_high))
+        if io_max:
+            self.limits['io.max'] = [io_max_line(device, limits)
+                                     for device, limits in io_max.items()]
+        if io_weight is not None:
+            self.limits['io.weight'] = 'default {}'.format(io_weight)
+        if cpu_weight is not None:
+            self.limits['cpu.weight'] = str(cpu_weight)
+        self.cgroup_dir = cgroup_dir
+        self.path = os.path.join(cgroup_dir,
+                                 'extbackup-{}'.format(os.getpid()))
+        self.origin = None
+
+    @classmethod
+    def from_config(cls, config):
+        if not config:
+            return None
+        cgroup = cls(memory_high=config.get('memory-high'),
+                     io_max=config.get('io-max'),
+                     io_weight=config.get('io-weight'),
+                     cpu_weight=config.get('cpu-weight'))
+        if not cgroup.available():
+            print('cgroup v2 not available, running without a cgroup')
+            return None
+        return cgroup
+
+    def available(self):
+        return os.path.isfile(os.path.join(self.cgroup_dir,
+                                           'cgroup.controllers'))
+
+    def __enter__(self):
+        self._enable_controllers(self.cgroup_dir)
+        os.mkdir(self.path)
+        try:
+            for key, value in sorted(self.limits.items()):
+                for line in (value if isinstance(value, list) else [value]):
+                    _write(os.path.join(self.path, key), line)
+            self._enable_controllers(self.path)
+            # Processes may only be in leaves once controllers are enabled
+            self.origin = self._current()
+            _write(os.path.join(self.leaf('main'), 'cgroup.procs'),
+                   str(os.getpid()))
+        except BaseException:
+            self._remove()
+            raise
+        print('Running in cgroup {}'.format(self.path))
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        self._remove()
+
+    def leaf(self, name):
+        path = os.path.join(self.path, name.replace('/', '_'))
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        return path
+
+    @contextlib.contextmanager
+    def phase(self, name, report, phase):
+        path = self.leaf(name)
+        try:
+            yield path
+        finally:
+            self._report(path, report, phase)
+            self._rmdir(path)
+
+    def wrap(self, leaf, cmd):
+        # Join the leaf before exec so no child escapes accounting
+        return ['sh', '-c', 'echo $$ > "$0" && exec "$@"',
+                os.path.join(leaf, 'cgroup.procs')] + cmd
+
+    def _report(self, path, report, phase):
+        peak_file = os.path.join(path, 'memory.peak')
+        if os.path.isfile(peak_file):
+            report.add(phase, 'memory_peak_bytes', int(_read(peak_file)))
+        io_file = os.path.join(path, 'io.stat')
+        if os.path.isfile(io_file):
+            totals = parse_io_stat(_read(io_file))
+            report.add(phase, 'read_bytes', totals['rbytes'])
+            report.add(phase, 'write_bytes', totals['wbytes'])
+
+    def _enable_controllers(self, path):
+        available = _read(os.path.join(path, 'cgroup.controllers')).split()
+        enabled = _read(os.path.join(path, 'cgroup.subtree_control')).split()
+        missing = [c for c in CONTROLLERS if c in available and
+                   c not in enabled]
+        if missing:
+            _write(os.path.join(path, 'cgroup.subtree_control'),
+                   ' '.join('+{}'.format(c) for c in missing))
+
+    def _current(self):
+        for line in _read('/proc/self/cgroup').splitlines():
+            if line.startswith('0::'):
+                return os.path.join(self.cgroup_dir,
+                                    line[3:].lstrip('/'))
+        return self.cgroup_dir
+
+    def _rmdir(self, path):
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            print('Unable to remove cgroup {}: {}'.format(path, e))
+
+    def _remove(self):
+        if not os.path.isdir(self.path):
+            return
+        if self.origin:
+            _write(os.path.join(self.origin, 'cgroup.procs'),
+                   str(os.getpid()))
+        for entry in os.scandir(self.path):
+            if entry.is_dir():
+                self._rmdir(entry.path)
+        self._rmdir(self.path)
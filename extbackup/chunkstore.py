@@ -0,0 +1,151 @@
+import hashlib
+import os
+import re
+import tempfile
+import zlib
+
+from .sizes import format_size
+from .sizes import parse_size
+
+CHUNK_STORE_DIR = '.chunks'
+RECIPE_SUFFIX = '.recipe'
+RECIPE_HEADER = 'extbackup-recipe 1'
+WINDOW_SIZE = 64
+
+# Chunk boundaries are only considered after line breaks and the row
+# separators of SQL extended inserts, which keeps boundary detection in C
+ANCHOR_RE = re.compile(rb'\n|\),\(')
+
+
+class ChunkStore(object):
+    def __init__(self, store_dir, min_size=256 * 1024,
+                 max_size=4 * 1024 * 1024, mask_bits=10):
+        if min_size < WINDOW_SIZE or max_size <= min_size:
+            raise Exception('Invalid chunk sizes {}..{}'.format(
+                min_size, max_size))
+        self.store_dir = store_dir
+        self.min_size = min_size
+        self.max_size = max_size
+        self.mask = (1 << mask_bits) - 1
+
+    @classmethod
+    def from_config(cls, target, config):
+        if not config:
+            return None
+        config = config if isinstance(config, dict) else {}
+        return cls(os.path.join(target, CHUNK_STORE_DIR),
+                   min_size=parse_size(config.get('min-size', '256K')),
+                   max_size=parse_size(config.get('max-size', '4M')))
+
+    def chunks(self, stream):
+        data = b''
+        eof = False
+        while data or not eof:
+            # Always search a full max_size window so boundaries do not
+            # depend on how the stream was read
+            while not eof and len(data) < self.max_size:
+                block = stream.read(self.max_size)
+                if not block:
+                    eof = True
+                data += block
+            if not data:
+                break
+            cut = self._boundary(data)
+            yield data[:cut]
+            data = data[cut:]
+
+    def _boundary(self, data):
+        limit = min(len(data), self.max_size)
+        if limit <= self.min_size:
+            return limit
+        # A boundary is placed where the hash of the bytes preceding an
+        # anchor matches the mask, so inserted or removed data only changes
+        # the surrounding chunks
+        for match in ANCHOR_RE.finditer(data, self.min_size, limit):
+            end = match.end()
+            if not zlib.crc32(data[end - WINDOW_SIZE:end]) & self.mask:
+                return end
+        return limit
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.store_dir, digest[:2], digest[2:])
+
+    def _store_chunk(self, digest, chunk):
+        path = self._chunk_path(digest)
+        if os.path.exists(path):
+            return False
+        os.makedirs(os.path.dirname(path), 0o0700, exist_ok=True)
+        fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(zlib.compress(chunk))
+            os.rename(temp_file, path)
+        except BaseException:
+            os.unlink(temp_file)
+            raise
+        return True
+
+    def write(self, stream, recipe_file):
+        total = 0
+        new = 0
+        lines = [RECIPE_HEADER]
+        for chunk in self.chunks(stream):
+            digest = hashlib.sha256(chunk).hexdigest()
+            if self._store_chunk(digest, chunk):
+                new += len(chunk)
+            total += len(chunk)
+            lines.append('{} {}'.format(digest, len(chunk)))
+        temp_file = '{}.tmp'.format(recipe_file)
+        with open(temp_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(temp_file, recipe_file)
+        return total, new
+
+    def add_file(self, source, recipe_file):
+        with open(source, 'rb') as f:
+            total, new = self.write(f, recipe_file)
+        print('Stored {} as chunks, {} new'.format(
+            format_size(total), format_size(new)))
+        return total, new
+
+    def _read_recipe(self, recipe_file):
+        with open(recipe_file, 'r') as f:
+            if f.readline().rstrip('\n') != RECIPE_HEADER:
+                raise Exception('{} is not a chunk recipe'.format(
+                    recipe_file))
+            for line in f:
+                digest, size = line.split()
+                yield digest, int(size)
+
+    def cat(self, recipe_file, output):
+        for digest, size in self._read_recipe(recipe_file):
+            with open(self._chunk_path(digest), 'rb') as chunk_file:
+                chunk = zlib.decompress(chunk_file.read())
+            if len(chunk) != size or \
+                    hashlib.sha256(chunk).hexdigest() != digest:
+                raise Exception('Chunk {} is corrupt'.format(digest))
+            output.write(chunk)
+
+    def gc(self, recipe_files):
+        # Mark the chunks listed by the remaining recipes, then sweep the
+        # rest, including temporary files left by interrupted writes
+        referenced = set()
+        for recipe_file in recipe_files:
+            referenced.update(digest for digest, _ in
+                              self._read_recipe(recipe_file))
+        removed = 0
+        freed = 0
+        if not os.path.isdir(self.store_dir):
+            return removed, freed
+        for prefix in sorted(os.listdir(self.store_dir)):
+            chunk_dir = os.path.join(self.store_dir, prefix)
+            for name in os.listdir(chunk_dir):
+                if prefix + name in referenced:
+                    continue
+                path = os.path.join(chunk_dir, name)
+                freed += os.lstat(path).st_size
+                os.unlink(path)
+                removed += 1
+        print('Removed {} unreferenced chunks, {} freed'.format(
+            removed, format_size(freed)))
+        return removed, freed
@@ -0,0 +1,146 @@
+import errno
+import os
+import socket
+import sys
+import time
+import traceback
+
+from .fstab import fstab_mount_points
+from .rsync import load_config
+
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL_GROUP = 1
+
+# Both LUKS1 and LUKS2 headers store the UUID at the same offset
+LUKS_MAGIC = b'LUKS\xba\xbe'
+LUKS_UUID_OFFSET = 168
+LUKS_UUID_LENGTH = 40
+
+SYS_BLOCK_DIR = '/sys/class/block'
+
+
+def parse_uevent(data):
+    fields = data.split(b'\0')
+    event = {}
+    for field in fields[1:]:
+        if b'=' in field:
+            key, value = field.split(b'=', 1)
+            event[key.decode()] = value.decode(errors='replace')
+    return event
+
+
+def uevents():
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                         NETLINK_KOBJECT_UEVENT)
+    sock.bind((0, UEVENT_KERNEL_GROUP))
+    try:
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # The kernel dropped events that arrived faster than they
+                # were read, so look for disks attached in the meantime
+                print('Missed device events, rescanning attached disks',
+                      file=sys.stderr)
+                for event in attached_devices():
+                    yield event
+                continue
+            yield parse_uevent(data)
+    finally:
+        sock.close()
+
+
+def attached_devices():
+    for name in sorted(os.listdir(SYS_BLOCK_DIR)):
+        yield {'ACTION': 'add', 'SUBSYSTEM': 'block', 'DEVNAME': name,
+               'RESCAN': '1'}
+
+
+def luks_uuid(device):
+    try:
+        with open(device, 'rb') as f:
+            header = f.read(LUKS_UUID_OFFSET + LUKS_UUID_LENGTH)
+    except OSError:
+        return None
+    if not header.startswith(LUKS_MAGIC):
+        return None
+    return header[LUKS_UUID_OFFSET:].rstrip(b'\0').decode(errors='replace')
+
+
+class CachedFile(object):
+    # Keep a value parsed from a file until the file's mtime changes
+    def __init__(self, file_name, loader):
+        self.file_name = file_name
+        self.loader = loader
+        self.mtime = None
+        self.value = None
+
+    def get(self):
+        mtime = os.stat(self.file_name).st_mtime_ns
+        if mtime != self.mtime:
+            self.value = self.loader(self.file_name)
+            self.mtime = mtime
+        return self.value
+
+
+class BackupDaemon(object):
+    DEVICE_WAIT = 5
+
+    def __init__(self, app, config_file, events=None):
+        self.app = app
+        self.config = CachedFile(config_file, load_config)
+        self.mounts = CachedFile('/etc/fstab',
+                                 lambda _: fstab_mount_points())
+        self.events = events
+        # Devices backed up since they were attached, so a rescan does not
+        # back them up again
+        self.backed_up = set()
+
+    @property
+    def daemon_config(self):
+        return self.config.get().get('daemon') or {}
+
+    def run(self):
+        uuids = self.daemon_config.get('uuids')
+        if not uuids:
+            raise Exception('No backup disk UUIDs configured')
+        print('Waiting for backup disks: {}'.format(', '.join(uuids)))
+        for event in (self.events if self.events is not None
+                      else uevents()):
+            if event.get('ACTION') == 'remove' and event.get('DEVNAME'):
+                self.backed_up.discard(
+                    os.path.join('/dev', event['DEVNAME']))
+            device = self._match(event)
+            if not device:
+                continue
+            if event.get('RESCAN') and device in self.backed_up:
+                continue
+            self.backed_up.add(device)
+            try:
+                self._backup(device)
+            except Exception:
+                traceback.print_exc()
+
+    def _match(self, event):
+        if event.get('ACTION') != 'add' or \
+                event.get('SUBSYSTEM') != 'block' or \
+                not event.get('DEVNAME'):
+            return None
+        device = os.path.join('/dev', event['DEVNAME'])
+        # The device node may appear shortly after the event
+        for _ in range(self.DEVICE_WAIT):
+            if os.path.exists(device):
+                break
+            time.sleep(1)
+        uuid = luks_uuid(device)
+        if uuid and uuid in self.daemon_config.get('uuids', []):
+            print('Backup disk {} attached as {}'.format(uuid, device))
+            return device
+        return None
+
+    def _backup(self, device):
+        self.app.backup_device(device, config=self.config.get(),
+                               mounts=self.mounts.get(),
+                               key_file=self.daemon_config.get('key-file'))
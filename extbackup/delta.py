@@ -0,0 +1,181 @@
+import concurrent.futures
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import mmap
+import os
+import struct
+
+BLOCK_INDEX_DIR = '.block-index'
+DIGEST_SIZE = 16
+HOLE_DIGEST = b'\0' * DIGEST_SIZE
+INDEX_HEADER = struct.Struct('<QQQQ')
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+
+def data_segments(fd, size):
+    # Yield (start, end) ranges containing data, skipping holes
+    if not hasattr(os, 'SEEK_DATA'):
+        yield 0, size
+        return
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return
+            if e.errno == errno.EINVAL:
+                yield offset, size
+                return
+            raise
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        yield start, min(end, size)
+        offset = end
+
+
+def _digest(data):
+    if hasattr(hashlib, 'blake2b'):
+        return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+    return hashlib.sha256(data).digest()[:DIGEST_SIZE]
+
+
+def _libc_fallocate():
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    fallocate = libc.fallocate
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                          ctypes.c_int64, ctypes.c_int64]
+    return fallocate
+
+
+def punch_hole(fd, offset, length):
+    try:
+        fallocate = _libc_fallocate()
+    except (AttributeError, OSError):
+        fallocate = None
+    if fallocate and fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                               offset, length) == 0:
+        return
+    os.pwrite(fd, b'\0' * length, offset)
+
+
+class BlockIndex(object):
+    def __init__(self, size, mtime_ns, block_size, digests):
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.block_size = block_size
+        self.digests = digests
+
+    @classmethod
+    def load(cls, file_name):
+        try:
+            with open(file_name, 'rb') as f:
+                size, mtime_ns, block_size, count = INDEX_HEADER.unpack(
+                    f.read(INDEX_HEADER.size))
+                data = f.read(count * DIGEST_SIZE)
+        except (OSError, struct.error):
+            return None
+        if len(data) != count * DIGEST_SIZE:
+            return None
+        return cls(size, mtime_ns, block_size,
+                   [data[i:i + DIGEST_SIZE]
+                    for i in range(0, len(data), DIGEST_SIZE)])
+
+    def save(self, file_name):
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        temp_file = '{}.tmp'.format(file_name)
+        with open(temp_file, 'wb') as f:
+            f.write(INDEX_HEADER.pack(self.size, self.mtime_ns,
+                                      self.block_size, len(self.digests)))
+            f.write(b''.join(self.digests))
+        os.rename(temp_file, file_name)
+
+    def matches(self, st, block_size):
+        return (self.size == st.st_size and self.mtime_ns == st.st_mtime_ns
+                and self.block_size == block_size)
+
+
+def hash_blocks(fd, size, block_size, jobs=4):
+    if not size:
+        return []
+    count = (size + block_size - 1) // block_size
+    has_data = [False] * count
+    for start, end in data_segments(fd, size):
+        for block in range(start // block_size,
+                           (end + block_size - 1) // block_size):
+            has_data[block] = True
+    with mmap.mmap(fd, size, prot=mmap.PROT_READ) as mm:
+        view = memoryview(mm)
+
+        def _hash(block):
+            if not has_data[block]:
+                return HOLE_DIGEST
+            offset = block * block_size
+            return _digest(view[offset:offset + block_size])
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+                return list(executor.map(_hash, range(count)))
+        finally:
+            view.release()
+
+
+class DeltaCopy(object):
+    def __init__(self, source, dest, index_file, block_size=1024 * 1024,
+                 jobs=4):
+        self.source = source
+        self.dest = dest
+        self.index_file = index_file
+        self.block_size = block_size
+        self.jobs = jobs
+        self.bytes_written = 0
+
+    def run(self):
+        st = os.stat(self.source)
+        src_fd = os.open(self.source, os.O_RDONLY)
+        try:
+            source_digests = hash_blocks(src_fd, st.st_size,
+                                         self.block_size, self.jobs)
+            dest_fd = os.open(self.dest, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                dest_digests = self._dest_digests(dest_fd)
+                os.ftruncate(dest_fd, st.st_size)
+                self._write_changed(src_fd, dest_fd, st.st_size,
+                                    source_digests, dest_digests)
+                os.fsync(dest_fd)
+            finally:
+                os.close(dest_fd)
+        finally:
+            os.close(src_fd)
+        os.chown(self.dest, st.st_uid, st.st_gid)
+        os.chmod(self.dest, st.st_mode & 0o7777)
+        os.utime(self.dest, ns=(st.st_atime_ns, st.st_mtime_ns))
+        BlockIndex(st.st_size, st.st_mtime_ns, self.block_size,
+                   source_digests).save(self.index_file)
+        return self.bytes_written
+
+    def _dest_digests(self, dest_fd):
+        st = os.fstat(dest_fd)
+        index = BlockIndex.load(self.index_file)
+        if index and index.matches(st, self.block_size):
+            return index.digests
+        # The index is missing or stale, so rebuild it from the target copy
+        return hash_blocks(dest_fd, st.st_size, self.block_size, self.jobs)
+
+    def _write_changed(self, src_fd, dest_fd, size, source_digests,
+                       dest_digests):
+        for block, digest in enumerate(source_digests):
+            if block < len(dest_digests) and dest_digests[block] == digest:
+                continue
+            offset = block * self.block_size
+            length = min(self.block_size, size - offset)
+            if digest == HOLE_DIGEST:
+                if block < len(dest_digests):
+                    punch_hole(dest_fd, offset, length)
+                continue
+            data = os.pread(src_fd, length, offset)
+            os.pwrite(dest_fd, data, offset)
+            self.bytes_written += length
@@ -0,0 +1,194 @@
+import abc
+import glob
+import os
+import pathlib
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+
+from . import mysql
+from .chunkstore import RECIPE_SUFFIX
+from .chunkstore import ChunkStore
+
+POSTGRESQL_DIR = 'postgresql'
+POSTGRESQL_GLOBALS_FILE = 'globals.sql'
+SQLITE_DIR = 'sqlite'
+
+
+class DumpProvider(abc.ABC):
+    # Creates an application-consistent dump inside a versioned snapshot
+    name = None
+
+    def __init__(self, target, snapshot, runcmd, config=None, store=None):
+        self.target = target
+        self.snapshot = snapshot
+        self.runcmd = runcmd
+        self.config = config or {}
+        self.store = store
+
+    @classmethod
+    def enabled(cls, config):
+        return cls.name in config
+
+    def available(self):
+        return True
+
+    @abc.abstractmethod
+    def dump(self):
+        pass
+
+    def _output_dir(self, name):
+        output_dir = os.path.join(self.snapshot, name)
+        if not os.path.isdir(output_dir):
+            os.mkdir(output_dir, 0o0700)
+        return output_dir
+
+    def _store_tree(self, source_dir, output_dir):
+        for root, _, files in os.walk(source_dir):
+            for file_name in sorted(files):
+                source = os.path.join(root, file_name)
+                dest = os.path.join(output_dir,
+                                    os.path.relpath(source, source_dir))
+                os.makedirs(os.path.dirname(dest), 0o0700, exist_ok=True)
+                self.store.add_file(source, dest + RECIPE_SUFFIX)
+
+
+class MysqlProvider(DumpProvider):
+    name = 'mysql'
+
+    @classmethod
+    def enabled(cls, config):
+        # MySQL is backed up whenever it is installed, as before providers
+        return True
+
+    def available(self):
+        return mysql.MysqlBackup.available()
+
+    def dump(self):
+        mysql.MysqlBackup(self.target, self.snapshot, self.runcmd,
+                          config=self.config, store=self.store).backup()
+
+
+class PostgresqlProvider(DumpProvider):
+    name = 'postgresql'
+
+    def available(self):
+        return shutil.which('pg_dump') is not None
+
+    def _connect_args(self):
+        args = []
+        if self.config.get('host'):
+            args += ['-h', str(self.config['host'])]
+        if self.config.get('user'):
+            args += ['-U', str(self.config['user'])]
+        return args
+
+    def databases(self):
+        if self.config.get('databases'):
+            return self.config['databases']
+        output = subprocess.check_output(
+            ['psql', '-At'] + self._connect_args() +
+            ['-d', 'postgres', '-c',
+             'SELECT datname FROM pg_database '
+             'WHERE datallowconn AND NOT datistemplate ORDER BY datname'],
+            universal_newlines=True)
+        return [line for line in output.splitlines() if line]
+
+    def dump(self):
+        output_dir = self._output_dir(POSTGRESQL_DIR)
+        if not self.store:
+            self._dump(output_dir)
+            return
+        # Uncompressed dumps let unchanged table data share chunks
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self._dump(temp_dir, args=['-Z', '0'])
+            self._store_tree(temp_dir, output_dir)
+
+    def _dump(self, output_dir, args=None):
+        self.runcmd(['pg_dumpall', '--globals-only'] + self._connect_args() +
+                    ['-f', os.path.join(output_dir,
+                                        POSTGRESQL_GLOBALS_FILE)])
+        # The directory format dumps tables in parallel from one snapshot
+        jobs = str(self.config.get('jobs', 4))
+        for database in self.databases():
+            self.runcmd(['pg_dump', '-Fd', '-j', jobs] + (args or []) +
+                        self._connect_args() +
+                        ['-f', os.path.join(output_dir, database),
+                         database])
+
+
+class SqliteProvider(DumpProvider):
+    name = 'sqlite'
+    PAGES_PER_STEP = 1024
+    STEP_SLEEP = 0.01
+
+    def databases(self):
+        files = []
+        for pattern in self.config.get('databases') or []:
+            files += sorted(glob.glob(pattern))
+        return files
+
+    def dump(self):
+        output_dir = self._output_dir(SQLITE_DIR)
+        for database in self.databases():
+            dest = os.path.join(output_dir, database.lstrip(os.sep))
+            os.makedirs(os.path.dirname(dest), 0o0700, exist_ok=True)
+            print('Copying SQLite database {}'.format(database))
+            if not self.store:
+                self.copy(database, dest)
+                continue
+            with tempfile.TemporaryDirectory() as temp_dir:
+                temp_file = os.path.join(temp_dir, os.path.basename(dest))
+                self.copy(database, temp_file)
+                self.store.add_file(temp_file, dest + RECIPE_SUFFIX)
+
+    def copy(self, source, dest):
+        # The online backup API copies a consistent snapshot, releasing the
+        # read lock between steps so writers are not blocked, and restarting
+        # if the source changes during the copy
+        if os.path.exists(dest):
+            os.unlink(dest)
+        src = sqlite3.connect(
+            pathlib.Path(os.path.abspath(source)).as_uri() + '?mode=ro',
+            uri=True)
+        try:
+            dst = sqlite3.connect(dest)
+            try:
+                src.backup(dst, pages=self.PAGES_PER_STEP,
+                           sleep=self.STEP_SLEEP)
+            finally:
+                dst.close()
+        finally:
+            src.close()
+
+
+PROVIDERS = [MysqlProvider, PostgresqlProvider, SqliteProvider]
+DUMP_DIRS = [mysql.MYSQL_DIR, POSTGRESQL_DIR, SQLITE_DIR]
+
+
+def recipe_files(target, snapshots):
+    # Chunk recipes written by the dumps of the given snapshots
+    for snapshot in snapshots:
+        for name in DUMP_DIRS:
+            for root, _, files in os.walk(os.path.join(target, snapshot,
+                                                       name)):
+                for file_name in sorted(files):
+                    if file_name.endswith(RECIPE_SUFFIX):
+                        yield os.path.join(root, file_name)
+
+
+def dump_providers(config, target, snapshot, runcmd):
+    store = ChunkStore.from_config(target, config.get('chunk-store'))
+    providers = []
+    for cls in PROVIDERS:
+        if not cls.enabled(config):
+            continue
+        provider = cls(target, snapshot, runcmd, config=config.get(cls.name),
+                       store=store)
+        if not provider.available():
+            print('Client tools not found, skipping {} dump'.format(
+                cls.name))
+            continue
+        providers.append(provider)
+    return providers
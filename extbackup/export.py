@@ -0,0 +1,155 @@
+import os
+import shutil
+import subprocess
+import tarfile
+
+from .inodes import find_duplicates
+
+COMPRESSORS = [
+    ['zstd', '-T0', '-q', '-c'],
+    ['pigz', '-c'],
+    ['gzip', '-c'],
+]
+
+
+def find_compressor():
+    for cmd in COMPRESSORS:
+        if shutil.which(cmd[0]):
+            return cmd
+    raise Exception('No compressor found')
+
+
+def _inode_sorted(path):
+    with os.scandir(path) as it:
+        return sorted(it, key=lambda e: e.inode())
+
+
+def walk_inode_order(top):
+    # Depth-first walk visiting each directory's entries in inode order,
+    # which approximates on-disk order, holding one listing per level
+    stack = [iter(_inode_sorted(top))]
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+            continue
+        yield entry
+        if entry.is_dir(follow_symlinks=False):
+            stack.append(iter(_inode_sorted(entry.path)))
+
+
+class _LinkTargets(dict):
+    # tarfile records every regular file for hard link detection; only keep
+    # the inodes known to have several links within the snapshot
+    def __init__(self, wanted):
+        super(_LinkTargets, self).__init__()
+        self.wanted = wanted
+
+    def __setitem__(self, key, value):
+        if key[0] in self.wanted:
+            super(_LinkTargets, self).__setitem__(key, value)
+
+
+class _ChunkedOutput(object):
+    def __init__(self, outfile, compressor, chunk_size=None):
+        self.outfile = outfile
+        self.compressor = compressor
+        self.chunk_size = chunk_size
+        self.chunk = -1
+        self.chunk_offset = 0
+        self.offset = 0
+        self.proc = None
+        self.files = []
+        self._open()
+
+    def tell(self):
+        return self.offset
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+        self.chunk_offset += len(data)
+        self.offset += len(data)
+
+    def maybe_rotate(self):
+        if self.chunk_size and self.chunk_offset >= self.chunk_size:
+            self._close()
+            self._open()
+
+    def close(self):
+        self._close()
+
+    def _chunk_file(self):
+        if not self.chunk_size:
+            return self.outfile
+        return '{}.{:03d}'.format(self.outfile, self.chunk)
+
+    def _open(self):
+        self.chunk += 1
+        self.chunk_offset = 0
+        file_name = self._chunk_file()
+        self.files.append(file_name)
+        with open(file_name, 'wb') as f:
+            self.proc = subprocess.Popen(self.compressor,
+                                         stdin=subprocess.PIPE, stdout=f)
+
+    def _close(self):
+        self.proc.stdin.close()
+        if self.proc.wait():
+            raise subprocess.CalledProcessError(self.proc.returncode,
+                                                self.compressor)
+
+
+class SnapshotExporter(object):
+    def __init__(self, snapshot_dir, outfile, compressor=None,
+                 chunk_size=None, index=False):
+        self.snapshot_dir = snapshot_dir
+        self.outfile = outfile
+        self.compressor = compressor or find_compressor()
+        self.chunk_size = chunk_size
+        self.index = index
+
+    def export(self):
+        print('Finding hard links in {}'.format(self.snapshot_dir))
+        links = find_duplicates(
+            entry.inode() for entry in walk_inode_order(self.snapshot_dir)
+            if not entry.is_dir(follow_symlinks=False)
+            and entry.stat(follow_symlinks=False).st_nlink > 1)
+        print('Exporting {} to {}'.format(self.snapshot_dir, self.outfile))
+        output = _ChunkedOutput(self.outfile, self.compressor,
+                                self.chunk_size)
+        index = open('{}.index'.format(self.outfile), 'w') \
+            if self.index else None
+        try:
+            tar = tarfile.TarFile(fileobj=output, mode='w',
+                                  format=tarfile.PAX_FORMAT)
+            tar.inodes = _LinkTargets(links)
+            base = os.path.basename(os.path.normpath(self.snapshot_dir))
+            tar.add(self.snapshot_dir, arcname=base, recursive=False)
+            for entry in walk_inode_order(self.snapshot_dir):
+                arcname = os.path.join(
+                    base, os.path.relpath(entry.path, self.snapshot_dir))
+                self._add(tar, output, index, entry, arcname)
+            tar.close()
+        finally:
+            output.close()
+            if index:
+                index.close()
+        return output.files
+
+    def _add(self, tar, output, index, entry, arcname):
+        tarinfo = tar.gettarinfo(entry.path, arcname)
+        if index:
+            print('{}\t{}\t{}\t{}'.format(
+                output.chunk, output.chunk_offset,
+                tarinfo.size if tarinfo.isreg() else 0, arcname), file=index)
+        if tarinfo.isreg():
+            with open(entry.path, 'rb') as f:
+                tar.addfile(tarinfo, f)
+        else:
+            tar.addfile(tarinfo)
+        # tarfile keeps every member written, which is only needed to read
+        # the archive back
+        tar.members.clear()
+        # Only rotate between members so each chunk can be decompressed and
+        # read on its own
+        output.maybe_rotate()
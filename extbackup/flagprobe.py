@@ -0,0 +1,190 @@
+import collections
+import datetime
+import os
+import re
+
+import yaml
+
+from .localcopy import ACL_XATTR_PREFIX
+
+FLAG_PROBE_FILE = '.flag-probe.yaml'
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+MOUNTINFO_FILE = '/proc/self/mountinfo'
+
+# rsync options dropped when a mount does not need them
+FLAGS = collections.OrderedDict([
+    ('hard_links', '--no-hard-links'),
+    ('acls', '--no-acls'),
+    ('xattrs', '--no-xattrs'),
+])
+# Filesystems that cannot store hard links, ACLs or extended attributes
+UNSUPPORTED = {
+    'hard_links': {'exfat', 'msdos', 'vfat'},
+    'acls': {'exfat', 'iso9660', 'msdos', 'udf', 'vfat'},
+    'xattrs': {'exfat', 'iso9660', 'msdos', 'udf', 'vfat'},
+}
+
+# Options only kept from a cached scan when the mount cannot need them, as
+# ACLs and attributes added since then would otherwise be lost
+RESCANNED = ['acls', 'xattrs']
+
+MountFlags = collections.namedtuple('MountFlags', ['needed', 'reasons'])
+
+
+def _unescape(field):
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+
+def mount_info(path, mountinfo_file=MOUNTINFO_FILE):
+    # Filesystem type and mount options of the mount containing path
+    path = os.path.realpath(path)
+    found = None
+    with open(mountinfo_file, 'r') as f:
+        for line in f:
+            fields, _, fs_fields = line.rstrip('\n').partition(' - ')
+            fields = fields.split(' ')
+            fs_fields = fs_fields.split(' ')
+            mount_point = _unescape(fields[4])
+            if path != mount_point and not path.startswith(
+                    os.path.join(mount_point, '')):
+                continue
+            if found is None or len(mount_point) >= len(found[0]):
+                options = set(fields[5].split(','))
+                if len(fs_fields) > 2:
+                    options.update(fs_fields[2].split(','))
+                found = (mount_point, fs_fields[0], sorted(options))
+    if found is None:
+        return None, []
+    return found[1], found[2]
+
+
+def _check_xattrs(path, found):
+    try:
+        names = os.listxattr(path, follow_symlinks=False)
+    except OSError:
+        return
+    for name in names:
+        found.setdefault(
+            'acls' if name.startswith(ACL_XATTR_PREFIX) else 'xattrs', path)
+
+
+def scan(path, max_files):
+    # Look for hard links, ACLs and extended attributes, stopping once all
+    # are found. Returns the first path with each, whether every file on
+    # the mount was checked and the number of files checked
+    found = {}
+    files = 0
+    root_dev = os.lstat(path).st_dev
+    stack = [path]
+    while stack and len(found) < len(FLAGS):
+        directory = stack.pop()
+        _check_xattrs(directory, found)
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            if files >= max_files:
+                return found, False, files
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if st.st_dev == root_dev:
+                    stack.append(entry.path)
+                continue
+            files += 1
+            if st.st_nlink > 1:
+                found.setdefault('hard_links', entry.path)
+            _check_xattrs(entry.path, found)
+    return found, True, files
+
+
+def _unsupported(flag, fs_type, options):
+    # Why the mount itself cannot store what flag preserves, if it cannot
+    if fs_type in UNSUPPORTED[flag]:
+        return 'not supported by {}'.format(fs_type)
+    if flag == 'acls' and 'noacl' in options:
+        return 'mounted with noacl'
+    return None
+
+
+def choose_flags(fs_type, options, found, complete, files):
+    # Keep each option unless the mount cannot need it
+    needed = {}
+    reasons = {}
+    for flag in FLAGS:
+        unsupported = _unsupported(flag, fs_type, options)
+        if unsupported:
+            needed[flag] = False
+            reasons[flag] = unsupported
+        elif flag in found:
+            needed[flag] = True
+            reasons[flag] = 'found at {}'.format(found[flag])
+        elif complete:
+            needed[flag] = False
+            reasons[flag] = 'none in {} files'.format(files)
+        else:
+            needed[flag] = True
+            reasons[flag] = 'scan stopped after {} files'.format(files)
+    return MountFlags(needed, reasons)
+
+
+def flag_args(flags):
+    return [arg for flag, arg in FLAGS.items() if not flags.needed[flag]]
+
+
+class FlagProbe(object):
+    # Chooses the rsync metadata options each mount needs, cached between
+    # runs. A mount is probed again when its type or options change
+    def __init__(self, target, max_files=100000, rescan_days=7,
+                 mountinfo_file=MOUNTINFO_FILE):
+        self.probe_file = os.path.join(target, FLAG_PROBE_FILE)
+        self.max_files = max_files
+        self.rescan = datetime.timedelta(days=rescan_days)
+        self.mountinfo_file = mountinfo_file
+        self.cache = {}
+
+    @classmethod
+    def from_config(cls, config, target):
+        if not config:
+            return None
+        config = config if isinstance(config, dict) else {}
+        return cls(target, max_files=config.get('max-files', 100000),
+                   rescan_days=config.get('rescan-days', 7))
+
+    def load(self):
+        if os.path.isfile(self.probe_file):
+            with open(self.probe_file, 'r') as f:
+                self.cache = yaml.safe_load(f) or {}
+
+    def save(self):
+        with open(self.probe_file, 'w') as f:
+            yaml.safe_dump(self.cache, f, default_flow_style=False)
+
+    def probe(self, name, path):
+        fs_type, options = mount_info(path, self.mountinfo_file)
+        cached = self.cache.get(name)
+        if cached and cached['fs-type'] == fs_type and \
+                cached['options'] == options and \
+                datetime.datetime.now() - datetime.datetime.strptime(
+                    cached['probed'], TIME_FORMAT) < self.rescan:
+            return self._cached_flags(cached, fs_type, options)
+        print('Probing {} ({})'.format(name, fs_type))
+        found, complete, files = scan(path, self.max_files)
+        flags = choose_flags(fs_type, options, found, complete, files)
+        self.cache[name] = {
+            'probed': datetime.datetime.now().strftime(TIME_FORMAT),
+            'fs-type': fs_type, 'options': options,
+            'needed': flags.needed, 'reasons': flags.reasons}
+        return flags
+
+    def _cached_flags(self, cached, fs_type, options):
+        needed = dict(cached['needed'])
+        reasons = dict(cached['reasons'])
+        for flag in RESCANNED:
+            if not needed[flag] and not _unsupported(flag, fs_type, options):
+                needed[flag] = True
+                reasons[flag] = 'kept until the next scan'
+        return MountFlags(needed, reasons)
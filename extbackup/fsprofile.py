@@ -0,0 +1,111 @@
+import collections
+import os
+import subprocess
+import tempfile
+import time
+
+from .mount import mount
+from .mount import unmount
+
+FsProfile = collections.namedtuple('FsProfile',
+                                   ['mkfs_args', 'mount_opts', 'inode_ratio'])
+
+# Snapshot farms created with --link-dest duplicate the whole directory tree
+# for every snapshot, so inode count, directory indexing and journal size
+# matter more than data layout
+PROFILES = collections.OrderedDict([
+    ('many-small-files', FsProfile(
+        mkfs_args=['-i', '8192', '-I', '256',
+                   '-O', 'dir_index,large_dir',
+                   '-J', 'size=1024',
+                   '-E', 'lazy_itable_init=0,lazy_journal_init=0'],
+        mount_opts='commit=60,data=ordered',
+        inode_ratio=8192)),
+    ('mixed', FsProfile(
+        mkfs_args=['-i', '16384',
+                   '-O', 'dir_index,large_dir',
+                   '-J', 'size=512',
+                   '-E', 'lazy_itable_init=0,lazy_journal_init=0'],
+        mount_opts='commit=30,data=ordered',
+        inode_ratio=16384)),
+    ('large-media', FsProfile(
+        mkfs_args=['-T', 'largefile',
+                   '-O', 'dir_index',
+                   '-J', 'size=256',
+                   '-E', 'lazy_itable_init=1'],
+        mount_opts='commit=60,data=ordered',
+        # Bytes per inode set by the largefile usage type
+        inode_ratio=1048576)),
+])
+DEFAULT_PROFILE = 'mixed'
+
+# Options passed on every mount; ext4 options that depend on the profile are
+# stored in the superblock by tune2fs
+MOUNT_OPTIONS = 'noatime'
+
+
+def mkfs_cmds(device, profile_name, force=False):
+    profile = PROFILES[profile_name]
+    return [
+        ['mkfs.ext4'] + (['-F', '-q'] if force else []) +
+        profile.mkfs_args + [device],
+        ['tune2fs', '-m', '0',
+         '-E', 'mount_opts={}'.format(profile.mount_opts), device],
+    ]
+
+
+def _metadata_workload(root, files, files_per_dir=100):
+    ops = 0
+    source = os.path.join(root, 'source')
+    snapshot = os.path.join(root, 'snapshot')
+    os.mkdir(source)
+    os.mkdir(snapshot)
+    for i in range(0, files, files_per_dir):
+        dir_name = 'd{:06d}'.format(i // files_per_dir)
+        os.mkdir(os.path.join(source, dir_name))
+        os.mkdir(os.path.join(snapshot, dir_name))
+        ops += 2
+        for j in range(i, min(i + files_per_dir, files)):
+            file_name = os.path.join(dir_name, 'f{:08d}'.format(j))
+            with open(os.path.join(source, file_name), 'wb') as f:
+                f.write(b'x' * 64)
+            # Hard-link each file as a --link-dest snapshot would
+            os.link(os.path.join(source, file_name),
+                    os.path.join(snapshot, file_name))
+            os.lstat(os.path.join(snapshot, file_name))
+            ops += 3
+    os.sync()
+    return ops
+
+
+def _max_files(size_mb, files_per_dir=100):
+    # Every profile runs the same workload, so it must fit in the profile
+    # with the fewest inodes. Each directory of files needs two directory
+    # inodes, and ext4 reserves the first inodes of the filesystem
+    inodes = size_mb * 1024 * 1024 // max(
+        profile.inode_ratio for profile in PROFILES.values())
+    return max(0, (inodes - 16) * files_per_dir // (files_per_dir + 2))
+
+
+def benchmark(work_dir=None, size_mb=2048, files=50000):
+    results = collections.OrderedDict()
+    files = min(files, _max_files(size_mb))
+    with tempfile.TemporaryDirectory(dir=work_dir) as temp_dir:
+        image = os.path.join(temp_dir, 'fs.img')
+        mount_point = os.path.join(temp_dir, 'mnt')
+        os.mkdir(mount_point)
+        for name in PROFILES:
+            with open(image, 'wb') as f:
+                f.truncate(size_mb * 1024 * 1024)
+            for cmd in mkfs_cmds(image, name, force=True):
+                subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
+            mount(mount_point, source=image,
+                  options='loop,{}'.format(MOUNT_OPTIONS))
+            try:
+                start = time.monotonic()
+                ops = _metadata_workload(mount_point, files)
+                results[name] = ops / (time.monotonic() - start)
+            finally:
+                unmount(mount_point)
+            os.unlink(image)
+    return results
@@ -0,0 +1,152 @@
+import array
+import heapq
+import os
+import stat
+import struct
+
+HEADER = struct.Struct('<QQ')
+
+
+def scan_inodes(top):
+    # Yield (inode, allocated bytes) for every non-directory entry, and
+    # (None, allocated bytes) for directories, which are never hard-linked
+    pending = [top]
+    while pending:
+        dir_name = pending.pop()
+        try:
+            entries = list(os.scandir(dir_name))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                pending.append(entry.path)
+                yield None, st.st_blocks * 512
+            else:
+                yield st.st_ino, st.st_blocks * 512
+
+
+def find_duplicates(inodes, chunk_size=1000000):
+    # Return the set of inodes occurring more than once, sorting fixed-size
+    # chunks and merging them rather than holding a set of every inode
+    chunks = []
+    chunk = array.array('Q')
+    for inode in inodes:
+        chunk.append(inode)
+        if len(chunk) >= chunk_size:
+            chunks.append(array.array('Q', sorted(chunk)))
+            chunk = array.array('Q')
+    chunks.append(array.array('Q', sorted(chunk)))
+    duplicates = set()
+    last = None
+    for inode in heapq.merge(*chunks):
+        if inode == last:
+            duplicates.add(inode)
+        last = inode
+    return duplicates
+
+
+class InodeTable(object):
+    CHUNK_SIZE = 1000000
+
+    def __init__(self, inodes=None, sizes=None, dir_bytes=0):
+        self.inodes = inodes if inodes is not None else array.array('Q')
+        self.sizes = sizes if sizes is not None else array.array('Q')
+        self.dir_bytes = dir_bytes
+
+    def __len__(self):
+        return len(self.inodes)
+
+    @property
+    def total_bytes(self):
+        return sum(self.sizes) + self.dir_bytes
+
+    @classmethod
+    def from_entries(cls, entries):
+        # Sort fixed-size chunks and merge them so only one chunk of Python
+        # objects is alive at once; the result is a pair of compact arrays
+        chunks = []
+        chunk = []
+        dir_bytes = 0
+        for inode, size in entries:
+            if inode is None:
+                dir_bytes += size
+                continue
+            chunk.append((inode, size))
+            if len(chunk) >= cls.CHUNK_SIZE:
+                chunks.append(cls._sorted_chunk(chunk))
+                chunk = []
+        chunks.append(cls._sorted_chunk(chunk))
+        table = cls(dir_bytes=dir_bytes)
+        last = None
+        for inode, size in heapq.merge(*[zip(*chunk) for chunk in chunks]):
+            if inode == last:
+                continue
+            table.inodes.append(inode)
+            table.sizes.append(size)
+            last = inode
+        return table
+
+    @classmethod
+    def from_directory(cls, top):
+        return cls.from_entries(scan_inodes(top))
+
+    @classmethod
+    def load(cls, file_name):
+        with open(file_name, 'rb') as f:
+            count, dir_bytes = HEADER.unpack(f.read(HEADER.size))
+            table = cls(dir_bytes=dir_bytes)
+            table.inodes.fromfile(f, count)
+            table.sizes.fromfile(f, count)
+        return table
+
+    @classmethod
+    def read_entries(cls, file_name):
+        # Yield (inode, size) from a saved table in inode order, reading a
+        # chunk at a time instead of loading the whole table
+        with open(file_name, 'rb') as f:
+            count, _ = HEADER.unpack(f.read(HEADER.size))
+            item_size = array.array('Q').itemsize
+            sizes_offset = HEADER.size + count * item_size
+            for start in range(0, count, cls.CHUNK_SIZE):
+                length = min(cls.CHUNK_SIZE, count - start)
+                inodes = array.array('Q')
+                sizes = array.array('Q')
+                f.seek(HEADER.size + start * item_size)
+                inodes.fromfile(f, length)
+                f.seek(sizes_offset + start * item_size)
+                sizes.fromfile(f, length)
+                yield from zip(inodes, sizes)
+
+    def save(self, file_name):
+        temp_file = '{}.tmp'.format(file_name)
+        with open(temp_file, 'wb') as f:
+            f.write(HEADER.pack(len(self.inodes), self.dir_bytes))
+            self.inodes.tofile(f)
+            self.sizes.tofile(f)
+        os.rename(temp_file, file_name)
+
+    def shared_bytes(self, other):
+        # Sorted merge of two tables, returning the bytes of common inodes
+        shared = 0
+        i = j = 0
+        while i < len(self.inodes) and j < len(other.inodes):
+            if self.inodes[i] < other.inodes[j]:
+                i += 1
+            elif self.inodes[i] > other.inodes[j]:
+                j += 1
+            else:
+                shared += self.sizes[i]
+                i += 1
+                j += 1
+        return shared
+
+    @staticmethod
+    def _sorted_chunk(chunk):
+        chunk.sort()
+        inodes = array.array('Q', (inode for inode, _ in chunk))
+        sizes = array.array('Q', (size for _, size in chunk))
+        return inodes, sizes
@@ -0,0 +1,587 @@
+import collections
+import concurrent.futures
+import datetime
+import errno
+import os
+import re
+import shutil
+import stat
+import threading
+
+from .sizes import format_size
+from .sizes import parse_size
+
+RULE_KINDS = {
+    '+': '+', '-': '-', 'H': 'H', 'S': 'S', 'P': 'P', 'R': 'R',
+    'include': '+', 'exclude': '-', 'hide': 'H', 'show': 'S',
+    'protect': 'P', 'risk': 'R',
+}
+# With --delete-excluded, include and exclude rules only apply to the
+# sending side and the receiving side only sees protect and risk rules
+SENDER_KINDS = '+-HS'
+RECEIVER_KINDS = 'PR'
+# Rules reading more rules from a file, and clearing the rules so far
+MERGE_RULES = {'.', ':', 'merge', 'dir-merge'}
+CLEAR_RULES = {'!', 'clear'}
+# Single-letter rule names may be followed directly by their modifiers
+RULE_MODIFIERS = '/!Csrpx0enw+-'
+# Directories scanned, and then copied, together
+SCAN_BATCH = 256
+STOP_AT_FORMAT = '%Y-%m-%dT%H:%M'
+ACL_XATTR_PREFIX = 'system.posix_acl_'
+# Options turning off parts of -aHSAX, as chosen by the flag probe
+NO_OPTIONS = {
+    '--no-hard-links': 'hard_links', '--no-H': 'hard_links',
+    '--no-acls': 'acls', '--no-A': 'acls',
+    '--no-xattrs': 'xattrs', '--no-X': 'xattrs',
+}
+
+FilterRule = collections.namedtuple('FilterRule',
+                                    ['kind', 'regex', 'dir_only'])
+
+_copy_file_range = getattr(os, 'copy_file_range', None)
+
+
+def _wildcard_regex(pattern):
+    parts = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\' and i + 1 < len(pattern):
+            parts.append(re.escape(pattern[i + 1]))
+            i += 2
+            continue
+        if pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+            continue
+        if c == '*':
+            parts.append('[^/]*')
+        elif c == '?':
+            parts.append('[^/]')
+        elif c == '[':
+            end = pattern.find(']', i + 2)
+            if end < 0:
+                parts.append(re.escape(c))
+            else:
+                parts.append('[{}]'.format(
+                    pattern[i + 1:end].replace('!', '^', 1)
+                    if pattern[i + 1] == '!' else pattern[i + 1:end]))
+                i = end
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return ''.join(parts)
+
+
+def _rule_name(word):
+    # Split "exclude,s" or "-s" into the rule name and its modifiers
+    name, comma, modifiers = word.partition(',')
+    if not comma and len(name) > 1 and name[0] in RULE_KINDS and \
+            all(c in RULE_MODIFIERS for c in name[1:]):
+        name, modifiers = name[0], name[1:]
+    return name, modifiers
+
+
+def parse_rule(line, default_kind):
+    # A subset of rsync's FILTER RULES: include, exclude, hide, show, protect
+    # and risk rules with wildcards, anchoring and directory-only patterns
+    kind = default_kind
+    fields = line.split(' ', 1)
+    name, modifiers = _rule_name(fields[0])
+    if (len(fields) == 2 and name in MERGE_RULES) or \
+            (len(fields) == 1 and name in CLEAR_RULES):
+        raise Exception('Filter rule {} is not supported by the native copy '
+                        'engine'.format(line))
+    if len(fields) == 2 and name in RULE_KINDS:
+        if modifiers:
+            raise Exception('Filter rule modifiers in {} are not supported '
+                            'by the native copy engine'.format(line))
+        kind = RULE_KINDS[name]
+        line = fields[1]
+    dir_only = line.endswith('/')
+    pattern = line.rstrip('/') if line != '/' else line
+    # "dir/***" matches the directory itself and everything in it
+    contents = pattern.endswith('/***')
+    if contents:
+        pattern = pattern[:-len('/***')]
+    anchored = pattern.startswith('/')
+    pattern = pattern.lstrip('/')
+    regex = _wildcard_regex(pattern)
+    if contents:
+        regex += '(/.*)?'
+    # Unanchored patterns match the end of the path at a name boundary
+    regex = ('^{}$' if anchored else '(^|.*/){}$').format(regex)
+    return FilterRule(kind, re.compile(regex), dir_only and not contents)
+
+
+class RsyncFilter(object):
+    def __init__(self):
+        self.rules = []
+
+    def add(self, line, default_kind='-'):
+        line = line.strip()
+        if not line or line.startswith(('#', ';')):
+            return
+        self.rules.append(parse_rule(line, default_kind))
+
+    def add_file(self, file_name, default_kind):
+        with open(file_name, 'r') as f:
+            for line in f:
+                self.add(line, default_kind)
+
+    def included(self, path, is_dir):
+        kind = self._match(path, is_dir, SENDER_KINDS)
+        return kind is None or kind in '+S'
+
+    def protected(self, path, is_dir):
+        return self._match(path, is_dir, RECEIVER_KINDS) == 'P'
+
+    def _match(self, path, is_dir, kinds):
+        for rule in self.rules:
+            if rule.kind not in kinds or (rule.dir_only and not is_dir):
+                continue
+            if rule.regex.match(path):
+                return rule.kind
+        return None
+
+
+def parse_rsync_args(args):
+    # Options the native engine accepts, in rsync's own syntax so the same
+    # arguments can be used by either engine
+    options = {'filter': RsyncFilter(), 'max_size': None,
+               'one_file_system': False, 'hard_links': True, 'acls': True,
+               'xattrs': True}
+    for arg in args:
+        name, _, value = arg.partition('=')
+        if name == '--filter':
+            options['filter'].add(value)
+        elif name == '--exclude-from':
+            options['filter'].add_file(value, '-')
+        elif name == '--include-from':
+            options['filter'].add_file(value, '+')
+        elif name == '--max-size':
+            options['max_size'] = parse_size(value)
+        elif name == '--one-file-system':
+            options['one_file_system'] = True
+        elif name in NO_OPTIONS:
+            options[NO_OPTIONS[name]] = False
+        else:
+            raise Exception('Option {} is not supported by the native copy '
+                            'engine'.format(arg))
+    return options
+
+
+def _copy_range(src_fd, dst_fd, offset, count):
+    global _copy_file_range
+    while count > 0:
+        copied = None
+        if _copy_file_range:
+            try:
+                copied = _copy_file_range(src_fd, dst_fd, count, offset,
+                                          offset)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                   errno.EOPNOTSUPP):
+                    raise
+                _copy_file_range = None
+        if copied is None:
+            os.lseek(dst_fd, offset, os.SEEK_SET)
+            copied = os.sendfile(dst_fd, src_fd, offset, count)
+        if not copied:
+            return
+        offset += copied
+        count -= copied
+
+
+def copy_data(src_fd, dst_fd, size):
+    # Copy only the data regions of the source, leaving holes unallocated
+    offset = 0
+    while offset < size:
+        try:
+            data = os.lseek(src_fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                break
+            if e.errno != errno.EINVAL:
+                raise
+            _copy_range(src_fd, dst_fd, offset, size - offset)
+            break
+        hole = min(os.lseek(src_fd, data, os.SEEK_HOLE), size)
+        _copy_range(src_fd, dst_fd, data, hole - data)
+        offset = hole
+    os.ftruncate(dst_fd, size)
+
+
+def _xattrs(path, acls=True, xattrs=True):
+    if not acls and not xattrs:
+        return {}
+    try:
+        return {name: os.getxattr(path, name, follow_symlinks=False)
+                for name in os.listxattr(path, follow_symlinks=False)
+                if (acls if name.startswith(ACL_XATTR_PREFIX) else xattrs)}
+    except OSError as e:
+        if e.errno == errno.EOPNOTSUPP:
+            return {}
+        raise
+
+
+def copy_attributes(src, dst, st, acls=True, xattrs=True):
+    # ACLs are stored in system.posix_acl_* extended attributes
+    is_link = stat.S_ISLNK(st.st_mode)
+    try:
+        os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+    except PermissionError:
+        if os.geteuid() == 0:
+            raise
+    if not is_link:
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+    src_xattrs = _xattrs(src, acls, xattrs)
+    dst_xattrs = _xattrs(dst, acls, xattrs)
+    for name in set(dst_xattrs) - set(src_xattrs):
+        os.removexattr(dst, name, follow_symlinks=False)
+    for name, value in src_xattrs.items():
+        if dst_xattrs.get(name) != value:
+            os.setxattr(dst, name, value, follow_symlinks=False)
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns),
+             follow_symlinks=False)
+
+
+class LocalCopy(object):
+    # Copies source into dest like rsync -aHSAX --numeric-ids --delete
+    # --delete-excluded, with unchanged files hard-linked from link_dests
+    def __init__(self, source, dest, args=None, link_dests=None, jobs=8,
+                 stop_at=None, pretend=False):
+        options = parse_rsync_args(args or [])
+        self.filter = options['filter']
+        self.max_size = options['max_size']
+        self.one_file_system = options['one_file_system']
+        self.hard_links = options['hard_links']
+        self.acls = options['acls']
+        self.xattrs = options['xattrs']
+        self.source = source
+        self.dest = dest
+        self.link_dests = link_dests or []
+        self.jobs = jobs
+        self.stop_at = datetime.datetime.strptime(stop_at, STOP_AT_FORMAT) \
+            if stop_at else None
+        self.pretend = pretend
+        self.failed = {}
+        self.stopped = False
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+        self.root_dev = None
+        self.first_links = {}
+
+    def run(self, files=None):
+        # With files, only those paths are copied and nothing is deleted
+        self.root_dev = os.lstat(self.source).st_dev
+        self.first_links = {}
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+            if files is None:
+                dirs = self._copy_tree(executor)
+            else:
+                dirs = self._copy_listed(files, executor)
+        # Children were found after their parents, so they are finished first
+        for rel, st in reversed(dirs):
+            self._finish_dir(rel, st)
+        print('Copied {} files ({}), linked {}, unchanged {}, deleted {}'
+              .format(self.stats['copied'], format_size(self.stats['bytes']),
+                      self.stats['linked'], self.stats['unchanged'],
+                      self.stats['deleted']))
+        return self.failed
+
+    def _count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def _fail(self, rel, error):
+        print('Unable to copy {}: {}'.format(rel, error))
+        self.failed[rel] = error.strerror if isinstance(error, OSError) and \
+            error.strerror else str(error)
+
+    def _copy_tree(self, executor):
+        # Directories are read in parallel a batch at a time, depth first,
+        # and each batch is copied before the next is read, so only the
+        # files of one batch are held in memory
+        self._make_dir('')
+        return [('', os.lstat(self.source))] + self._copy_subtrees(
+            [''], executor, delete=True)
+
+    def _copy_subtrees(self, pending, executor, delete=False):
+        dirs = []
+        while pending and not self.stopped:
+            batch = pending[-SCAN_BATCH:]
+            del pending[-SCAN_BATCH:]
+            files = []
+            listings = []
+            for rel, children in zip(batch,
+                                     executor.map(self._scan_dir, batch)):
+                if children is None:
+                    continue
+                listings.append((rel, {os.path.basename(child)
+                                       for child, _, _ in children}))
+                for child, st, descend in children:
+                    if stat.S_ISDIR(st.st_mode):
+                        self._make_dir(child)
+                        dirs.append((child, st))
+                        if descend:
+                            pending.append(child)
+                    # Larger files are skipped but kept in the listing, so
+                    # their earlier copies are not deleted
+                    elif self.max_size is None or \
+                            st.st_size <= self.max_size:
+                        files.append((child, st))
+            self._copy_files(files, executor)
+            if self.stopped or not delete:
+                continue
+            for rel, names in listings:
+                self._delete(rel, names)
+        return dirs
+
+    def _copy_listed(self, files, executor):
+        entries = self._listed(files)
+        dirs = sorted((rel, st) for rel, st in entries.items()
+                      if stat.S_ISDIR(st.st_mode))
+        for rel, _ in dirs:
+            self._make_dir(rel)
+        self._copy_files([(rel, st) for rel, st in entries.items()
+                          if not stat.S_ISDIR(st.st_mode)], executor)
+        # Listed directories are copied with their contents, as with rsync -r;
+        # those inside another listed directory are copied with it
+        listed = {path.strip('/') for path in files}
+        roots = [rel for rel, st in dirs if rel in listed and
+                 not self._listed_parent(rel, listed) and
+                 not (self.one_file_system and st.st_dev != self.root_dev)]
+        return dirs + self._copy_subtrees(roots, executor)
+
+    @staticmethod
+    def _listed_parent(rel, listed):
+        while rel:
+            rel = os.path.dirname(rel)
+            if rel in listed:
+                return True
+        return False
+
+    def _copy_files(self, files, executor):
+        transfers = []
+        links = []
+        # Inode order approximates disk order on most filesystems
+        for rel, st in sorted(files, key=lambda item: (item[1].st_ino,
+                                                       item[0])):
+            if self.hard_links and st.st_nlink > 1:
+                key = (st.st_dev, st.st_ino)
+                first = self.first_links.get(key)
+                if first:
+                    links.append((rel, first[0]))
+                    # Forget the inode once all of its links were seen
+                    first[1] -= 1
+                    if not first[1]:
+                        del self.first_links[key]
+                    continue
+                self.first_links[key] = [rel, st.st_nlink - 1]
+            transfers.append((rel, st))
+        list(executor.map(lambda item: self._transfer(*item), transfers))
+        for rel, first in links:
+            self._link_within(rel, first)
+
+    def _scan_dir(self, rel):
+        # The included children of a directory, or None if it is unreadable
+        # so nothing is deleted from its copy
+        children = []
+        try:
+            it = os.scandir(os.path.join(self.source, rel))
+        except OSError as e:
+            self._fail(rel, e)
+            return None
+        with it:
+            for entry in it:
+                child = os.path.join(rel, entry.name) if rel else entry.name
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError as e:
+                    self._fail(child, e)
+                    continue
+                is_dir = stat.S_ISDIR(st.st_mode)
+                if not self.filter.included(child, is_dir):
+                    continue
+                # Mount points are copied but not descended into with
+                # --one-file-system
+                descend = is_dir and not (self.one_file_system and
+                                          st.st_dev != self.root_dev)
+                children.append((child, st, descend))
+        return children
+
+    def _listed(self, files):
+        entries = {'': os.lstat(self.source)}
+        for path in files:
+            rel = path.strip('/')
+            parent = os.path.dirname(rel)
+            try:
+                while parent and parent not in entries:
+                    entries[parent] = os.lstat(
+                        os.path.join(self.source, parent))
+                    parent = os.path.dirname(parent)
+                st = os.lstat(os.path.join(self.source, rel))
+            except OSError as e:
+                self._fail(rel, e)
+                continue
+            if self.filter.included(rel, stat.S_ISDIR(st.st_mode)):
+                entries[rel] = st
+        return entries
+
+    def _make_dir(self, rel):
+        dst = os.path.join(self.dest, rel)
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            return
+        if self.pretend:
+            return
+        try:
+            self._remove(dst)
+            os.mkdir(dst, 0o700)
+        except OSError as e:
+            self._fail(rel, e)
+
+    def _finish_dir(self, rel, st):
+        dst = os.path.join(self.dest, rel)
+        if self.pretend or not os.path.isdir(dst):
+            return
+        try:
+            copy_attributes(os.path.join(self.source, rel), dst, st,
+                            self.acls, self.xattrs)
+        except OSError as e:
+            self._fail(rel, e)
+
+    def _unchanged(self, path, st, src):
+        try:
+            other = os.lstat(path)
+        except OSError:
+            return False
+        if stat.S_IFMT(other.st_mode) != stat.S_IFMT(st.st_mode) or \
+                stat.S_IMODE(other.st_mode) != stat.S_IMODE(st.st_mode) or \
+                other.st_size != st.st_size or \
+                other.st_mtime_ns != st.st_mtime_ns or \
+                other.st_uid != st.st_uid or other.st_gid != st.st_gid:
+            return False
+        if stat.S_ISLNK(st.st_mode):
+            return os.readlink(path) == os.readlink(src)
+        if stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+            return other.st_rdev == st.st_rdev
+        return _xattrs(path, self.acls, self.xattrs) == \
+            _xattrs(src, self.acls, self.xattrs)
+
+    def _transfer(self, rel, st):
+        if self.stop_at and datetime.datetime.now() >= self.stop_at:
+            self.stopped = True
+            return
+        src = os.path.join(self.source, rel)
+        dst = os.path.join(self.dest, rel)
+        try:
+            if self._unchanged(dst, st, src):
+                self._count('unchanged')
+                return
+            for link_dest in self.link_dests:
+                linked = os.path.join(link_dest, rel)
+                if self._unchanged(linked, st, src):
+                    if not self.pretend:
+                        self._remove(dst)
+                        os.link(linked, dst)
+                    self._count('linked')
+                    return
+            print(rel)
+            if not self.pretend:
+                self._copy(src, dst, st)
+            self._count('copied')
+            if stat.S_ISREG(st.st_mode):
+                self._count('bytes', st.st_size)
+        except OSError as e:
+            self._fail(rel, e)
+
+    def _copy(self, src, dst, st):
+        if stat.S_ISREG(st.st_mode):
+            # Write to a temporary file so an interrupted copy never leaves
+            # a partial file under the final name
+            temp = os.path.join(os.path.dirname(dst),
+                                '.{}.extbackup'.format(os.path.basename(dst)))
+            with open(src, 'rb') as fsrc:
+                fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                             0o600)
+                try:
+                    copy_data(fsrc.fileno(), fd, st.st_size)
+                finally:
+                    os.close(fd)
+            try:
+                copy_attributes(src, temp, st, self.acls, self.xattrs)
+                if os.path.isdir(dst) and not os.path.islink(dst):
+                    shutil.rmtree(dst)
+                os.replace(temp, dst)
+            except BaseException:
+                os.unlink(temp)
+                raise
+            return
+        self._remove(dst)
+        if stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(src), dst)
+        else:
+            os.mknod(dst, st.st_mode, st.st_rdev)
+        copy_attributes(src, dst, st, self.acls, self.xattrs)
+
+    def _link_within(self, rel, first):
+        # Hard links inside the source are recreated in the copy
+        if first in self.failed or self.pretend or self.stopped:
+            return
+        dst = os.path.join(self.dest, rel)
+        target = os.path.join(self.dest, first)
+        try:
+            if os.path.lexists(dst) and os.path.samefile(dst, target):
+                return
+            self._remove(dst)
+            os.link(target, dst)
+        except OSError as e:
+            self._fail(rel, e)
+
+    def _delete(self, rel, names):
+        # Delete what is no longer in the source from one directory's copy
+        dst = os.path.join(self.dest, rel)
+        if not os.path.isdir(dst) or os.path.islink(dst):
+            return
+        for entry in list(os.scandir(dst)):
+            if entry.name not in names:
+                self._delete_entry(
+                    os.path.join(rel, entry.name) if rel else entry.name,
+                    entry.path, entry.is_dir(follow_symlinks=False))
+
+    def _delete_entry(self, rel, path, is_dir):
+        # Returns whether rel was deleted. Protected entries below a deleted
+        # directory are kept, along with the directories holding them
+        if self.filter.protected(rel, is_dir):
+            return False
+        if is_dir:
+            try:
+                entries = list(os.scandir(path))
+            except OSError as e:
+                self._fail(rel, e)
+                return False
+            kept = [entry for entry in entries if not self._delete_entry(
+                os.path.join(rel, entry.name), entry.path,
+                entry.is_dir(follow_symlinks=False))]
+            if kept:
+                return False
+        print('deleting {}'.format(rel))
+        self._count('deleted')
+        if not self.pretend:
+            try:
+                if is_dir:
+                    os.rmdir(path)
+                else:
+                    os.unlink(path)
+            except OSError as e:
+                self._fail(rel, e)
+                return False
+        return True
+
+    def _remove(self, path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.unlink(path)
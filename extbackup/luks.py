@@ -0,0 +1,112 @@
+import collections
+import os
+import re
+import subprocess
+
+SECTOR_SIZE = 4096
+
+# Ciphers acceptable for the backup partition, mapped from their cryptsetup
+# benchmark names to their --cipher specifications
+SAFE_CIPHERS = collections.OrderedDict([
+    ('aes-xts', 'aes-xts-plain64'),
+    ('serpent-xts', 'serpent-xts-plain64'),
+    ('twofish-xts', 'twofish-xts-plain64'),
+    ('xchacha20,aes-adiantum', 'xchacha20,aes-adiantum-plain64'),
+])
+MIN_KEY_SIZE = 256
+# The dm-crypt workqueue flags need Linux 5.9 and cryptsetup 2.3.4
+MIN_WORKQUEUE_KERNEL = (5, 9)
+# cryptsetup's exit code for invalid or unsupported options
+WRONG_PARAMETERS = 1
+
+BENCHMARK_RE = re.compile(r'^\s*(?P<cipher>\S+)\s+(?P<key_size>\d+)b\s+'
+                          r'(?P<encrypt>[\d.]+)\s+MiB/s\s+'
+                          r'(?P<decrypt>[\d.]+)\s+MiB/s\s*$')
+
+BenchmarkResult = collections.namedtuple(
+    'BenchmarkResult', ['cipher', 'key_size', 'encrypt', 'decrypt'])
+
+
+def parse_benchmark(output):
+    results = []
+    for line in output.splitlines():
+        match = BENCHMARK_RE.match(line)
+        if not match:
+            continue
+        results.append(BenchmarkResult(
+            cipher=match.group('cipher'),
+            key_size=int(match.group('key_size')),
+            encrypt=float(match.group('encrypt')),
+            decrypt=float(match.group('decrypt'))))
+    return results
+
+
+def benchmark():
+    print('Running cryptsetup benchmark')
+    output = subprocess.check_output(['cryptsetup', 'benchmark'],
+                                     universal_newlines=True)
+    return parse_benchmark(output)
+
+
+def select_cipher(results):
+    candidates = [r for r in results
+                  if r.cipher in SAFE_CIPHERS and r.key_size >= MIN_KEY_SIZE]
+    if not candidates:
+        raise Exception('No supported cipher found in benchmark results')
+    # Prefer the best worst-case throughput, then the larger key
+    return max(candidates,
+               key=lambda r: (min(r.encrypt, r.decrypt), r.key_size))
+
+
+def _read_queue_attribute(device, attribute):
+    name = os.path.basename(os.path.realpath(device))
+    # Partitions use their parent device's queue
+    for queue_dir in [os.path.join('/sys/class/block', name, 'queue'),
+                      os.path.join('/sys/class/block', name, '..', 'queue')]:
+        try:
+            with open(os.path.join(queue_dir, attribute), 'r') as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+
+
+def is_rotational(device):
+    rotational = _read_queue_attribute(device, 'rotational')
+    return rotational is None or bool(rotational)
+
+
+def supports_sector_size(device, sector_size=SECTOR_SIZE):
+    logical_block_size = _read_queue_attribute(device, 'logical_block_size')
+    if logical_block_size and logical_block_size > sector_size:
+        return False
+    try:
+        fd = os.open(device, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        return os.lseek(fd, 0, os.SEEK_END) % sector_size == 0
+    finally:
+        os.close(fd)
+
+
+def format_args(device, result):
+    args = ['--type', 'luks2',
+            '--cipher', SAFE_CIPHERS[result.cipher],
+            '--hash', 'sha512',
+            '--key-size', str(result.key_size)]
+    if supports_sector_size(device):
+        args += ['--sector-size', str(SECTOR_SIZE)]
+    return args
+
+
+def kernel_version():
+    match = re.match(r'(\d+)\.(\d+)', os.uname().release)
+    return (int(match.group(1)), int(match.group(2))) if match else (0, 0)
+
+
+def open_args(device):
+    # dm-crypt's read and write workqueues only add latency on fast,
+    # non-rotational devices
+    if is_rotational(device) or kernel_version() < MIN_WORKQUEUE_KERNEL:
+        return []
+    return ['--perf-no_read_workqueue', '--perf-no_write_workqueue']
@@ -1,22 +1,38 @@
 import argparse
+import datetime
 import enum
 import os
 import subprocess
 import sys
 
+from . import fsprofile
+from . import luks
+from . import physorder
 from .backup import MOUNT_DIR
 from .backup import ExternalBackup
+from .daemon import BackupDaemon
 from .mount import mount
 from .mount import unmount
+from .schedule import parse_deadline
+from .sizes import format_size
+from .sizes import parse_size
 
 MAPPER_NAME = 'backup-external'
 
 
 class Action(enum.Enum):
     BACKUP = 'backup'
+    BENCHMARK = 'benchmark'
+    CAT = 'cat'
     CREATE = 'create'
+    DAEMON = 'daemon'
+    EXPORT = 'export'
+    EXTRACT = 'extract'
     MOUNT = 'mount'
+    MYSQL_REPLAY = 'mysql-replay'
     UNMOUNT = 'unmount'
+    USAGE = 'usage'
+    VERSIONS = 'versions'
 
 
 class App(object):
@@ -26,18 +42,134 @@ class App(object):
     def run(self):
         if self.args.action == Action.BACKUP:
             eb = ExternalBackup(pretend=self.args.pretend,
-                                config_file=self.args.config_file)
+                                config_file=self.args.config_file,
+                                deadline=self._deadline())
             eb.backup()
+        if self.args.action == Action.BENCHMARK:
+            self._benchmark()
+        if self.args.action == Action.CAT:
+            self._cat()
         if self.args.action == Action.CREATE:
             self._check_device()
             self._create()
+        if self.args.action == Action.DAEMON:
+            BackupDaemon(self, self.args.config_file).run()
+        if self.args.action == Action.EXPORT:
+            self._export()
+        if self.args.action == Action.EXTRACT:
+            self._extract()
         if self.args.action == Action.MOUNT:
             self._check_device()
             self._unlock()
             self._mount()
+        if self.args.action == Action.MYSQL_REPLAY:
+            self._mysql_replay()
         if self.args.action == Action.UNMOUNT:
             self._unmount()
             self._lock()
+        if self.args.action == Action.USAGE:
+            self._usage()
+        if self.args.action == Action.VERSIONS:
+            self._versions()
+
+    def backup_device(self, device, config=None, mounts=None,
+                      key_file=None):
+        self.args.device = device
+        self._check_device()
+        self._unlock(key_file=key_file)
+        try:
+            self._mount()
+            try:
+                eb = ExternalBackup(pretend=self.args.pretend,
+                                    config_file=self.args.config_file,
+                                    config=config, mounts=mounts,
+                                    deadline=self._deadline())
+                eb.backup()
+            finally:
+                self._unmount()
+        finally:
+            self._lock()
+
+    def _deadline(self):
+        if self.args.deadline:
+            return parse_deadline(self.args.deadline)
+
+    def _benchmark(self):
+        benchmarks = {'fs': self._benchmark_fs,
+                      'physical-order': self._benchmark_physical_order}
+        if len(self.args.arguments) != 1 or \
+                self.args.arguments[0] not in benchmarks:
+            raise Exception('Usage: benchmark {{{}}}'.format(
+                ','.join(sorted(benchmarks))))
+        benchmarks[self.args.arguments[0]]()
+
+    def _benchmark_fs(self):
+        for name, ops in fsprofile.benchmark().items():
+            print('{:<20}{:>12.0f} metadata ops/s'.format(name, ops))
+
+    def _benchmark_physical_order(self):
+        for name, rate in physorder.benchmark().items():
+            print('{:<20}{:>12}/s'.format(name, format_size(rate)))
+
+    def _cat(self):
+        if len(self.args.arguments) != 1:
+            raise Exception('Usage: cat RECIPE')
+        eb = ExternalBackup(config_file=self.args.config_file)
+        with eb.open_target(Action.CAT.value):
+            eb.cat(self.args.arguments[0])
+
+    def _export(self):
+        if len(self.args.arguments) != 2:
+            raise Exception('Usage: export SNAPSHOT OUTFILE')
+        eb = ExternalBackup(config_file=self.args.config_file)
+        chunk_size = (parse_size(self.args.chunk_size)
+                      if self.args.chunk_size else None)
+        with eb.open_target(Action.EXPORT.value):
+            for file_name in eb.export(*self.args.arguments,
+                                       chunk_size=chunk_size,
+                                       index=self.args.index):
+                print('Wrote {}'.format(file_name))
+
+    def _extract(self):
+        if len(self.args.arguments) not in [2, 3]:
+            raise Exception('Usage: extract SNAPSHOT PATH [DEST]')
+        eb = ExternalBackup(config_file=self.args.config_file)
+        with eb.open_target(Action.EXTRACT.value):
+            snapshot, path = self.args.arguments[:2]
+            dest = self.args.arguments[2] if len(self.args.arguments) == 3 \
+                else os.getcwd()
+            for name in eb.extract(snapshot, path, dest):
+                print('Extracted {}'.format(os.path.join(dest, name)))
+
+    def _mysql_replay(self):
+        if len(self.args.arguments) not in [1, 2]:
+            raise Exception('Usage: mysql-replay SNAPSHOT [STOP_DATETIME]')
+        eb = ExternalBackup(config_file=self.args.config_file)
+        with eb.open_target(Action.MYSQL_REPLAY.value):
+            eb.mysql_replay(*self.args.arguments)
+
+    def _usage(self):
+        eb = ExternalBackup(config_file=self.args.config_file)
+        with eb.open_target(Action.USAGE.value):
+            print('{:<16}{:>12}{:>12}{:>14}{:>14}'.format(
+                'Snapshot', 'Total', 'Unique', 'Shared prev', 'Shared next'))
+            for usage in eb.usage():
+                print('{:<16}{:>12}{:>12}{:>14}{:>14}'.format(
+                    usage.name, format_size(usage.total),
+                    format_size(usage.unique), format_size(usage.shared_prev),
+                    format_size(usage.shared_next)))
+
+    def _versions(self):
+        if len(self.args.arguments) != 1:
+            raise Exception('Usage: versions PATTERN')
+        eb = ExternalBackup(config_file=self.args.config_file)
+        with eb.open_target(Action.VERSIONS.value, remote=True):
+            for path, inode, size, mtime, first, last in \
+                    eb.find_versions(self.args.arguments[0]):
+                print('{}\t{}\t{}\t{}\t{}..{}'.format(
+                    path, inode, size,
+                    datetime.datetime.fromtimestamp(mtime / 1e9).isoformat(),
+                    first, last))
 
     def _mapper_path(self):
         return os.path.join('/dev', 'mapper', MAPPER_NAME)
@@ -53,22 +185,49 @@ class App(object):
             raise Exception('{} is already mounted'.format(MOUNT_DIR))
         if os.path.exists(self._mapper_path()):
             raise Exception('{} is already in use'.format(self._mapper_path()))
-        subprocess.check_call(['cryptsetup', '-y',
-                               '--cipher', 'aes-xts-plain64:sha512',
-                               '--hash', 'sha512',
-                               '--key-size', '512',
-                               'luksFormat', self.args.device])
+        results = luks.benchmark()
+        cipher = luks.select_cipher(results)
+        for result in results:
+            print('{} {:<24} {:>5}b {:>10.1f} MiB/s {:>10.1f} MiB/s'.format(
+                '*' if result == cipher else ' ', result.cipher,
+                result.key_size, result.encrypt, result.decrypt))
+        print('Using {} with a {}-bit key'.format(cipher.cipher,
+                                                  cipher.key_size))
+        subprocess.check_call(['cryptsetup', '-y'] +
+                              luks.format_args(self.args.device, cipher) +
+                              ['luksFormat', self.args.device])
         self._unlock()
-        subprocess.check_call(['mkfs.ext4', self._mapper_path()])
-        subprocess.check_call(['tune2fs', '-m', '0', self._mapper_path()])
+        print('Creating filesystem with {} profile'
+              .format(self.args.fs_profile))
+        for cmd in fsprofile.mkfs_cmds(self._mapper_path(),
+                                       self.args.fs_profile):
+            subprocess.check_call(cmd)
         self._lock()
 
-    def _unlock(self):
+    def _unlock(self, key_file=None):
         if not os.path.exists(self._mapper_path()):
-            subprocess.check_call(['cryptsetup', 'luksOpen',
-                                   self.args.device, MAPPER_NAME])
+            key_args = ['--key-file', key_file] if key_file else []
+            open_args = luks.open_args(self.args.device)
+            if open_args:
+                print('Disabling dm-crypt workqueues for non-rotational {}'
+                      .format(self.args.device))
+                try:
+                    self._luks_open(open_args + key_args)
+                except subprocess.CalledProcessError as e:
+                    # Older cryptsetup versions reject the workqueue options
+                    if e.returncode != luks.WRONG_PARAMETERS:
+                        raise
+                    print('Opening {} with dm-crypt workqueues'
+                          .format(self.args.device))
+                    self._luks_open(key_args)
+            else:
+                self._luks_open(key_args)
             print('Started {}'.format(self._mapper_path()))
 
+    def _luks_open(self, args):
+        subprocess.check_call(['cryptsetup', 'luksOpen'] + args +
+                              [self.args.device, MAPPER_NAME])
+
     def _lock(self):
         if os.path.exists(self._mapper_path()):
             print('Closing {}'.format(self._mapper_path()))
@@ -85,7 +244,8 @@ class App(object):
             print('Creating {}'.format(MOUNT_DIR))
             os.mkdir(MOUNT_DIR)
         if not os.path.ismount(MOUNT_DIR):
-            mount(MOUNT_DIR, source=self._mapper_path())
+            mount(MOUNT_DIR, source=self._mapper_path(),
+                  options=fsprofile.MOUNT_OPTIONS)
 
 
 def _require_root():
@@ -101,13 +261,27 @@ def main():
                         os.path.expanduser('~'), '.extbackup'),
                     help=('rsync include/exclude paths config file '
                           '(default: %(default)s)'))
+    ap.add_argument('--chunk-size', dest='chunk_size', metavar='size',
+                    help='Split exported archives into chunks of this size')
+    ap.add_argument('--deadline', dest='deadline', metavar='time',
+                    help=('Finish the backup by this time (HH:MM or '
+                          'YYYY-mm-ddTHH:MM), skipping lower priority work'))
     ap.add_argument('-d', '--device', dest='device', metavar='dev',
                     help='Device to mount')
+    ap.add_argument('-f', '--fs-profile', dest='fs_profile',
+                    choices=list(fsprofile.PROFILES),
+                    default=fsprofile.DEFAULT_PROFILE,
+                    help=('Filesystem workload profile for create '
+                          '(default: %(default)s)'))
+    ap.add_argument('-i', '--index', dest='index', action='store_true',
+                    help='Write an index of exported archive members')
     ap.add_argument('-p', '--pretend', dest='pretend', action='store_true',
                     help='Perform a backup dry run')
     ap.add_argument('action',  type=Action,
                     help=('Action to perform (choices: {})'
                           .format(' '.join([a.value for a in Action]))))
+    ap.add_argument('arguments', nargs='*', metavar='arg',
+                    help='Action arguments')
     args = ap.parse_args()
 
     _require_root()
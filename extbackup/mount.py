@@ -1,13 +1,14 @@
 import os
 import subprocess
 import tempfile
+import time
 
 
 def _list_dir(dir_name):
     return [fn for fn in os.listdir(dir_name) if fn not in ['.keep']]
 
 
-def mount(target, source=None, bind=False):
+def mount(target, source=None, bind=False, options=None):
     if bind and not source:
         raise Exception('source is required with bind')
     if not os.path.isdir(target):
@@ -19,6 +20,8 @@ def mount(target, source=None, bind=False):
     cmd = ['mount']
     if bind:
         cmd += ['--bind']
+    if options:
+        cmd += ['-o', options]
     if source:
         cmd += [source]
     cmd += [target]
@@ -37,7 +40,9 @@ def unmount(target):
     if not os.path.isdir(target):
         raise Exception('{} does not exist'.format(target))
     print('Unmounting {}'.format(target))
+    start = time.monotonic()
     subprocess.check_call(['umount', target])
+    print('Unmounted {} in {:.1f}s'.format(target, time.monotonic() - start))
     if len(_list_dir(target)) > 0:
         raise Exception('{} is not empty'.format(target))
     if os.path.ismount(target):
@@ -0,0 +1,191 @@
+import datetime
+import gzip
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import yaml
+
+from .chunkstore import CHUNK_STORE_DIR
+from .chunkstore import RECIPE_SUFFIX
+from .chunkstore import ChunkStore
+
+MYSQL_DIR = 'mysql'
+DUMP_FILE = 'mysqldump.sql'
+MANIFEST_FILE = 'manifest.yaml'
+STATE_FILE = '.mysql-state.yaml'
+BINLOG_START = 4
+
+BINLOG_POSITION_RE = re.compile(
+    r"(?:MASTER|SOURCE)_LOG_FILE='(?P<file>[^']+)',\s*"
+    r"(?:MASTER|SOURCE)_LOG_POS=(?P<pos>\d+)")
+
+
+def _which(program):
+    return shutil.which(program) is not None
+
+
+def _load_yaml(file_name):
+    if not os.path.isfile(file_name):
+        return None
+    with open(file_name, 'r') as f:
+        return yaml.safe_load(f)
+
+
+def _save_yaml(data, file_name):
+    with open(file_name, 'w') as f:
+        yaml.safe_dump(data, f, default_flow_style=False)
+
+
+def _read_file(target, mysql_dir, name, output):
+    recipe_file = os.path.join(mysql_dir, name + RECIPE_SUFFIX)
+    if os.path.isfile(recipe_file):
+        store = ChunkStore(os.path.join(target, CHUNK_STORE_DIR))
+        store.cat(recipe_file, output)
+        return
+    with gzip.open(os.path.join(mysql_dir, '{}.gz'.format(name)), 'rb') as f:
+        shutil.copyfileobj(f, output)
+
+
+def parse_dump_position(dump_file, max_lines=100):
+    with open(dump_file, 'r', errors='replace') as f:
+        for _ in range(max_lines):
+            line = f.readline()
+            if not line:
+                break
+            match = BINLOG_POSITION_RE.search(line)
+            if match:
+                return {'file': match.group('file'),
+                        'pos': int(match.group('pos'))}
+    return None
+
+
+class MysqlBackup(object):
+    def __init__(self, target, snapshot, runcmd, config=None, store=None):
+        config = config or {}
+        self.target = target
+        self.snapshot = snapshot
+        self.runcmd = runcmd
+        self.store = store
+        self.full_interval = datetime.timedelta(
+            days=config.get('full-interval', 7))
+        self.state_file = os.path.join(target, STATE_FILE)
+        self.output_dir = os.path.join(snapshot, MYSQL_DIR)
+
+    @staticmethod
+    def available():
+        return _which('mysqldump')
+
+    def backup(self):
+        state = _load_yaml(self.state_file)
+        binlogs = self._binary_logs() if _which('mysqlbinlog') else None
+        if not os.path.isdir(self.output_dir):
+            os.mkdir(self.output_dir)
+        if self._full_due(state, binlogs):
+            state = self._full(binlogs is not None)
+        else:
+            state = self._incremental(state, binlogs)
+        _save_yaml(state, self.state_file)
+
+    def _full_due(self, state, binlogs):
+        if not state or not binlogs or not state.get('position'):
+            return True
+        if state['position']['file'] not in binlogs:
+            print('Binary log {} is no longer available'.format(
+                state['position']['file']))
+            return True
+        last_full = datetime.datetime.strptime(state['last_full'],
+                                               '%Y-%m-%dT%H:%M:%S')
+        return datetime.datetime.now() - last_full >= self.full_interval
+
+    def _binary_logs(self):
+        try:
+            output = subprocess.check_output(
+                ['mysql', '-N', '-B', '-e', 'SHOW BINARY LOGS'],
+                universal_newlines=True, stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            return None
+        return [line.split('\t')[0] for line in output.splitlines() if line]
+
+    def _flush_binary_logs(self):
+        subprocess.check_call(['mysql', '-e', 'FLUSH BINARY LOGS'])
+        return self._binary_logs()
+
+    def _full(self, binlog_enabled):
+        print('Creating full MySQL dump')
+        name = os.path.basename(self.snapshot)
+        cmd = ['mysqldump', '--all-databases', '--single-transaction']
+        if binlog_enabled:
+            cmd += ['--flush-logs', '--master-data=2']
+        with tempfile.TemporaryDirectory() as mysql_dir:
+            dump_file = os.path.join(mysql_dir, DUMP_FILE)
+            with open(dump_file, 'w') as f:
+                self.runcmd(cmd, stdout=f)
+            position = parse_dump_position(dump_file) \
+                if binlog_enabled else None
+            self._save(dump_file)
+        now = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        _save_yaml({'type': 'full', 'chain': [name], 'end': position},
+                   os.path.join(self.output_dir, MANIFEST_FILE))
+        return {'last_full': now, 'chain': [name], 'position': position}
+
+    def _incremental(self, state, binlogs):
+        start = state['position']
+        binlogs = self._flush_binary_logs()
+        # The log opened by the flush stays on the server for the next run
+        captured = binlogs[binlogs.index(start['file']):-1]
+        end = {'file': binlogs[-1], 'pos': BINLOG_START}
+        print('Capturing MySQL binary logs {}'.format(', '.join(captured)))
+        with tempfile.TemporaryDirectory() as mysql_dir:
+            self.runcmd(['mysqlbinlog', '--read-from-remote-server', '--raw',
+                         '--result-file={}'.format(
+                             os.path.join(mysql_dir, ''))] + captured)
+            for binlog in captured:
+                self._save(os.path.join(mysql_dir, binlog))
+        chain = state['chain'] + [os.path.basename(self.snapshot)]
+        _save_yaml({'type': 'incremental', 'chain': chain, 'start': start,
+                    'end': end, 'binlogs': captured},
+                   os.path.join(self.output_dir, MANIFEST_FILE))
+        return {'last_full': state['last_full'], 'chain': chain,
+                'position': end}
+
+    def _save(self, file_name):
+        name = os.path.basename(file_name)
+        if self.store:
+            self.store.add_file(file_name, os.path.join(
+                self.output_dir, name + RECIPE_SUFFIX))
+            return
+        self.runcmd(['gzip', file_name])
+        shutil.copy('{}.gz'.format(file_name), self.output_dir)
+
+
+def replay(target, snapshot, stop_datetime=None, output=None):
+    # Write SQL restoring the chain ending at snapshot to output
+    output = output or sys.stdout.buffer
+    manifest = _load_yaml(os.path.join(target, snapshot, MYSQL_DIR,
+                                       MANIFEST_FILE))
+    if not manifest:
+        raise Exception('No MySQL backup found in {}'.format(snapshot))
+    for name in manifest['chain']:
+        mysql_dir = os.path.join(target, name, MYSQL_DIR)
+        step = _load_yaml(os.path.join(mysql_dir, MANIFEST_FILE))
+        if not step:
+            raise Exception('MySQL backup chain is missing {}'.format(name))
+        if step['type'] == 'full':
+            _read_file(target, mysql_dir, DUMP_FILE, output)
+            continue
+        with tempfile.TemporaryDirectory() as temp_dir:
+            files = []
+            for binlog in step['binlogs']:
+                files.append(os.path.join(temp_dir, binlog))
+                with open(files[-1], 'wb') as f:
+                    _read_file(target, mysql_dir, binlog, f)
+            cmd = ['mysqlbinlog',
+                   '--start-position={}'.format(step['start']['pos'])]
+            if stop_datetime:
+                cmd.append('--stop-datetime={}'.format(stop_datetime))
+            output.flush()
+            subprocess.check_call(cmd + files, stdout=output)
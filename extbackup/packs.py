@@ -0,0 +1,137 @@
+import hashlib
+import os
+import tarfile
+
+PACK_DIR = 'packs'
+PACK_SUFFIX = '.tar'
+INDEX_SUFFIX = '.index'
+MANIFEST_PREFIX = '# manifest '
+
+
+class _NoLinks(dict):
+    # Store hard-linked files in full so any member can be extracted alone
+    def __setitem__(self, key, value):
+        pass
+
+
+def walk_sorted(top, included=None):
+    # Paths relative to top, parents before their contents. included(rel,
+    # is_dir) leaves out filtered entries, and the contents of directories
+    for dir_name, dirs, files in os.walk(top):
+        rel_dir = os.path.relpath(dir_name, top)
+        names = []
+        for name in sorted(dirs + files):
+            rel = os.path.normpath(os.path.join(rel_dir, name))
+            is_dir = name in dirs and \
+                not os.path.islink(os.path.join(dir_name, name))
+            if included is None or included(rel, is_dir):
+                names.append(name)
+                yield rel
+        dirs[:] = [name for name in sorted(dirs) if name in names]
+
+
+def manifest_digest(directory, included=None):
+    # Changes whenever any entry is added, removed or modified
+    digest = hashlib.sha256()
+    for rel in walk_sorted(directory, included):
+        path = os.path.join(directory, rel)
+        st = os.lstat(path)
+        link = os.readlink(path) if os.path.islink(path) else ''
+        digest.update('{}\0{}\0{}\0{}\0{}\0{}\0{}\n'.format(
+            rel, st.st_mode, st.st_uid, st.st_gid,
+            st.st_size, st.st_mtime_ns, link).encode(
+                errors='surrogateescape'))
+    return digest.hexdigest()
+
+
+class DirectoryPack(object):
+    # An uncompressed tar of a directory in a snapshot, with an index of the
+    # offset of each member so members can be read without a full scan
+    def __init__(self, snapshot, path):
+        base = os.path.join(snapshot, PACK_DIR, path.strip('/'))
+        self.path = path
+        self.tar_file = base + PACK_SUFFIX
+        self.index_file = base + INDEX_SUFFIX
+
+    @classmethod
+    def find(cls, snapshot, path):
+        # The pack holding path, which may be the packed directory itself
+        parent = path.rstrip('/')
+        while parent not in ('', '/'):
+            pack = cls(snapshot, parent)
+            if os.path.isfile(pack.index_file):
+                return pack
+            parent = os.path.dirname(parent)
+        return None
+
+    def exists(self):
+        return os.path.isfile(self.tar_file) and \
+            os.path.isfile(self.index_file)
+
+    def digest(self):
+        if not self.exists():
+            return None
+        with open(self.index_file, 'r') as f:
+            line = f.readline()
+        if line.startswith(MANIFEST_PREFIX):
+            return line[len(MANIFEST_PREFIX):].strip()
+        return None
+
+    def members(self):
+        with open(self.index_file, 'r', errors='surrogateescape') as f:
+            for line in f:
+                if line.startswith('#'):
+                    continue
+                offset, size, name = line.rstrip('\n').split('\t', 2)
+                yield int(offset), int(size), name
+
+    def build(self, directory, digest, included=None):
+        os.makedirs(os.path.dirname(self.tar_file), exist_ok=True)
+        temp_tar = '{}.tmp'.format(self.tar_file)
+        temp_index = '{}.tmp'.format(self.index_file)
+        with open(temp_tar, 'wb') as f, \
+                open(temp_index, 'w', errors='surrogateescape') as index:
+            print('{}{}'.format(MANIFEST_PREFIX, digest), file=index)
+            tar = tarfile.TarFile(fileobj=f, mode='w',
+                                  format=tarfile.PAX_FORMAT)
+            tar.inodes = _NoLinks()
+            for rel in walk_sorted(directory, included):
+                path = os.path.join(directory, rel)
+                tarinfo = tar.gettarinfo(path, rel)
+                print('{}\t{}\t{}'.format(
+                    tar.offset, tarinfo.size if tarinfo.isreg() else 0, rel),
+                    file=index)
+                if tarinfo.isreg():
+                    with open(path, 'rb') as member:
+                        tar.addfile(tarinfo, member)
+                else:
+                    tar.addfile(tarinfo)
+                # tarfile keeps every member written, which is only needed
+                # to read the archive back
+                tar.members.clear()
+            tar.close()
+        os.replace(temp_tar, self.tar_file)
+        os.replace(temp_index, self.index_file)
+
+    def link_from(self, prev):
+        os.makedirs(os.path.dirname(self.tar_file), exist_ok=True)
+        os.link(prev.tar_file, self.tar_file)
+        os.link(prev.index_file, self.index_file)
+
+    def extract(self, name, dest):
+        # Extract name, or everything below it, reading only those members
+        name = os.path.normpath(name).strip('/')
+        if name == '.':
+            name = ''
+        wanted = [(offset, member) for offset, _, member in self.members()
+                  if not name or member == name or
+                  member.startswith(name + '/')]
+        if not wanted:
+            raise Exception('{} not found in {}'.format(name, self.path))
+        with open(self.tar_file, 'rb') as f:
+            tar = tarfile.TarFile(fileobj=f, mode='r')
+            for offset, _ in wanted:
+                f.seek(offset)
+                tar.offset = offset
+                tar.extract(tarfile.TarInfo.fromtarfile(tar), dest)
+        return [member for _, member in wanted]
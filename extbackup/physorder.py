@@ -0,0 +1,116 @@
+import array
+import collections
+import fcntl
+import os
+import random
+import struct
+import subprocess
+import tempfile
+import time
+
+from .fsprofile import DEFAULT_PROFILE
+from .fsprofile import MOUNT_OPTIONS
+from .fsprofile import mkfs_cmds
+from .mount import mount
+from .mount import unmount
+
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct('=QQIIII')
+FIEMAP_EXTENT = struct.Struct('=QQQQQIIII')
+METHODS = ['fiemap', 'inode']
+
+
+def first_extent(path):
+    # Physical byte offset of the file's first extent, or None for files
+    # without extents such as empty or inline files. Data not yet written
+    # back has no physical location and reads as 0
+    buf = array.array('B', FIEMAP_HEADER.pack(0, 2 ** 64 - 1, 0, 0, 1, 0) +
+                      bytes(FIEMAP_EXTENT.size))
+    with open(path, 'rb') as f:
+        fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, buf)
+    mapped = FIEMAP_HEADER.unpack_from(buf)[3]
+    if not mapped:
+        return None
+    return FIEMAP_EXTENT.unpack_from(buf, FIEMAP_HEADER.size)[1]
+
+
+def physical_order(root, paths, method='fiemap'):
+    # Sort paths relative to root by disk location, falling back to the
+    # inode number for files FIEMAP cannot map
+    if method not in METHODS:
+        raise Exception('Unknown physical order method {}'.format(method))
+    keys = {}
+    for path in paths:
+        full_path = os.path.join(root, path)
+        try:
+            ino = os.lstat(full_path).st_ino
+        except OSError:
+            continue
+        extent = None
+        if method == 'fiemap' and os.path.isfile(full_path) and \
+                not os.path.islink(full_path):
+            try:
+                extent = first_extent(full_path)
+            except OSError:
+                pass
+        keys[path] = (extent or 0, ino)
+    return sorted(keys, key=lambda path: (keys[path], path))
+
+
+def batches(paths, batch_files):
+    for i in range(0, len(paths), batch_files):
+        yield paths[i:i + batch_files]
+
+
+def _write_files(root, files, files_per_dir=100, file_size=16384):
+    # Create files in shuffled directories so directory order differs from
+    # allocation order, as on a long-lived filesystem
+    names = ['d{:04d}/f{:06d}'.format(i % (files // files_per_dir or 1), i)
+             for i in range(files)]
+    random.Random(files).shuffle(names)
+    for name in names:
+        os.makedirs(os.path.join(root, os.path.dirname(name)), exist_ok=True)
+        with open(os.path.join(root, name), 'wb') as f:
+            f.write(os.urandom(file_size))
+    os.sync()
+    return sorted(names)
+
+
+def _drop_caches():
+    os.sync()
+    with open('/proc/sys/vm/drop_caches', 'w') as f:
+        f.write('3')
+
+
+def _read_throughput(root, paths):
+    _drop_caches()
+    start = time.monotonic()
+    total = 0
+    for path in paths:
+        with open(os.path.join(root, path), 'rb') as f:
+            total += len(f.read())
+    return total / (time.monotonic() - start)
+
+
+def benchmark(work_dir=None, size_mb=2048, files=50000):
+    # Read throughput in bytes per second for each read order
+    results = collections.OrderedDict()
+    with tempfile.TemporaryDirectory(dir=work_dir) as temp_dir:
+        image = os.path.join(temp_dir, 'fs.img')
+        mount_point = os.path.join(temp_dir, 'mnt')
+        os.mkdir(mount_point)
+        with open(image, 'wb') as f:
+            f.truncate(size_mb * 1024 * 1024)
+        for cmd in mkfs_cmds(image, DEFAULT_PROFILE, force=True):
+            subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
+        mount(mount_point, source=image,
+              options='loop,{}'.format(MOUNT_OPTIONS))
+        try:
+            paths = _write_files(mount_point, files)
+            results['directory'] = _read_throughput(mount_point, paths)
+            for method in METHODS:
+                results[method] = _read_throughput(
+                    mount_point, physical_order(mount_point, paths, method))
+        finally:
+            unmount(mount_point)
+    return results
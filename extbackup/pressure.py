@@ -0,0 +1,110 @@
+import os
+import signal
+import threading
+import time
+
+PRESSURE_DIR = '/proc/pressure'
+
+
+def read_pressure(resource, pressure_dir=PRESSURE_DIR):
+    with open(os.path.join(pressure_dir, resource), 'r') as f:
+        for line in f.readlines():
+            fields = line.split()
+            if fields and fields[0] == 'some':
+                values = dict(field.split('=', 1) for field in fields[1:])
+                return float(values['avg10'])
+    raise Exception('Unable to parse {} pressure'.format(resource))
+
+
+class PressureThrottle(object):
+    RESOURCES = ['io', 'cpu']
+
+    def __init__(self, io=None, cpu=None, interval=5, max_pause=300,
+                 resume_ratio=0.5, pressure_dir=PRESSURE_DIR):
+        self.targets = {resource: target for resource, target
+                        in [('io', io), ('cpu', cpu)] if target is not None}
+        self.interval = interval
+        self.max_pause = max_pause
+        self.resume_ratio = resume_ratio
+        self.pressure_dir = pressure_dir
+        # Pause start times by process group, as concurrent commands are
+        # watched separately
+        self.paused_at = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        if not config:
+            return None
+        throttle = cls(io=config.get('io'), cpu=config.get('cpu'),
+                       interval=config.get('interval', 5),
+                       max_pause=config.get('max-pause', 300))
+        if not throttle.available():
+            print('Pressure stall information not available, '
+                  'disabling throttling')
+            return None
+        return throttle
+
+    def available(self):
+        return bool(self.targets) and all(
+            os.path.exists(os.path.join(self.pressure_dir, resource))
+            for resource in self.targets)
+
+    def watch(self, proc):
+        return _ThrottleWatcher(self, proc)
+
+    def update(self, pgid):
+        readings = {resource: read_pressure(resource, self.pressure_dir)
+                    for resource in self.targets}
+        over = [resource for resource, reading in readings.items()
+                if reading > self.targets[resource]]
+        with self.lock:
+            paused_at = self.paused_at.get(pgid)
+            if paused_at is None:
+                if over:
+                    print('Pausing for {} pressure ({})'.format(
+                        ', '.join(sorted(over)), self._format(readings)))
+                    os.killpg(pgid, signal.SIGSTOP)
+                    self.paused_at[pgid] = time.monotonic()
+                return
+        calm = all(reading <= self.targets[resource] * self.resume_ratio
+                   for resource, reading in readings.items())
+        if calm or time.monotonic() - paused_at >= self.max_pause:
+            print('Resuming ({})'.format(self._format(readings)))
+            self.resume(pgid)
+
+    def resume(self, pgid):
+        with self.lock:
+            if self.paused_at.pop(pgid, None) is not None:
+                os.killpg(pgid, signal.SIGCONT)
+
+    def _format(self, readings):
+        return ', '.join('{} {:.1f}%'.format(resource, reading)
+                         for resource, reading in sorted(readings.items()))
+
+
+class _ThrottleWatcher(object):
+    def __init__(self, throttle, proc):
+        self.throttle = throttle
+        self.proc = proc
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        self.stop_event.set()
+        self.thread.join()
+        if self.proc.poll() is None:
+            self.throttle.resume(self.proc.pid)
+
+    def _run(self):
+        while not self.stop_event.wait(self.throttle.interval):
+            if self.proc.poll() is not None:
+                break
+            try:
+                self.throttle.update(self.proc.pid)
+            except ProcessLookupError:
+                break
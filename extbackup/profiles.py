@@ -0,0 +1,55 @@
+import collections
+import concurrent.futures
+import os
+
+SourceProfile = collections.namedtuple('SourceProfile',
+                                       ['name', 'root', 'target', 'config'])
+
+
+def _overlaps(target, other):
+    return (target == other or target.startswith(other + os.sep) or
+            other.startswith(target + os.sep))
+
+
+def load_profiles(config, host_target=None):
+    profiles = []
+    # Each target directory holds one source's snapshots and state files
+    targets = {host_target: 'the host'} if host_target else {}
+    for name, profile_config in sorted((config.get('profiles') or {})
+                                       .items()):
+        if not profile_config or 'root' not in profile_config:
+            raise Exception('Profile {} has no root'.format(name))
+        root = profile_config['root']
+        if not os.path.isdir(root):
+            raise Exception('Profile {} root {} does not exist'
+                            .format(name, root))
+        target = profile_config.get('target', name)
+        if os.path.isabs(target) or '..' in target.split(os.sep):
+            raise Exception('Profile {} target {} is not a relative path'
+                            .format(name, target))
+        target = os.path.normpath(target)
+        for other, owner in targets.items():
+            if _overlaps(target, other):
+                raise Exception('Profile {} target {} overlaps the target of '
+                                '{}'.format(name, target, owner))
+        targets[target] = 'profile {}'.format(name)
+        profiles.append(SourceProfile(name=name, root=root, target=target,
+                                      config=profile_config))
+    return profiles
+
+
+def run_concurrently(tasks, concurrency=1):
+    # Run (name, callable) tasks, letting each finish even if others fail
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        futures = collections.OrderedDict(
+            (executor.submit(task), name) for name, task in tasks)
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print('Backup of {} failed: {}'.format(futures[future], e))
+                failed.append(futures[future])
+    if failed:
+        raise Exception('Backup failed for {}'.format(', '.join(
+            sorted(failed))))
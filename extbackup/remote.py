@@ -0,0 +1,166 @@
+import os
+import posixpath
+import shlex
+import shutil
+import subprocess
+import tempfile
+import urllib.parse
+
+SCHEMES = ['ssh', 'rsync']
+STATE_DIR = '/var/lib/extbackup'
+# Top-level state files of the target, such as the catalog and schedule
+# state, but none of the snapshots
+STATE_FILTER_ARGS = ['--filter=- /*/', '--filter=+ /.*', '--filter=- *']
+
+
+def _mtime_ns(value):
+    # find prints seconds with a fractional part of up to ten digits
+    seconds, _, fraction = value.partition('.')
+    return int(seconds) * 10 ** 9 + int((fraction + '0' * 9)[:9])
+
+
+class RemoteTarget(object):
+    # A backup server reached over ssh, with one connection shared by every
+    # rsync run, or an rsync daemon
+    def __init__(self, url, state_dir=STATE_DIR, compress=None,
+                 control_persist='10m'):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in SCHEMES or not parts.hostname or \
+                not parts.path.strip('/'):
+            raise Exception('Unsupported remote target {}'.format(url))
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.host = parts.hostname
+        if parts.username:
+            self.host = '{}@{}'.format(parts.username, self.host)
+        self.port = parts.port
+        self.path = parts.path.rstrip('/')
+        self.state_dir = state_dir
+        self.compress = compress
+        self.control_persist = control_persist
+        self.control_dir = None
+
+    @classmethod
+    def from_config(cls, config):
+        if not config:
+            return None
+        config = config if isinstance(config, dict) else {'url': config}
+        return cls(config['url'], state_dir=config.get('state-dir', STATE_DIR),
+                   compress=config.get('compress'),
+                   control_persist=config.get('control-persist', '10m'))
+
+    @property
+    def ssh(self):
+        return self.scheme == 'ssh'
+
+    def __enter__(self):
+        if not self.ssh:
+            return self
+        self.control_dir = tempfile.mkdtemp(prefix='extbackup-ssh.')
+        print('Connecting to {}'.format(self.host))
+        try:
+            subprocess.check_call(self.ssh_cmd() + [
+                '-o', 'ControlMaster=yes',
+                '-o', 'ControlPersist={}'.format(self.control_persist),
+                '-fN', self.host])
+        except BaseException:
+            self._cleanup()
+            raise
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        if self.control_dir:
+            subprocess.call(self.ssh_cmd() + ['-O', 'exit', self.host],
+                            stderr=subprocess.DEVNULL)
+        self._cleanup()
+
+    def _cleanup(self):
+        if self.control_dir:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = None
+
+    def ssh_cmd(self):
+        cmd = ['ssh']
+        if self.control_dir:
+            cmd += ['-o', 'ControlPath={}'.format(
+                os.path.join(self.control_dir, 'master'))]
+        if self.port:
+            cmd += ['-p', str(self.port)]
+        return cmd
+
+    def rsync_args(self):
+        args = []
+        if self.ssh:
+            args += ['-e', ' '.join(shlex.quote(arg)
+                                    for arg in self.ssh_cmd())]
+        if self.compress:
+            args.append('--compress')
+            if self.compress is not True:
+                args.append('--compress-choice={}'.format(self.compress))
+        return args
+
+    def join(self, *paths):
+        return posixpath.join(self.path, *paths)
+
+    def url(self, path):
+        if self.ssh:
+            return '{}:{}'.format(self.host, path)
+        return 'rsync://{}{}'.format(self.netloc, path)
+
+    def _rsync(self, args, **kwargs):
+        cmd = ['rsync'] + self.rsync_args() + args
+        return subprocess.check_call(cmd, **kwargs)
+
+    def list_dirs(self, path):
+        output = subprocess.check_output(
+            ['rsync', '--list-only'] + self.rsync_args() +
+            [self.url(posixpath.join(path, ''))], universal_newlines=True)
+        names = []
+        for line in output.splitlines():
+            fields = line.split(None, 4)
+            if len(fields) == 5 and fields[0].startswith('d') and \
+                    fields[4] != '.':
+                names.append(fields[4])
+        return names
+
+    def makedirs(self, path):
+        with tempfile.TemporaryDirectory() as empty:
+            self._rsync(['-r', '--mkpath', os.path.join(empty, ''),
+                         self.url(posixpath.join(path, ''))])
+
+    def put(self, local_dir, path, args=None):
+        self._rsync(['-a'] + (args or []) + [
+            os.path.join(local_dir, ''), self.url(posixpath.join(path, ''))])
+
+    def get(self, path, local_dir, args=None):
+        self._rsync(['-a'] + (args or []) + [
+            self.url(posixpath.join(path, '')), os.path.join(local_dir, '')])
+
+    def fetch(self, path, local_dir):
+        # Copy a single file, returning its local path or None if missing
+        local_file = os.path.join(local_dir, posixpath.basename(path))
+        try:
+            self._rsync([self.url(path), local_file],
+                        stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            return None
+        return local_file
+
+    def pull_state(self, path, local_dir):
+        self.get(path, local_dir, args=STATE_FILTER_ARGS)
+
+    def push_state(self, local_dir, path):
+        self.put(local_dir, path, args=STATE_FILTER_ARGS)
+
+    def walk(self, path):
+        # (path, inode, size, mtime) of the files under path, as listed by
+        # find on the server through the shared connection
+        if not self.ssh:
+            raise Exception('Listing {} needs an ssh target'.format(path))
+        output = subprocess.check_output(self.ssh_cmd() + [
+            self.host, 'find', shlex.quote(path), '!', '-type', 'd',
+            '-printf', shlex.quote('%P\\0%i\\0%s\\0%T@\\0')])
+        fields = output.split(b'\0')
+        for i in range(0, len(fields) - 1, 4):
+            yield ('/' + os.fsdecode(fields[i]), int(fields[i + 1]),
+                   int(fields[i + 2]), _mtime_ns(fields[i + 3].decode()))
@@ -0,0 +1,62 @@
+import contextlib
+import time
+
+import yaml
+
+from .sizes import format_size
+
+REPORT_FILE = 'extbackup-report.yaml'
+
+
+class Report(object):
+    def __init__(self, name):
+        self.name = name
+        self.phases = {}
+        self.order = []
+
+    @classmethod
+    def load(cls, file_name):
+        with open(file_name, 'r') as f:
+            data = yaml.safe_load(f) or {}
+        report = cls(data.get('name'))
+        for phase, values in sorted((data.get('phases') or {}).items()):
+            for key, value in sorted(values.items()):
+                report.add(phase, key, value)
+        return report
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, 'seconds', round(time.monotonic() - start, 1))
+
+    def add(self, phase, key, value):
+        if phase not in self.phases:
+            self.phases[phase] = {}
+            self.order.append(phase)
+        self.phases[phase][key] = value
+
+    def get(self, phase, key, default=None):
+        return self.phases.get(phase, {}).get(key, default)
+
+    def summary(self):
+        lines = ['Report for {}:'.format(self.name)]
+        for phase in self.order:
+            lines.append('  {}: {}'.format(phase, ', '.join(
+                self._format(key, value) for key, value
+                in sorted(self.phases[phase].items()))))
+        return '\n'.join(lines)
+
+    def _format(self, key, value):
+        if key.endswith('_bytes'):
+            return '{} {}'.format(key[:-len('_bytes')], format_size(value))
+        if isinstance(value, dict):
+            return '{} {}'.format(key, len(value))
+        return '{} {}'.format(key, value)
+
+    def save(self, file_name):
+        with open(file_name, 'w') as f:
+            yaml.safe_dump({'name': self.name, 'phases': self.phases}, f,
+                           default_flow_style=False)
@@ -0,0 +1,118 @@
+import collections
+import datetime
+import fnmatch
+import os
+
+import yaml
+
+from .catalog import CATALOG_FILE
+from .catalog import Catalog
+from .shards import escape_pattern
+from .sizes import parse_size
+
+ROUTING_STATE_FILE = '.routing-state.yaml'
+
+Route = collections.namedtuple('Route', ['path', 'size', 'changes', 'new'])
+
+
+def route_filter_args(paths):
+    # Transfer only the routed files and the directories leading to them
+    parents = set()
+    for path in paths:
+        parent = os.path.dirname(path)
+        while parent not in ('', '/'):
+            parents.add(parent)
+            parent = os.path.dirname(parent)
+    rules = ['+ {}/'.format(escape_pattern(p)) for p in sorted(parents)]
+    rules += ['+ {}'.format(escape_pattern(p)) for p in sorted(paths)]
+    rules += ['H *', 'P *']
+    return ['--filter={}'.format(rule) for rule in rules]
+
+
+def skip_filter_args(paths):
+    # Leave routed files to the routed pass and keep them from deletion
+    args = []
+    for path in sorted(paths):
+        args += ['--filter=H {}'.format(escape_pattern(path)),
+                 '--filter=P {}'.format(escape_pattern(path))]
+    return args
+
+
+class ChurnRouter(object):
+    # Routes files that are large and replaced in most recent snapshots from
+    # the versioned tree to the single-copy tree. Routed files no longer
+    # appear in the catalog, so a route is kept until the file is removed,
+    # matched by a versioned override or the route expires. Expired files
+    # return to the versioned tree so their churn can be observed again
+    def __init__(self, target, min_size='256M', min_changes=3, window=5,
+                 versioned=None, recheck_days=30):
+        self.target = target
+        self.state_file = os.path.join(target, ROUTING_STATE_FILE)
+        self.min_size = parse_size(min_size)
+        self.min_changes = min_changes
+        self.window = window
+        self.versioned = versioned or []
+        self.recheck_days = recheck_days
+        self.expired = []
+        if min_changes < 1 or min_changes >= window:
+            raise Exception('Routing needs 1 <= min-changes < window')
+        self.state = {}
+        if os.path.isfile(self.state_file):
+            with open(self.state_file, 'r') as f:
+                self.state = yaml.safe_load(f) or {}
+
+    @classmethod
+    def from_config(cls, config, target):
+        if not config:
+            return None
+        config = config if isinstance(config, dict) else {}
+        return cls(target, min_size=config.get('min-size', '256M'),
+                   min_changes=config.get('min-changes', 3),
+                   window=config.get('window', 5),
+                   versioned=config.get('versioned'),
+                   recheck_days=config.get('recheck-days', 30))
+
+    def route(self, bind_dir):
+        routes = {}
+        expires = datetime.date.today() - datetime.timedelta(
+            days=self.recheck_days)
+        self.expired = [path for path, routed in sorted(self.state.items())
+                        if routed <= expires]
+        for path in sorted(self.state):
+            if path in self.expired:
+                continue
+            size = self._source_size(bind_dir, path)
+            if size is not None and not self._keep_versioned(path):
+                routes[path] = Route(path, size, None, False)
+        for path, _, changes in self._candidates():
+            if path in routes or path in self.expired or \
+                    changes < self.min_changes or self._keep_versioned(path):
+                continue
+            size = self._source_size(bind_dir, path)
+            if size is not None:
+                routes[path] = Route(path, size, changes, True)
+        return [routes[path] for path in sorted(routes)]
+
+    def save(self, routes):
+        today = datetime.date.today()
+        self.state = {route.path: self.state.get(route.path, today)
+                      for route in routes}
+        with open(self.state_file, 'w') as f:
+            yaml.safe_dump(self.state, f, default_flow_style=False)
+
+    def _candidates(self):
+        catalog_file = os.path.join(self.target, CATALOG_FILE)
+        if not os.path.isfile(catalog_file):
+            return []
+        with Catalog(catalog_file, read_only=True) as catalog:
+            return catalog.churn(self.window, self.min_size)
+
+    def _keep_versioned(self, path):
+        return any(fnmatch.fnmatchcase(path, pattern)
+                   for pattern in self.versioned)
+
+    def _source_size(self, bind_dir, path):
+        source = os.path.join(bind_dir, path.lstrip('/'))
+        if not os.path.isfile(source) or os.path.islink(source):
+            return None
+        return os.path.getsize(source)
@@ -1,29 +1,72 @@
 from __future__ import print_function
 
 import os
+import re
 import shutil
 
 import yaml
 
+ERROR_RE = re.compile(r'^rsync: (?:\[\w+\] )?(?P<message>.*?)'
+                      r'"(?P<path>[^"]+)"(?P<detail>.*)$')
+VERIFY_ERROR_RE = re.compile(r'^ERROR: (?P<path>.+) failed verification')
+
+
+def load_config(config_file):
+    print('Loading {}'.format(config_file))
+    with open(config_file, 'r') as f:
+        config = yaml.safe_load(f)
+        if not config:
+            raise Exception('No configuration loaded')
+    return config
+
+
+def _relative_path(path, roots):
+    for root in roots:
+        root = os.path.join(root, '')
+        if path.startswith(root):
+            return path[len(root):]
+    if os.path.isabs(path):
+        return None
+    return path
+
+
+def parse_failed_paths(lines, source, dest):
+    # Map paths rsync reported errors for, relative to the transfer root, to
+    # their error messages. Vanished files are not errors
+    failed = {}
+    for line in lines:
+        match = ERROR_RE.match(line)
+        if match and 'vanished' not in match.group('message'):
+            detail = match.group('detail')
+            error = detail.rsplit(': ', 1)[-1].strip() if ': ' in detail \
+                else match.group('message').strip(' :')
+        else:
+            match = VERIFY_ERROR_RE.match(line)
+            if not match:
+                continue
+            error = 'failed verification'
+        path = _relative_path(match.group('path'), [source, dest])
+        if path:
+            failed[path] = error
+    return failed
+
 
 class RsyncPaths(object):
     CONFIG_SECTIONS = ['include', 'exclude',
                        'include-single', 'exclude-single']
 
-    def __init__(self, config_file, config_directory):
+    def __init__(self, config_file, config_directory, config=None):
         self.config_file = config_file
         self.config_directory = config_directory
         self.paths_files = {}
+        if config is not None:
+            self._config = config
         self._configure()
 
     @property
     def config(self):
         if not hasattr(self, '_config'):
-            print('Loading {}'.format(self.config_file))
-            with open(self.config_file, 'r') as f:
-                self._config = yaml.load(f)
-                if not self._config:
-                    raise Exception('No configuration loaded')
+            self._config = load_config(self.config_file)
         return self._config
 
     def copy_config(self, destination):
@@ -35,6 +78,16 @@ class RsyncPaths(object):
         for file_path in self.paths_files.values():
             shutil.copy(file_path, destination)
 
+    def add_excludes(self, patterns, sections=('exclude', 'exclude-single')):
+        # Append generated rules to the versioned and single-copy excludes
+        for section in sections:
+            paths_file = self.paths_files.get(section) or os.path.join(
+                self.config_directory, 'rsync-{}'.format(section))
+            with open(paths_file, 'a') as f:
+                for pattern in patterns:
+                    print(pattern, file=f)
+            self.paths_files[section] = paths_file
+
     def get_exclude_include_args(self, single=False):
         out_args = []
         for paths_type in ['exclude', 'include']:
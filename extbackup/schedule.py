@@ -0,0 +1,91 @@
+import datetime
+import os
+import re
+
+import yaml
+
+SCHEDULE_STATE_FILE = '.schedule-state.yaml'
+DEADLINE_FORMATS = ['%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M']
+TIME_RE = re.compile(r'^(?P<hour>\d{1,2}):(?P<minute>\d{2})$')
+
+
+def parse_deadline(value, now=None):
+    # HH:MM means the next time the clock reads HH:MM
+    now = now or datetime.datetime.now()
+    match = TIME_RE.match(value)
+    if match:
+        deadline = now.replace(hour=int(match.group('hour')),
+                               minute=int(match.group('minute')),
+                               second=0, microsecond=0)
+        if deadline <= now:
+            deadline += datetime.timedelta(days=1)
+        return deadline
+    for deadline_format in DEADLINE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, deadline_format)
+        except ValueError:
+            continue
+    raise Exception('Invalid deadline: {}'.format(value))
+
+
+class DeadlineScheduler(object):
+    # Without a deadline every unit runs, but completion is still recorded
+    def __init__(self, deadline, target, estimates=None):
+        self.deadline = deadline
+        self.state_file = os.path.join(target, SCHEDULE_STATE_FILE)
+        self.estimates = estimates or {}
+        self.skipped = []
+        self.stopped = []
+        self.state = {}
+        if os.path.isfile(self.state_file):
+            with open(self.state_file, 'r') as f:
+                self.state = yaml.safe_load(f) or {}
+
+    @property
+    def last_complete(self):
+        return self.state.get('last-complete')
+
+    @property
+    def partial(self):
+        return bool(self.skipped or self.stopped)
+
+    def order(self, units):
+        # Units left over by the previous run go first, otherwise units keep
+        # their priority order
+        previous = self.state.get('skipped') or []
+        return sorted(units, key=lambda unit: unit[0] not in previous)
+
+    def remaining(self):
+        return (self.deadline - datetime.datetime.now()).total_seconds()
+
+    def should_run(self, name, required=False):
+        if required or not self.deadline:
+            return True
+        remaining = self.remaining()
+        if remaining <= 0 or self.estimates.get(name, 0) > remaining:
+            print('Skipping {}, {:.0f}s estimated with {:.0f}s left'.format(
+                name, self.estimates.get(name, 0), max(remaining, 0)))
+            self.skipped.append(name)
+            return False
+        return True
+
+    def finished(self, name, required=False, stopped=False):
+        # rsync's --stop-at has minute precision, so it may stop a unit
+        # shortly before the deadline itself has passed
+        if stopped or (self.deadline and not required and
+                       self.remaining() <= 0):
+            print('Stopped {} at deadline'.format(name))
+            self.stopped.append(name)
+
+    def stop_at(self):
+        # Local time in the format taken by rsync's --stop-at
+        if self.deadline:
+            return self.deadline.strftime('%Y-%m-%dT%H:%M')
+
+    def save(self, snapshot_name):
+        state = {'skipped': self.skipped + self.stopped,
+                 'last-complete': self.last_complete}
+        if not self.partial:
+            state['last-complete'] = snapshot_name
+        with open(self.state_file, 'w') as f:
+            yaml.safe_dump(state, f, default_flow_style=False)
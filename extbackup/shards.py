@@ -0,0 +1,128 @@
+import collections
+import concurrent.futures
+import datetime
+import heapq
+import os
+import re
+
+import yaml
+
+SHARD_ESTIMATES_FILE = '.shard-estimates.yaml'
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+ShardPlan = collections.namedtuple('ShardPlan', ['path', 'shards'])
+
+
+def count_entries(path):
+    count = 1
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    count += count_entries(entry.path)
+                else:
+                    count += 1
+    except (NotADirectoryError, PermissionError, FileNotFoundError):
+        pass
+    return count
+
+
+def scan_estimates(directory, jobs=4):
+    names = sorted(os.listdir(directory))
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        counts = executor.map(
+            lambda name: count_entries(os.path.join(directory, name)), names)
+        return dict(zip(names, counts))
+
+
+def plan_shards(estimates, count):
+    # Assign the largest subtrees first, each to the lightest shard
+    heap = [(0, i) for i in range(count)]
+    shards = [[] for _ in range(count)]
+    for name in sorted(estimates, key=lambda n: (-estimates[n], n)):
+        weight, i = heapq.heappop(heap)
+        shards[i].append(name)
+        heapq.heappush(heap, (weight + estimates[name], i))
+    return [sorted(shard) for shard in shards if shard]
+
+
+def escape_pattern(name):
+    return re.sub(r'([*?\[])', r'\\\1', name)
+
+
+def hide_filter_args(path):
+    # The main pass transfers the sharded directory but none of its
+    # contents, and must not delete what the shard passes copy
+    pattern = '{}/*'.format(escape_pattern(path.rstrip('/')))
+    return ['--filter=H {}'.format(pattern),
+            '--filter=P {}'.format(pattern)]
+
+
+def shard_filter_args(path, others):
+    # Transfer only this shard's entries of path, plus the directories
+    # leading to it. Entries left to other passes are hidden on the sending
+    # side and protected from deletion on the receiving side, while this
+    # shard's entries fall through to the configured filters
+    path = path.rstrip('/')
+    rules = []
+    for name in others:
+        pattern = '{}/{}'.format(escape_pattern(path), escape_pattern(name))
+        rules += ['H {}'.format(pattern), 'P {}'.format(pattern)]
+    parents = []
+    parent = path
+    while parent not in ('', '/'):
+        parents.insert(0, parent)
+        parent = os.path.dirname(parent)
+    rules += ['+ {}/'.format(escape_pattern(p)) for p in parents]
+    for p in reversed(parents):
+        siblings = '{}/*'.format(escape_pattern(os.path.dirname(p)))
+        rules += ['H {}'.format(siblings.replace('//', '/')),
+                  'P {}'.format(siblings.replace('//', '/'))]
+    return ['--filter={}'.format(rule) for rule in rules]
+
+
+class ShardPlanner(object):
+    def __init__(self, target, jobs=4, rescan_days=7):
+        self.estimates_file = os.path.join(target, SHARD_ESTIMATES_FILE)
+        self.jobs = jobs
+        self.rescan = datetime.timedelta(days=rescan_days)
+
+    def plan(self, bind_dir, paths):
+        cache = self._load()
+        plans = []
+        for path in paths:
+            directory = os.path.join(bind_dir, path.strip('/'))
+            if not os.path.isdir(directory):
+                print('Sharded path {} not found'.format(path))
+                continue
+            estimates = self._estimates(cache, path, directory)
+            plans.append(ShardPlan(path, plan_shards(estimates, self.jobs)))
+        self._save(cache)
+        return plans
+
+    def _estimates(self, cache, path, directory):
+        cached = cache.get(path)
+        if cached and datetime.datetime.now() - datetime.datetime.strptime(
+                cached['scanned'], TIME_FORMAT) < self.rescan:
+            # Entries added since the scan are assumed to be average sized
+            names = os.listdir(directory)
+            known = [cached['entries'][name] for name in names
+                     if name in cached['entries']]
+            default = sum(known) // len(known) if known else 1
+            return {name: cached['entries'].get(name, default)
+                    for name in names}
+        print('Estimating size of {}'.format(path))
+        estimates = scan_estimates(directory, self.jobs)
+        cache[path] = {'scanned': datetime.datetime.now().strftime(
+            TIME_FORMAT), 'entries': estimates}
+        return estimates
+
+    def _load(self):
+        if not os.path.isfile(self.estimates_file):
+            return {}
+        with open(self.estimates_file, 'r') as f:
+            return yaml.safe_load(f) or {}
+
+    def _save(self, cache):
+        with open(self.estimates_file, 'w') as f:
+            yaml.safe_dump(cache, f, default_flow_style=False)
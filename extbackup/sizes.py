@@ -0,0 +1,24 @@
+import re
+
+SIZE_UNITS = ['B', 'KiB', 'MiB', 'GiB', 'TiB']
+SIZE_RE = re.compile(r'^\s*(?P<value>\d+(\.\d+)?)\s*(?P<unit>[KMGT]?)i?B?\s*$',
+                     re.IGNORECASE)
+
+
+def format_size(size):
+    for unit in SIZE_UNITS:
+        if size < 1024 or unit == SIZE_UNITS[-1]:
+            break
+        size /= 1024.0
+    return '{:.1f} {}'.format(size, unit) if unit != 'B' \
+        else '{} {}'.format(int(size), unit)
+
+
+def parse_size(value):
+    if isinstance(value, int):
+        return value
+    match = SIZE_RE.match(str(value))
+    if not match:
+        raise Exception('Invalid size: {}'.format(value))
+    multiplier = 1024 ** 'BKMGT'.index(match.group('unit').upper() or 'B')
+    return int(float(match.group('value')) * multiplier)
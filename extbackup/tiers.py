@@ -0,0 +1,61 @@
+import collections
+import datetime
+import os
+
+import yaml
+
+TIER_STATE_FILE = '.tier-state.yaml'
+
+Tier = collections.namedtuple('Tier', ['name', 'interval', 'paths'])
+
+
+def load_tiers(config):
+    tiers = []
+    for name, tier_config in sorted((config or {}).items()):
+        tier_config = tier_config or {}
+        interval = tier_config.get('interval')
+        if not isinstance(interval, int) or interval < 1:
+            raise Exception('Tier {} needs an interval of at least 1 day'
+                            .format(name))
+        paths = tier_config.get('paths') or []
+        for path in paths:
+            if not path.startswith('/'):
+                raise Exception('Tier {} path {} is not absolute'
+                                .format(name, path))
+        tiers.append(Tier(name=name, interval=interval, paths=paths))
+    return tiers
+
+
+class TierSchedule(object):
+    # Tracks the day each tier's paths were last copied from the source
+    def __init__(self, target, tiers, today=None):
+        self.state_file = os.path.join(target, TIER_STATE_FILE)
+        self.tiers = tiers
+        self.today = today or datetime.date.today()
+        self.state = {}
+        if os.path.isfile(self.state_file):
+            with open(self.state_file, 'r') as f:
+                self.state = yaml.safe_load(f) or {}
+
+    def due(self, tier, prev_snapshot):
+        last = self.state.get(tier.name)
+        if not last or not prev_snapshot:
+            return True
+        # Paths missing from the previous snapshot cannot be carried forward
+        if not all(os.path.isdir(os.path.join(prev_snapshot,
+                                              path.strip('/')))
+                   for path in tier.paths):
+            return True
+        return (self.today - last).days >= tier.interval
+
+    def carried(self, prev_snapshot):
+        return [tier for tier in self.tiers
+                if not self.due(tier, prev_snapshot)]
+
+    def save(self, carried):
+        carried_names = [tier.name for tier in carried]
+        for tier in self.tiers:
+            if tier.name not in carried_names:
+                self.state[tier.name] = self.today
+        with open(self.state_file, 'w') as f:
+            yaml.safe_dump(self.state, f, default_flow_style=False)
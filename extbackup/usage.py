@@ -0,0 +1,86 @@
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import os
+
+from .inodes import InodeTable
+
+USAGE_CACHE_DIR = '.usage-cache'
+
+SnapshotUsage = collections.namedtuple(
+    'SnapshotUsage', ['name', 'total', 'unique', 'shared_prev', 'shared_next'])
+
+
+class UsageCalculator(object):
+    def __init__(self, target, snapshots, jobs=4):
+        self.target = target
+        self.snapshots = snapshots
+        self.jobs = jobs
+        self.cache_dir = os.path.join(target, USAGE_CACHE_DIR)
+
+    def calculate(self):
+        self._scan_missing()
+        unique = self._unique_bytes()
+        usage = []
+        # Keep a window of three tables so memory use does not grow with the
+        # number of snapshots
+        prev_table = None
+        table = self._load(0)
+        for i, name in enumerate(self.snapshots):
+            next_table = self._load(i + 1)
+            usage.append(SnapshotUsage(
+                name=name,
+                total=table.total_bytes,
+                unique=unique[i] + table.dir_bytes,
+                shared_prev=(table.shared_bytes(prev_table)
+                             if prev_table is not None else 0),
+                shared_next=(table.shared_bytes(next_table)
+                             if next_table is not None else 0)))
+            prev_table, table = table, next_table
+        return usage
+
+    def _unique_bytes(self):
+        # Bytes of the inodes found in only one snapshot. A snapshot may be
+        # linked from older snapshots than its predecessor, so every table
+        # is merged rather than only the neighbors
+        unique = [0] * len(self.snapshots)
+        entries = [self._read_entries(i) for i in range(len(self.snapshots))]
+        for _, group in itertools.groupby(heapq.merge(*entries),
+                                          key=lambda entry: entry[0]):
+            first = next(group)
+            if next(group, None) is None:
+                unique[first[1]] += first[2]
+        return unique
+
+    def _read_entries(self, index):
+        for inode, size in InodeTable.read_entries(
+                self._cache_file(self.snapshots[index])):
+            yield inode, index, size
+
+    def _cache_file(self, name):
+        return os.path.join(self.cache_dir, '{}.inodes'.format(name))
+
+    def _load(self, index):
+        if index >= len(self.snapshots):
+            return None
+        return InodeTable.load(self._cache_file(self.snapshots[index]))
+
+    def _scan_missing(self):
+        if not os.path.isdir(self.cache_dir):
+            os.mkdir(self.cache_dir)
+        for fn in os.listdir(self.cache_dir):
+            # Remove cached tables of pruned snapshots
+            if os.path.splitext(fn)[0] not in self.snapshots:
+                os.unlink(os.path.join(self.cache_dir, fn))
+        missing = [name for name in self.snapshots
+                   if not os.path.isfile(self._cache_file(name))]
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+            for future in [executor.submit(self._scan, name)
+                           for name in missing]:
+                future.result()
+
+    def _scan(self, name):
+        print('Scanning {}'.format(name))
+        table = InodeTable.from_directory(os.path.join(self.target, name))
+        table.save(self._cache_file(name))
@@ -0,0 +1,109 @@
+import os
+import subprocess
+import threading
+
+from .sizes import parse_size
+
+BDI_DIR = '/sys/class/bdi'
+
+
+def _read(file_name):
+    with open(file_name, 'r') as f:
+        return f.read().strip()
+
+
+def _write(file_name, value):
+    with open(file_name, 'w') as f:
+        f.write(value)
+
+
+def bdi_name(path):
+    dev = os.stat(path).st_dev
+    return '{}:{}'.format(os.major(dev), os.minor(dev))
+
+
+def syncfs(path):
+    subprocess.check_call(['sync', '-f', path])
+
+
+class WritebackLimits(object):
+    # Limits the target's share of dirty page cache while mounted, so rsync
+    # is paced by the disk rather than flushing everything at unmount.
+    # max_bytes and strict_limit need Linux 6.2 or later
+    def __init__(self, path, max_ratio=None, max_bytes=None,
+                 strict_limit=False, sync_interval=None, bdi_dir=BDI_DIR):
+        self.path = path
+        self.limits = []
+        if max_bytes is not None:
+            self.limits.append(('max_bytes', str(parse_size(max_bytes))))
+        elif max_ratio is not None:
+            self.limits.append(('max_ratio', str(max_ratio)))
+        if strict_limit:
+            self.limits.append(('strict_limit', '1'))
+        self.sync_interval = sync_interval
+        self.bdi_path = os.path.join(bdi_dir, bdi_name(path))
+        self.saved = []
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    @classmethod
+    def from_config(cls, config, path):
+        if not config:
+            return None
+        writeback = cls(path, max_ratio=config.get('max-ratio'),
+                        max_bytes=config.get('max-bytes'),
+                        strict_limit=config.get('strict-limit', False),
+                        sync_interval=config.get('sync-interval'))
+        if writeback.limits and not writeback.available():
+            print('Write-back limits not available for {}'.format(path))
+            writeback.limits = []
+        return writeback
+
+    def available(self):
+        return all(os.path.isfile(os.path.join(self.bdi_path, key))
+                   for key, _ in self.limits)
+
+    def __enter__(self):
+        try:
+            for key, value in self.limits:
+                # Writing max_bytes updates max_ratio, which is restored
+                saved_key = 'max_ratio' if key == 'max_bytes' else key
+                file_name = os.path.join(self.bdi_path, saved_key)
+                self.saved.insert(0, (saved_key, _read(file_name)))
+                _write(os.path.join(self.bdi_path, key), value)
+        except BaseException:
+            self._restore()
+            raise
+        if self.limits:
+            print('Limiting write-back for {} ({})'.format(
+                self.path, ', '.join('{} {}'.format(key, value)
+                                     for key, value in self.limits)))
+        if self.sync_interval:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        if self.thread:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+        self._restore()
+
+    def flush(self):
+        syncfs(self.path)
+
+    def _restore(self):
+        for key, value in self.saved:
+            try:
+                _write(os.path.join(self.bdi_path, key), value)
+            except OSError as e:
+                print('Unable to restore {}: {}'.format(key, e))
+        self.saved = []
+
+    def _run(self):
+        while not self.stop_event.wait(self.sync_interval):
+            try:
+                self.flush()
+            except (OSError, subprocess.CalledProcessError) as e:
+                print('Unable to sync {}: {}'.format(self.path, e))
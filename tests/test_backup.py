@@ -1,12 +1,31 @@
+import datetime
 import os
+import subprocess
 from unittest import mock
 
 import pytest
 
+from extbackup.backup import CHANGED_PREFIX
 from extbackup.backup import MOUNT_DIR
 from extbackup.backup import ExternalBackup
+from extbackup.backup import ProfileBackup
+from extbackup.flagprobe import FLAG_PROBE_FILE
+from extbackup.flagprobe import choose_flags
+from extbackup.packs import DirectoryPack
+from extbackup.profiles import SourceProfile
+from extbackup.remote import RemoteTarget
+from extbackup.report import REPORT_FILE
+from extbackup.routing import ROUTING_STATE_FILE
+from extbackup.schedule import SCHEDULE_STATE_FILE
+from extbackup.schedule import DeadlineScheduler
+from extbackup.shards import ShardPlan
+from extbackup.shards import ShardPlanner
+from extbackup.tiers import TIER_STATE_FILE
+from extbackup.tiers import TierSchedule
+from extbackup.tiers import load_tiers
 
 MOCK_HOSTNAME = 'testhost1'
+REAL_MKDIR = os.mkdir
 
 
 @pytest.fixture
@@ -27,6 +46,12 @@ def mock_mkdir():
         yield patched_object
 
 
+@pytest.fixture
+def real_mkdir(mock_mkdir):
+    mock_mkdir.side_effect = REAL_MKDIR
+    yield mock_mkdir
+
+
 @pytest.fixture
 def mock_isdir():
     with mock.patch('os.path.isdir') as patched_object:
@@ -84,3 +109,679 @@ def test_target_exists(dir_exists, mock_chmod, mock_mkdir,
         mock_mkdir.assert_not_called()
     else:
         mock_mkdir.assert_called_once_with(target)
+
+
+def test_versions(mock_ismount, mock_isdir, mock_gethostname):
+    mock_ismount.return_value = True
+    mock_isdir.return_value = True
+    mock_gethostname.return_value = MOCK_HOSTNAME
+    backup = ExternalBackup()
+    with mock.patch('os.listdir') as mock_listdir:
+        mock_listdir.return_value = ['20180102-0000', 'single',
+                                     '.catalog.sqlite', '20180101-0000']
+        assert backup.versions() == ['20180101-0000', '20180102-0000']
+
+
+@pytest.mark.parametrize(['last_complete', 'expected'], [
+    (None, ['20180103-0000']),
+    ('20180103-0000', ['20180103-0000']),
+    ('20180102-0000', ['20180103-0000', '20180102-0000']),
+])
+def test_start_snapshot(last_complete, expected, real_mkdir, tmp_path):
+    for name in ['20180101-0000', '20180102-0000', '20180103-0000']:
+        (tmp_path / name).mkdir()
+    if last_complete:
+        (tmp_path / SCHEDULE_STATE_FILE).write_text(
+            'last-complete: {}\n'.format(last_complete))
+    (tmp_path / '20180103-0000' / REPORT_FILE).write_text(
+        'name: testhost1\nphases:\n  versioned: {seconds: 60.0}\n')
+    backup = ExternalBackup(mounts=[], pretend=True)
+    backup._target = str(tmp_path)
+    backup._start_snapshot()
+    assert backup.link_dests == [str(tmp_path / name) for name in expected]
+    assert backup.scheduler.estimates == {'versioned': 60.0}
+
+
+@pytest.mark.parametrize(['config', 'expected_args'], [
+    ({}, []),
+    ({'single-delta': {'min-size': '1M'}}, ['--max-size=1048575']),
+])
+def test_backup_single(config, expected_args, mock_gethostname):
+    mock_gethostname.return_value = MOCK_HOSTNAME
+    backup = ExternalBackup()
+    backup._target = os.path.join(MOUNT_DIR, MOCK_HOSTNAME)
+    backup.config = config
+    backup.rsync = mock.MagicMock()
+    backup.rsync.get_exclude_include_args.return_value = []
+
+    def _runcmd(cmd, stdout=None, ignore_exit_codes=None):
+        if stdout:
+            stdout.write('sending incremental file list\n'
+                         '{0}vm/\n{0}vm/disk.img\n'.format(CHANGED_PREFIX))
+        return 0
+
+    with mock.patch.object(backup, '_runcmd',
+                           side_effect=_runcmd) as mock_runcmd, \
+            mock.patch('os.path.getsize') as mock_getsize, \
+            mock.patch('extbackup.backup.DeltaCopy') as mock_delta:
+        mock_getsize.return_value = 4 * 1024 * 1024
+        mock_delta.return_value.run.return_value = 1024
+        backup._backup_single('/tmp/bind')
+    cmd = mock_runcmd.call_args_list[0][0][0]
+    assert cmd[-2:] == ['/tmp/bind/', os.path.join(backup.target, 'single')]
+    assert [arg for arg in cmd if arg.startswith('--max-size')] == \
+        expected_args
+    if not config:
+        assert mock_runcmd.call_count == 1
+        mock_delta.assert_not_called()
+        return
+    delta_cmd = mock_runcmd.call_args_list[1][0][0]
+    assert delta_cmd[:2] == ['ionice', '-c']
+    assert '--min-size=1048576' in delta_cmd
+    assert mock_runcmd.call_args_list[1][1]['ignore_exit_codes'] == [24]
+    mock_delta.assert_called_once_with(
+        '/tmp/bind/vm/disk.img',
+        os.path.join(backup.target, 'single', 'vm', 'disk.img'),
+        os.path.join(backup.target, '.block-index', 'vm', 'disk.img'),
+        block_size=1024 * 1024, jobs=4)
+
+
+def test_backup_single_routed(real_mkdir, tmp_path):
+    bind_dir = tmp_path / 'bind'
+    (bind_dir / 'srv').mkdir(parents=True)
+    (bind_dir / 'srv' / 'vm.img').write_text('x' * 100)
+    (tmp_path / ROUTING_STATE_FILE).write_text('/srv/vm.img: {}\n'.format(
+        datetime.date.today()))
+    backup = ExternalBackup(mounts=[])
+    backup._configure({'routing': {'min-size': 10}})
+    backup._target = str(tmp_path)
+    backup.rsync = mock.MagicMock()
+    backup.rsync.get_exclude_include_args.return_value = []
+    backup._route_files(str(bind_dir))
+    backup.rsync.add_excludes.assert_called_once_with(
+        ['/srv/vm.img'], sections=['exclude'])
+    assert backup.report.get('routing', 'files') == 1
+    assert backup.report.get('routing', 'saved_bytes') == 100
+    with mock.patch.object(backup, '_runcmd') as mock_runcmd:
+        backup._backup_single(str(bind_dir))
+    single_cmd, routed_cmd = [c[0][0] for c in mock_runcmd.call_args_list]
+    assert '--filter=P /srv/vm.img' in single_cmd
+    assert routed_cmd[-2:] == [str(bind_dir) + '/', str(tmp_path / 'single')]
+    assert '--filter=+ /srv/vm.img' in routed_cmd
+    assert '--filter=H *' in routed_cmd
+
+
+def test_backup_versioned_flag_probe(real_mkdir, tmp_path):
+    bind_dir = tmp_path / 'bind'
+    for name in ['boot', 'home/user']:
+        (bind_dir / name).mkdir(parents=True)
+    backup = ExternalBackup(mounts=[])
+    backup._configure({'flag-probe': True,
+                       'schedule': {'priorities': ['/home/user']}})
+    backup._target = str(tmp_path)
+    backup.snapshot = str(tmp_path / '20180102-0000')
+    backup.rsync = mock.MagicMock()
+    backup.rsync.get_exclude_include_args.return_value = []
+    with mock.patch('extbackup.backup.FlagProbe.probe') as mock_probe:
+        mock_probe.side_effect = lambda path, _: choose_flags(
+            'vfat' if path == '/boot' else 'ext4', [], {'acls': '/a'},
+            True, 10)
+        backup._probe_flags(str(bind_dir))
+    assert backup.probed_args == {
+        '/boot': ['--no-hard-links', '--no-acls', '--no-xattrs'],
+        '/home': ['--no-hard-links', '--no-xattrs']}
+    assert backup.report.get('flag-probe', '/home') == \
+        '--no-hard-links --no-xattrs'
+    assert (tmp_path / FLAG_PROBE_FILE).exists()
+    with mock.patch.object(backup, '_runcmd') as mock_runcmd:
+        backup._backup_versioned(str(bind_dir))
+        backup._backup_priority(str(bind_dir), '/home/user')
+    boot_cmd, home_cmd, priority_cmd = [
+        c[0][0] for c in mock_runcmd.call_args_list]
+    assert boot_cmd[boot_cmd.index('--no-hard-links') - 1] == \
+        '--filter=P /home/user/*'
+    assert boot_cmd[-6:-2] == ['--no-xattrs', '--filter=+ /boot/',
+                               '--filter=H /*', '--filter=P /*']
+    assert '--no-acls' not in home_cmd
+    assert '--filter=+ /home/' in home_cmd
+    assert '--no-xattrs' in priority_cmd
+    assert '--filter=+ /home/user/' in priority_cmd
+
+
+def test_runcmd_stderr_lines():
+    backup = ExternalBackup(mounts=[])
+    lines = []
+    assert backup._runcmd(['sh', '-c', 'echo failed >&2; exit 23'],
+                          ignore_exit_codes=[23], stderr_lines=lines) == 23
+    assert lines == ['failed']
+    with pytest.raises(subprocess.CalledProcessError):
+        backup._runcmd(['sh', '-c', 'exit 23'], stderr_lines=[])
+
+
+@pytest.mark.parametrize(['retry_failures', 'expected_errors'], [
+    ([[]], None),
+    ([['srv/a'], ['srv/a']], {'versioned': {'srv/a': 'I/O error (5)'}}),
+])
+def test_rsync_retry(retry_failures, expected_errors):
+    backup = ExternalBackup(mounts=[])
+    backup._configure({'retry': {'attempts': 2, 'delay': 1}})
+    backup.rsync = mock.MagicMock()
+    backup.rsync.get_exclude_include_args.return_value = []
+    failures = [['srv/a', 'srv/b']] + retry_failures
+    files_from = []
+
+    def runcmd(cmd, ignore_exit_codes=None, stderr_lines=None):
+        assert 23 in ignore_exit_codes
+        for arg in cmd:
+            if arg.startswith('--files-from='):
+                with open(arg.split('=', 1)[1]) as f:
+                    files_from.append(f.read())
+        paths = failures.pop(0)
+        stderr_lines.extend(
+            'rsync: read errors mapping "/tmp/bind/{}": I/O error (5)'
+            .format(path) for path in paths)
+        return 23 if paths else 0
+
+    with mock.patch.object(backup, '_runcmd', side_effect=runcmd), \
+            mock.patch('time.sleep') as mock_sleep:
+        backup._rsync('/tmp/bind', '/dest/20180101-0000')
+    assert files_from[0] == 'srv/a\0srv/b\0'
+    assert files_from[1:] == ['srv/a\0'] * (len(files_from) - 1)
+    assert mock_sleep.call_args_list[:2] == [mock.call(1), mock.call(2)][
+        :len(files_from)]
+    assert not failures
+    if not expected_errors:
+        assert backup.failed_paths == {}
+        return
+    assert backup.failed_paths == expected_errors
+    backup.pretend = True
+    backup.scheduler = DeadlineScheduler(None, '/dest')
+    backup._finish_snapshot()
+    assert backup.report.get('errors', 'status') == 'complete-with-errors'
+    assert backup.report.get('errors', 'versioned') == \
+        expected_errors['versioned']
+
+
+def test_rsync_retry_directory():
+    backup = ExternalBackup(mounts=[])
+    backup._configure({'retry': {'attempts': 1, 'delay': 1}})
+    backup.rsync = mock.MagicMock()
+    backup.rsync.get_exclude_include_args.return_value = []
+    cmds = []
+
+    def runcmd(cmd, ignore_exit_codes=None, stderr_lines=None):
+        cmds.append(cmd)
+        if len(cmds) > 1:
+            return 0
+        stderr_lines.append('rsync: opendir "/tmp/bind/srv/data" failed: '
+                            'Permission denied (13)')
+        return 23
+
+    with mock.patch.object(backup, '_runcmd', side_effect=runcmd), \
+            mock.patch('time.sleep'):
+        backup._rsync('/tmp/bind', '/dest/20180101-0000')
+    assert len(cmds) == 2
+    # --files-from turns off the recursion of -a
+    assert '-r' not in cmds[0]
+    assert '-r' in cmds[1]
+    assert backup.failed_paths == {}
+
+
+def test_rsync_retry_max_failures():
+    backup = ExternalBackup(mounts=[])
+    backup._configure({'retry': {'attempts': 0, 'max-failures': 1}})
+    backup.rsync = mock.MagicMock()
+    backup.rsync.get_exclude_include_args.return_value = []
+
+    def runcmd(cmd, ignore_exit_codes=None, stderr_lines=None):
+        stderr_lines.extend([
+            'rsync: read errors mapping "/tmp/bind/a": I/O error (5)',
+            'rsync: read errors mapping "/tmp/bind/b": I/O error (5)',
+        ])
+        return 23
+
+    with mock.patch.object(backup, '_runcmd', side_effect=runcmd):
+        with pytest.raises(Exception, match='2 paths failed'):
+            backup._rsync('/tmp/bind', '/dest', single=True)
+
+
+def test_rsync_physical_order():
+    backup = ExternalBackup(mounts=[])
+    backup._configure({'physical-order': {'batch-files': 2}})
+    backup.rsync = mock.MagicMock()
+    backup.rsync.get_exclude_include_args.return_value = []
+    files_from = []
+
+    def runcmd(cmd, stdout=None, ignore_exit_codes=None):
+        if '--dry-run' in cmd:
+            stdout.write('sending incremental file list\n'
+                         'changed: srv/\nchanged: srv/a\nchanged: srv/b\n'
+                         'changed: srv/c\n')
+        for arg in cmd:
+            if arg.startswith('--files-from='):
+                assert '--delete' not in cmd
+                with open(arg.split('=', 1)[1]) as f:
+                    files_from.append(f.read())
+
+    with mock.patch.object(backup, '_runcmd',
+                           side_effect=runcmd) as mock_runcmd, \
+            mock.patch('extbackup.backup.physical_order',
+                       return_value=['srv/c', 'srv/a', 'srv/b']) as mock_order:
+        backup._rsync('/tmp/bind', '/dest/20180101-0000')
+    mock_order.assert_called_once_with(
+        '/tmp/bind', ['srv/a', 'srv/b', 'srv/c'], method='fiemap')
+    assert files_from == ['srv/c\0srv/a\0', 'srv/b\0']
+    # The full pass runs last
+    assert '--delete' in mock_runcmd.call_args[0][0]
+    assert mock_runcmd.call_count == 4
+
+
+@pytest.mark.parametrize(['stop_at', 'exit_codes', 'expected_batches'], [
+    # The deadline passed before the batches started
+    ('2018-01-01T06:00', [0], 0),
+    # rsync stopped at the deadline during the first batch
+    ('2999-01-01T06:00', [0, 30], 1),
+])
+def test_rsync_physical_order_deadline(stop_at, exit_codes,
+                                       expected_batches):
+    backup = ExternalBackup(mounts=[])
+    backup._configure({'physical-order': {'batch-files': 1}})
+    backup.rsync = mock.MagicMock()
+    backup.rsync.get_exclude_include_args.return_value = []
+    backup.stop_at = stop_at
+    exit_codes = iter(exit_codes)
+
+    def runcmd(cmd, stdout=None, ignore_exit_codes=None):
+        if '--dry-run' in cmd:
+            stdout.write('changed: srv/a\nchanged: srv/b\n')
+        return next(exit_codes)
+
+    with mock.patch.object(backup, '_runcmd',
+                           side_effect=runcmd) as mock_runcmd, \
+            mock.patch('extbackup.backup.physical_order',
+                       return_value=['srv/a', 'srv/b']):
+        backup._rsync('/tmp/bind', '/dest/20180101-0000')
+    assert backup.unit_stopped
+    # Neither further batches nor the full pass run
+    assert mock_runcmd.call_count == 1 + expected_batches
+
+
+@pytest.mark.parametrize(['returncode', 'stopped'], [
+    (0, False),
+    (24, False),
+    (30, True),
+])
+def test_rsync_stopped(returncode, stopped):
+    backup = ExternalBackup(mounts=[])
+    backup._configure({})
+    backup.rsync = mock.MagicMock()
+    backup.rsync.get_exclude_include_args.return_value = []
+    backup.stop_at = '2018-01-02T06:00'
+    with mock.patch.object(backup, '_runcmd',
+                           return_value=returncode) as mock_runcmd:
+        backup._rsync('/tmp/bind', '/dest/20180102-0000')
+    assert mock_runcmd.call_args[1]['ignore_exit_codes'] == [24, 30]
+    assert backup.unit_stopped == stopped
+
+
+def test_rsync_native_copy(mock_ismount, mock_isdir, mock_mkdir):
+    profile = SourceProfile(name='web', root='/srv/web', target='web',
+                            config={})
+    backup = ProfileBackup(profile, {'native-copy': {'jobs': 2}})
+    backup._configure(backup.global_config)
+    backup.rsync = mock.MagicMock()
+    backup.rsync.get_exclude_include_args.return_value = [
+        '--exclude-from=/tmp/rsync-exclude']
+    backup.stop_at = '2018-01-02T06:00'
+    with mock.patch('extbackup.backup.LocalCopy') as mock_copy, \
+            mock.patch.object(backup, '_runcmd') as mock_runcmd:
+        mock_copy.return_value.run.return_value = {}
+        backup._rsync('/srv/web', '/dest/20180102-0000',
+                      link_dests=['/dest/20180101-0000'],
+                      args=['--filter=- /tmp/'])
+        mock_copy.return_value.run.return_value = {'a': 'I/O error'}
+        with pytest.raises(Exception):
+            backup._rsync('/srv/web', '/dest/20180102-0000')
+    mock_runcmd.assert_not_called()
+    assert mock_copy.call_args_list[0] == mock.call(
+        '/srv/web', '/dest/20180102-0000',
+        args=['--one-file-system', '--filter=- /tmp/',
+              '--exclude-from=/tmp/rsync-exclude'],
+        link_dests=['/dest/20180101-0000'], jobs=2,
+        stop_at='2018-01-02T06:00', pretend=False)
+    mock_copy.return_value.run.assert_called_with(files=None)
+
+
+def test_backup_profiles(mock_gethostname):
+    mock_gethostname.return_value = MOCK_HOSTNAME
+    backup = ExternalBackup(mounts=[])
+    backup._configure({'scheduler': {'concurrency': 2, 'bwlimit': '100M'}})
+    profiles = [SourceProfile('web', '/srv/web', 'containers/web', {}),
+                SourceProfile('db', '/srv/db', 'db', {})]
+    with mock.patch.object(ExternalBackup, '_backup_run') as mock_run, \
+            mock.patch.object(ProfileBackup, 'backup') as mock_backup, \
+            mock.patch('extbackup.backup.run_concurrently') as mock_run_all:
+        backup._backup_profiles('/tmp/bind', profiles)
+        tasks = mock_run_all.call_args[0][0]
+        assert [name for name, _ in tasks] == [MOCK_HOSTNAME, 'web', 'db']
+        assert mock_run_all.call_args[0][1] == 2
+        for _, task in tasks:
+            task()
+    mock_run.assert_called_once_with('/tmp/bind')
+    assert mock_backup.call_count == 2
+    assert backup.bwlimit == 100 * 1024 // 2
+
+
+def test_profile_backup(mock_ismount, mock_isdir, mock_mkdir):
+    mock_ismount.return_value = True
+    mock_isdir.return_value = False
+    profile = SourceProfile('web', '/srv/web', 'containers/web',
+                            {'include': '/**'})
+    backup = ProfileBackup(profile, {})
+    assert backup.mounts == []
+    assert backup.name == 'web'
+    with mock.patch('os.makedirs') as mock_makedirs:
+        assert backup.target == os.path.join(MOUNT_DIR, 'containers', 'web')
+        mock_makedirs.assert_called_once_with(
+            os.path.join(MOUNT_DIR, 'containers'), 0o0700)
+    mock_mkdir.assert_called_once_with(backup.target)
+    assert [phase for phase, _ in backup._phases()] == ['versioned']
+    backup.rsync = mock.MagicMock()
+    backup.rsync.get_exclude_include_args.return_value = []
+    assert '--one-file-system' in backup._rsync_cmd('/srv/web', '/dest')
+
+
+def test_backup_dumps(mock_gethostname):
+    mock_gethostname.return_value = MOCK_HOSTNAME
+    backup = ExternalBackup(mounts=[])
+    backup._configure({})
+    backup._target = os.path.join(MOUNT_DIR, MOCK_HOSTNAME)
+    providers = [mock.MagicMock(), mock.MagicMock()]
+    providers[0].name = 'mysql'
+    providers[1].name = 'postgresql'
+    with mock.patch('extbackup.backup.dump_providers',
+                    return_value=providers):
+        backup._backup_dumps()
+    for provider in providers:
+        provider.dump.assert_called_once_with()
+    assert backup.report.get('dump-mysql', 'seconds') is not None
+    assert backup.report.get('dump-postgresql', 'seconds') is not None
+
+
+def test_backup_dumps_chunk_gc(real_mkdir, tmp_path):
+    backup = ExternalBackup(mounts=[])
+    backup._configure({'chunk-store': True})
+    backup._target = str(tmp_path)
+    backup.snapshot = str(tmp_path / '20180102-0000')
+    for name in ['20180101-0000', '20180102-0000']:
+        (tmp_path / name / 'mysql').mkdir(parents=True)
+    recipe = tmp_path / '20180101-0000' / 'mysql' / 'mysqldump.sql.recipe'
+    recipe.write_text('')
+    with mock.patch('extbackup.backup.dump_providers', return_value=[]), \
+            mock.patch('extbackup.backup.ChunkStore.gc',
+                       return_value=(2, 100)) as mock_gc:
+        backup._backup_dumps()
+    assert list(mock_gc.call_args[0][0]) == [str(recipe)]
+    assert backup.report.get('chunk-store', 'removed_chunks') == 2
+    assert backup.report.get('chunk-store', 'freed_bytes') == 100
+
+
+def test_backup_versioned_shards(mock_gethostname):
+    mock_gethostname.return_value = MOCK_HOSTNAME
+    backup = ExternalBackup(mounts=[])
+    backup._configure({'sharding': {'paths': ['/srv'], 'jobs': 2}})
+    backup._target = os.path.join(MOUNT_DIR, MOCK_HOSTNAME)
+    backup.pretend = True
+    backup.snapshot = os.path.join(backup._target, '20180101-0000')
+    backup.rsync = mock.MagicMock()
+    backup.rsync.get_exclude_include_args.return_value = []
+    plans = [ShardPlan('/srv', [['a'], ['b', 'c']])]
+    with mock.patch.object(backup, '_runcmd') as mock_runcmd, \
+            mock.patch.object(ShardPlanner, 'plan', return_value=plans):
+        backup._backup_versioned('/tmp/bind')
+    cmds = [c[0][0] for c in mock_runcmd.call_args_list]
+    assert len(cmds) == 3
+    assert '--filter=H /srv/*' in cmds[0]
+    shard_filters = sorted(
+        [arg for arg in cmd if arg.startswith('--filter=H /srv/')]
+        for cmd in cmds[1:])
+    assert shard_filters == [['--filter=H /srv/a'],
+                             ['--filter=H /srv/b', '--filter=H /srv/c']]
+    assert backup.report.get('versioned', 'shards') == 2
+
+
+def test_runcmd_cgroup():
+    backup = ExternalBackup(mounts=[])
+    backup.cgroup = mock.MagicMock()
+    backup.cgroup.wrap.return_value = ['sh', '-c', 'wrapped']
+    backup.cgroup_leaf = '/sys/fs/cgroup/extbackup-1/testhost1-versioned'
+    with mock.patch('subprocess.check_call') as mock_call:
+        backup._runcmd(['rsync'])
+    backup.cgroup.wrap.assert_called_once_with(backup.cgroup_leaf, ['rsync'])
+    assert mock_call.call_args[0][0] == ['sh', '-c', 'wrapped']
+
+
+def test_backup_run_deadline(mock_gethostname, mock_isdir):
+    mock_gethostname.return_value = MOCK_HOSTNAME
+    mock_isdir.return_value = True
+    deadline = datetime.datetime.now() + datetime.timedelta(minutes=10)
+    backup = ExternalBackup(mounts=[], pretend=True, deadline=deadline)
+    backup._configure({'schedule': {'priorities': ['/srv/db']}})
+    backup._target = os.path.join(MOUNT_DIR, MOCK_HOSTNAME)
+    backup.rsync = mock.MagicMock()
+    backup.rsync.get_exclude_include_args.return_value = []
+
+    def start_snapshot():
+        backup.snapshot = os.path.join(backup.target, '20180102-0000')
+        backup.link_dests = [os.path.join(backup.target, '20180101-0000')]
+        backup.scheduler = DeadlineScheduler(
+            deadline, backup.target, estimates={'single': 3600})
+        backup.scheduler.state = {}
+
+    with mock.patch.object(backup, '_start_snapshot',
+                           side_effect=start_snapshot), \
+            mock.patch.object(backup, '_runcmd') as mock_runcmd, \
+            mock.patch.object(backup, '_backup_single') as mock_single, \
+            mock.patch.object(backup, '_backup_dumps') as mock_dumps:
+        backup._backup_run('/tmp/bind')
+    mock_single.assert_not_called()
+    mock_dumps.assert_called_once_with()
+    priority_cmd, versioned_cmd = [c[0][0] for c in
+                                   mock_runcmd.call_args_list]
+    assert not any(arg.startswith('--stop-at') for arg in priority_cmd)
+    assert '--filter=+ /srv/db/' in priority_cmd
+    assert '--stop-at={}'.format(deadline.strftime('%Y-%m-%dT%H:%M')) in \
+        versioned_cmd
+    assert '--filter=H /srv/db/*' in versioned_cmd
+    assert mock_runcmd.call_args_list[1][1]['ignore_exit_codes'] == [24, 30]
+    assert backup.report.order[:2] == ['versioned:/srv/db', 'versioned']
+    assert backup.report.get('schedule', 'partial') is True
+    assert backup.report.get('schedule', 'skipped') == ['single']
+
+
+def test_backup_versioned_tiers(real_mkdir, tmp_path):
+    prev_snapshot = tmp_path / '20180101-0000'
+    (prev_snapshot / 'root' / 'usr' / 'lib').mkdir(parents=True)
+    (prev_snapshot / 'root' / 'usr' / 'lib' / 'libc.so').write_text('libc')
+    (tmp_path / TIER_STATE_FILE).write_text(
+        'weekly: {}\n'.format(datetime.date.today().isoformat()))
+    backup = ExternalBackup(mounts=[])
+    backup._configure({'tiers': {'weekly': {'interval': 7,
+                                            'paths': ['/root/usr']}}})
+    backup._target = str(tmp_path)
+    backup.snapshot = str(tmp_path / '20180102-0000')
+    backup.link_dests = [str(prev_snapshot)]
+    backup.rsync = mock.MagicMock()
+    backup.rsync.get_exclude_include_args.return_value = []
+    run_rsync = mock.MagicMock()
+
+    def runcmd(cmd, **kwargs):
+        if 'rsync' in cmd:
+            return run_rsync(cmd)
+        subprocess.check_call(cmd)
+
+    with mock.patch.object(backup, '_runcmd', side_effect=runcmd):
+        backup._backup_versioned('/tmp/bind')
+    assert '--filter=H /root/usr/*' in run_rsync.call_args[0][0]
+    copy = tmp_path / '20180102-0000' / 'root' / 'usr' / 'lib' / 'libc.so'
+    assert copy.read_text() == 'libc'
+    assert copy.stat().st_ino == \
+        (prev_snapshot / 'root' / 'usr' / 'lib' / 'libc.so').stat().st_ino
+    assert backup.report.get('versioned', 'carried_tiers') == ['weekly']
+
+
+@pytest.mark.parametrize('stopped,failed,saved', [
+    (False, {}, True),
+    (True, {}, False),
+    (False, {'versioned': {'/etc/shadow': 'Permission denied'}}, False),
+    (False, {'single': {'/etc/shadow': 'Permission denied'}}, True),
+])
+def test_save_tiers(real_mkdir, tmp_path, stopped, failed, saved):
+    backup = ExternalBackup(mounts=[])
+    backup._configure({'tiers': {'weekly': {'interval': 7,
+                                            'paths': ['/root/usr']}}})
+    backup._target = str(tmp_path)
+    backup.scheduler = DeadlineScheduler(None, str(tmp_path))
+    backup.tier_schedule = TierSchedule(
+        str(tmp_path), load_tiers(backup._tiers_config()))
+    backup.scheduler.finished('versioned', stopped=stopped)
+    backup.failed_paths = failed
+    backup._save_tiers()
+    assert (tmp_path / TIER_STATE_FILE).exists() == saved
+
+
+def test_backup_versioned_packs(real_mkdir, tmp_path):
+    bind_dir = tmp_path / 'bind'
+    (bind_dir / 'root' / 'mail' / 'cur').mkdir(parents=True)
+    (bind_dir / 'root' / 'mail' / 'cur' / '1.eml').write_text('one')
+    backup = ExternalBackup(mounts=[])
+    backup._configure({'packs': {'paths': ['/root/mail', '/root/missing']}})
+    backup._target = str(tmp_path)
+    backup.rsync = mock.MagicMock()
+    backup.rsync.get_exclude_include_args.return_value = []
+    backup.link_dests = []
+    snapshots = []
+    for name in ['20180101-0000', '20180102-0000', '20180103-0000']:
+        backup.snapshot = str(tmp_path / name)
+        with mock.patch.object(backup, '_runcmd') as runcmd:
+            backup._backup_versioned(str(bind_dir))
+        assert '--filter=H /root/mail/*' in runcmd.call_args[0][0]
+        snapshots.append(backup.report.get('versioned', 'packs_rebuilt'))
+        backup.link_dests = [backup.snapshot]
+        if len(snapshots) == 1:
+            (bind_dir / 'root' / 'mail' / 'cur' / '2.eml').write_text('two')
+    assert snapshots == [['/root/mail'], ['/root/mail'], []]
+    assert backup.report.get('versioned', 'packs_linked') == ['/root/mail']
+    assert os.path.samefile(
+        str(tmp_path / '20180102-0000' / 'packs' / 'root' / 'mail.tar'),
+        str(tmp_path / '20180103-0000' / 'packs' / 'root' / 'mail.tar'))
+
+    dest = tmp_path / 'restore'
+    assert backup.extract('20180103-0000', '/root/mail/cur/2.eml',
+                          str(dest)) == ['cur/2.eml']
+    assert (dest / 'cur' / '2.eml').read_text() == 'two'
+
+
+def test_backup_versioned_packs_filtered(real_mkdir, tmp_path):
+    bind_dir = tmp_path / 'bind'
+    for path in ['root/mail/cur', 'root/mail/.cache', 'root/skipped/mail']:
+        (bind_dir / path).mkdir(parents=True)
+    (bind_dir / 'root' / 'mail' / 'cur' / '1.eml').write_text('one')
+    (bind_dir / 'root' / 'mail' / 'cur' / '1.eml.bak').write_text('old')
+    (bind_dir / 'root' / 'mail' / '.cache' / 'index').write_text('index')
+    exclude_file = tmp_path / 'rsync-exclude'
+    exclude_file.write_text('*.bak\n/root/skipped/\n')
+    backup = ExternalBackup(mounts=[])
+    backup._configure({'packs': {'paths': ['/root/mail',
+                                           '/root/skipped/mail']}})
+    backup._target = str(tmp_path)
+    backup.snapshot = str(tmp_path / '20180101-0000')
+    backup.rsync = mock.MagicMock()
+    # Cache directories are excluded through the same filter files
+    backup.rsync.get_exclude_include_args.return_value = [
+        '--exclude-from={}'.format(exclude_file),
+        '--filter=- /root/mail/.cache/']
+    backup._backup_packs(str(bind_dir), None)
+    assert backup.report.get('versioned', 'packs_rebuilt') == ['/root/mail']
+    pack = DirectoryPack(backup.snapshot, '/root/mail')
+    assert [name for _, _, name in pack.members()] == ['cur', 'cur/1.eml']
+
+
+def test_remote_target(mock_gethostname, real_mkdir, tmp_path):
+    mock_gethostname.return_value = MOCK_HOSTNAME
+    backup = ExternalBackup(mounts=[])
+    backup._configure({})
+    backup.remote = RemoteTarget('ssh://backup@server/srv/backups',
+                                 state_dir=str(tmp_path))
+    backup.rsync = mock.MagicMock()
+    backup.rsync.get_exclude_include_args.return_value = []
+    assert backup.target == str(tmp_path / MOCK_HOSTNAME)
+    storage = '/srv/backups/{}'.format(MOCK_HOSTNAME)
+    with mock.patch.object(backup.remote, 'list_dirs',
+                           return_value=['20180101-0000', 'single']), \
+            mock.patch.object(backup.remote, 'fetch', return_value=None), \
+            mock.patch.object(backup.remote, 'makedirs') as mock_makedirs:
+        backup._start_snapshot()
+    mock_makedirs.assert_called_once_with(backup.snapshot)
+    assert os.path.dirname(backup.snapshot) == storage
+    assert backup.link_dests == [storage + '/20180101-0000']
+    # Snapshots are linked on the server, relative to the destination
+    cmd = backup._rsync_cmd('/tmp/bind', backup.snapshot,
+                            link_dests=backup.link_dests)
+    assert '--link-dest=../20180101-0000' in cmd
+    assert cmd[-4:] == ['-e', 'ssh', '/tmp/bind/',
+                        'backup@server:' + backup.snapshot]
+
+    entries = [('/root/etc/hosts', 12, 100, 1515000000000000000)]
+    with mock.patch.object(backup.remote, 'walk',
+                           return_value=entries) as mock_walk:
+        backup._update_catalog('20180101-0000', storage + '/20180101-0000')
+    mock_walk.assert_called_once_with(storage + '/20180101-0000')
+    assert [row[0] for row in backup.find_versions('/root/*')] == \
+        ['/root/etc/hosts']
+
+
+def test_update_catalog_pretend(real_mkdir, tmp_path):
+    backup = ExternalBackup(pretend=True, mounts=[])
+    backup._target = str(tmp_path)
+    backup._update_catalog('20180101-0000', str(tmp_path / '20180101-0000'))
+    assert os.listdir(str(tmp_path)) == []
+    assert backup.find_versions('/root/*') == []
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_open_target_remote(mock_gethostname, real_mkdir, tmp_path):
+    mock_gethostname.return_value = MOCK_HOSTNAME
+    backup = ExternalBackup(config={'remote': {
+        'url': 'ssh://backup@server/srv/backups',
+        'state-dir': str(tmp_path)}})
+    with mock.patch.object(RemoteTarget, '__enter__') as mock_enter, \
+            mock.patch.object(RemoteTarget, '__exit__'), \
+            mock.patch.object(RemoteTarget, 'pull_state') as mock_pull:
+        mock_enter.side_effect = lambda: backup.remote
+        with backup.open_target('versions', remote=True):
+            mock_pull.assert_called_once_with(
+                '/srv/backups/{}'.format(MOCK_HOSTNAME),
+                str(tmp_path / MOCK_HOSTNAME))
+            assert backup.find_versions('/root/*') == []
+        with pytest.raises(Exception) as e:
+            with backup.open_target('usage'):
+                pass
+    assert str(e.value) == 'usage is not supported with a remote target'
+
+
+def test_open_target_local(tmp_path):
+    backup = ExternalBackup(config_file=str(tmp_path / 'missing'))
+    with backup.open_target('usage'):
+        assert backup.remote is None
+
+
+def test_remote_target_unsupported():
+    backup = ExternalBackup(mounts=[])
+    backup._configure({'tiers': {}})
+    backup._check_remote()
+    backup._configure({'native-copy': True, 'packs': {'paths': ['/srv']}})
+    with pytest.raises(Exception) as e:
+        backup._check_remote()
+    assert str(e.value) == \
+        'native-copy, packs not supported with a remote target'
@@ -0,0 +1,67 @@
+from unittest import mock
+
+from extbackup.cachedirs import CACHEDIR_SIGNATURE
+from extbackup.cachedirs import CACHEDIR_TAG
+from extbackup.cachedirs import CacheDirScanner
+from extbackup.cachedirs import directory_size
+
+
+def _tree(root):
+    (root / 'home' / '.cache' / 'pip').mkdir(parents=True)
+    (root / 'home' / '.cache' / CACHEDIR_TAG).write_bytes(
+        CACHEDIR_SIGNATURE + b'\n# Cache directory\n')
+    (root / 'home' / '.cache' / 'pip' / 'wheel').write_bytes(b'x' * 1000)
+    (root / 'home' / 'notcache').mkdir()
+    (root / 'home' / 'notcache' / CACHEDIR_TAG).write_text('no signature')
+    (root / 'srv' / 'app' / 'build').mkdir(parents=True)
+    (root / 'srv' / 'app' / 'build' / '.nobackup').write_text('')
+    (root / 'srv' / 'app' / 'build' / 'out.o').write_bytes(b'x' * 500)
+
+
+def test_directory_size(tmp_path):
+    _tree(tmp_path)
+    assert directory_size(str(tmp_path / 'srv')) == 500
+
+
+def test_scan(tmp_path):
+    root = tmp_path / 'root'
+    root.mkdir()
+    _tree(root)
+    (root / '.nobackup').write_text('')
+    scanner = CacheDirScanner(str(tmp_path / 'scan.sqlite'),
+                              markers=['.nobackup'])
+    assert scanner.scan(str(root)) == [
+        ('home/.cache', CACHEDIR_TAG, len(CACHEDIR_SIGNATURE) + 19 + 1000),
+        ('srv/app/build', '.nobackup', 500),
+    ]
+    assert CacheDirScanner(str(tmp_path / 'x.sqlite')).scan(str(root)) == [
+        ('home/.cache', CACHEDIR_TAG, len(CACHEDIR_SIGNATURE) + 19 + 1000)]
+
+
+def test_scan_cache(tmp_path):
+    root = tmp_path / 'root'
+    root.mkdir()
+    _tree(root)
+    cache_file = str(tmp_path / 'scan.sqlite')
+    scanner = CacheDirScanner(cache_file, markers=['.nobackup'])
+    expected = scanner.scan(str(root))
+    scanner.save()
+
+    scanner = CacheDirScanner(cache_file, markers=['.nobackup'])
+    scanner.load()
+    with mock.patch.object(scanner, '_inspect',
+                           wraps=scanner._inspect) as mock_inspect:
+        assert scanner.scan(str(root)) == expected
+    mock_inspect.assert_not_called()
+
+    # Only directories whose mtime changed are read again
+    (root / 'srv' / 'app' / 'dist').mkdir()
+    (root / 'srv' / 'app' / 'dist' / '.nobackup').write_text('')
+    scanner = CacheDirScanner(cache_file, markers=['.nobackup'])
+    scanner.load()
+    with mock.patch.object(scanner, '_inspect',
+                           wraps=scanner._inspect) as mock_inspect:
+        assert [path for path, _, _ in scanner.scan(str(root))] == [
+            'home/.cache', 'srv/app/build', 'srv/app/dist']
+    assert sorted(c[0][0] for c in mock_inspect.call_args_list) == [
+        str(root / 'srv' / 'app'), str(root / 'srv' / 'app' / 'dist')]
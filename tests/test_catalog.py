@@ -0,0 +1,112 @@
+import os
+import sqlite3
+
+import pytest
+
+from extbackup.catalog import Catalog
+
+
+def _write(path, contents):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(contents)
+
+
+@pytest.fixture
+def snapshots(tmp_path):
+    first = str(tmp_path / '20180101-0000')
+    second = str(tmp_path / '20180102-0000')
+    third = str(tmp_path / '20180103-0000')
+    _write(os.path.join(first, 'root', 'etc', 'hosts'), 'hosts')
+    _write(os.path.join(first, 'root', 'etc', 'nginx', 'nginx.conf'), 'v1')
+    # Second snapshot hard-links unchanged files and adds a new version
+    os.makedirs(os.path.join(second, 'root', 'etc', 'nginx'))
+    os.link(os.path.join(first, 'root', 'etc', 'hosts'),
+            os.path.join(second, 'root', 'etc', 'hosts'))
+    _write(os.path.join(second, 'root', 'etc', 'nginx', 'nginx.conf'), 'v2')
+    # Third snapshot hard-links everything from the second
+    os.makedirs(os.path.join(third, 'root', 'etc', 'nginx'))
+    for fn in ['hosts', os.path.join('nginx', 'nginx.conf')]:
+        os.link(os.path.join(second, 'root', 'etc', fn),
+                os.path.join(third, 'root', 'etc', fn))
+    return [first, second, third]
+
+
+def test_catalog_versions(tmp_path, snapshots):
+    with Catalog(str(tmp_path / 'catalog.sqlite')) as catalog:
+        for snapshot in snapshots:
+            catalog.add_snapshot(os.path.basename(snapshot), snapshot)
+        assert catalog.snapshots() == [os.path.basename(s)
+                                       for s in snapshots]
+        nginx = catalog.find('/root/etc/nginx/*')
+        assert [(row[0], row[2], row[4], row[5]) for row in nginx] == [
+            ('/root/etc/nginx/nginx.conf', 2,
+             '20180101-0000', '20180101-0000'),
+            ('/root/etc/nginx/nginx.conf', 2,
+             '20180102-0000', '20180103-0000'),
+        ]
+        hosts = catalog.find('*/hosts')
+        assert [(row[0], row[4], row[5]) for row in hosts] == [
+            ('/root/etc/hosts', '20180101-0000', '20180103-0000'),
+        ]
+
+
+def test_catalog_incremental(tmp_path, snapshots):
+    db_file = str(tmp_path / 'catalog.sqlite')
+    with Catalog(db_file) as catalog:
+        for snapshot in snapshots[:2]:
+            catalog.add_snapshot(os.path.basename(snapshot), snapshot)
+    with Catalog(db_file) as catalog:
+        catalog.add_snapshot(os.path.basename(snapshots[2]), snapshots[2])
+        count = catalog.db.execute('SELECT COUNT(*) FROM versions')
+        assert count.fetchone()[0] == 3
+
+
+def test_catalog_open_ranges(tmp_path, snapshots):
+    with Catalog(str(tmp_path / 'catalog.sqlite')) as catalog:
+        for snapshot in snapshots[:2]:
+            catalog.add_snapshot(os.path.basename(snapshot), snapshot)
+        query = ('SELECT p.path, v.last_snapshot FROM versions v '
+                 'JOIN paths p ON p.id = v.path_id ORDER BY v.id')
+        rows = catalog.db.execute(query).fetchall()
+        # Nothing changed, so no version is written
+        catalog.add_snapshot(os.path.basename(snapshots[2]), snapshots[2])
+        assert catalog.db.execute(query).fetchall() == rows
+        assert rows == [('/root/etc/hosts', None),
+                        ('/root/etc/nginx/nginx.conf', 1),
+                        ('/root/etc/nginx/nginx.conf', None)]
+
+
+def test_catalog_read_only(tmp_path, snapshots):
+    db_file = str(tmp_path / 'catalog.sqlite')
+    with Catalog(db_file) as catalog:
+        catalog.add_snapshot('20180101-0000', snapshots[0])
+    with Catalog(db_file, read_only=True) as catalog:
+        assert len(catalog.find('*/hosts')) == 1
+        with pytest.raises(sqlite3.OperationalError):
+            catalog.add_snapshot('20180102-0000', snapshots[1])
+
+
+def test_catalog_duplicate_snapshot(tmp_path, snapshots):
+    with Catalog(str(tmp_path / 'catalog.sqlite')) as catalog:
+        catalog.add_snapshot('20180101-0000', snapshots[0])
+        with pytest.raises(Exception):
+            catalog.add_snapshot('20180101-0000', snapshots[0])
+
+
+def test_catalog_churn(tmp_path, snapshots):
+    with Catalog(str(tmp_path / 'catalog.sqlite')) as catalog:
+        catalog.add_snapshot('20180101-0000', snapshots[0])
+        assert catalog.churn(5, 0) == []
+        for snapshot in snapshots[1:]:
+            catalog.add_snapshot(os.path.basename(snapshot), snapshot)
+        assert catalog.churn(5, 0) == [
+            ('/root/etc/hosts', 5, 0),
+            ('/root/etc/nginx/nginx.conf', 2, 1),
+        ]
+        assert catalog.churn(5, 3) == [('/root/etc/hosts', 5, 0)]
+        # Only changes within the window are counted
+        assert catalog.churn(2, 0) == [
+            ('/root/etc/hosts', 5, 0),
+            ('/root/etc/nginx/nginx.conf', 2, 0),
+        ]
@@ -0,0 +1,101 @@
+import os
+import subprocess
+from unittest import mock
+
+import pytest
+
+from extbackup.cgroup import BackupCgroup
+from extbackup.cgroup import parse_io_stat
+from extbackup.report import Report
+
+MOCK_IO_STAT = '''8:0 rbytes=1000 wbytes=200 rios=10 wios=2 dbytes=0 dios=0
+8:16 rbytes=500 wbytes=300 rios=5 wios=3 dbytes=0 dios=0
+'''
+
+
+def _make_cgroup(path, mkdir=os.mkdir):
+    mkdir(path)
+    with open(os.path.join(path, 'cgroup.controllers'), 'w') as f:
+        f.write('cpu io memory pids\n')
+    for name in ['cgroup.subtree_control', 'cgroup.procs']:
+        open(os.path.join(path, name), 'w').close()
+
+
+@pytest.fixture
+def cgroup_dir(tmp_path):
+    root = str(tmp_path / 'cgroup')
+    _make_cgroup(root)
+    real_rmdir = os.rmdir
+
+    def rmdir(path):
+        if path.startswith(root):
+            for entry in os.listdir(path):
+                os.unlink(os.path.join(path, entry))
+        real_rmdir(path)
+
+    with mock.patch('os.mkdir', side_effect=_make_cgroup), \
+            mock.patch('os.rmdir', side_effect=rmdir), \
+            mock.patch.object(BackupCgroup, '_current', return_value=root):
+        yield root
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def test_parse_io_stat():
+    assert parse_io_stat(MOCK_IO_STAT) == {'rbytes': 1500, 'wbytes': 500}
+    assert parse_io_stat('') == {'rbytes': 0, 'wbytes': 0}
+
+
+def test_from_config(tmp_path):
+    assert BackupCgroup.from_config(None) is None
+    with mock.patch.object(BackupCgroup, 'available', return_value=False):
+        assert BackupCgroup.from_config({'cpu-weight': 10}) is None
+    cgroup = BackupCgroup(memory_high='2G', io_weight=10, cpu_weight=20,
+                          cgroup_dir=str(tmp_path))
+    assert cgroup.limits == {
+        'memory.high': str(2 * 1024 ** 3),
+        'io.weight': 'default 10',
+        'cpu.weight': '20',
+    }
+
+
+def test_io_max():
+    with mock.patch('os.stat') as mock_stat:
+        mock_stat.return_value.st_rdev = os.makedev(8, 16)
+        cgroup = BackupCgroup(io_max={'/dev/sdb': 'rbps=50M wiops=100'})
+    assert cgroup.limits['io.max'] == ['8:16 rbps=52428800 wiops=100']
+
+
+def test_cgroup(cgroup_dir):
+    cgroup = BackupCgroup(memory_high='1G', cpu_weight=20,
+                          cgroup_dir=cgroup_dir)
+    report = Report('testhost1')
+    with cgroup:
+        assert _read(os.path.join(cgroup_dir, 'cgroup.subtree_control')) \
+            == '+cpu +io +memory'
+        assert _read(os.path.join(cgroup.path, 'memory.high')) == \
+            str(1024 ** 3)
+        assert _read(os.path.join(cgroup.path, 'cgroup.subtree_control')) \
+            == '+cpu +io +memory'
+        assert _read(os.path.join(cgroup.path, 'main', 'cgroup.procs')) == \
+            str(os.getpid())
+        with cgroup.phase('testhost1-versioned', report, 'versioned') as leaf:
+            with open(os.path.join(leaf, 'memory.peak'), 'w') as f:
+                f.write('4096\n')
+            with open(os.path.join(leaf, 'io.stat'), 'w') as f:
+                f.write(MOCK_IO_STAT)
+            output = subprocess.check_output(
+                cgroup.wrap(leaf, ['echo', 'done']),
+                universal_newlines=True)
+            assert output == 'done\n'
+            assert _read(os.path.join(leaf, 'cgroup.procs')).strip() \
+                .isdigit()
+        assert not os.path.exists(leaf)
+    assert not os.path.exists(cgroup.path)
+    assert _read(os.path.join(cgroup_dir, 'cgroup.procs')) == \
+        str(os.getpid())
+    assert report.phases['versioned'] == {
+        'memory_peak_bytes': 4096, 'read_bytes': 1500, 'write_bytes': 500}
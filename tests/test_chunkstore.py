@@ -0,0 +1,133 @@
+import io
+import os
+import random
+import zlib
+
+import pytest
+
+from extbackup.chunkstore import RECIPE_HEADER
+from extbackup.chunkstore import ChunkStore
+
+
+def _dump(rows, seed=1):
+    rng = random.Random(seed)
+    return b''.join(
+        '({},\'{}\')'.format(i, rng.getrandbits(64)).encode() +
+        (b';\n' if i % 50 == 49 else b',')
+        for i in range(rows))
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ChunkStore(str(tmp_path / '.chunks'), min_size=1024,
+                      max_size=16384, mask_bits=4)
+
+
+def _write(store, tmp_path, name, data):
+    recipe = str(tmp_path / name)
+    total, new = store.write(io.BytesIO(data), recipe)
+    return recipe, total, new
+
+
+def test_round_trip(store, tmp_path):
+    data = _dump(5000)
+    recipe, total, new = _write(store, tmp_path, 'a.recipe', data)
+    assert total == new == len(data)
+    with open(recipe) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == RECIPE_HEADER
+    sizes = [int(line.split()[1]) for line in lines[1:]]
+    assert sum(sizes) == len(data)
+    assert all(size <= 16384 for size in sizes)
+    assert all(size >= 1024 for size in sizes[:-1])
+    output = io.BytesIO()
+    store.cat(recipe, output)
+    assert output.getvalue() == data
+
+
+def test_empty(store, tmp_path):
+    recipe, total, new = _write(store, tmp_path, 'empty.recipe', b'')
+    output = io.BytesIO()
+    store.cat(recipe, output)
+    assert output.getvalue() == b''
+    assert total == new == 0
+
+
+def test_dedup_after_insert(store, tmp_path):
+    data = _dump(5000)
+    _write(store, tmp_path, 'a.recipe', data)
+    middle = len(data) // 2
+    changed = data[:middle] + b'(-1,\'inserted\'),' + data[middle:]
+    recipe, total, new = _write(store, tmp_path, 'b.recipe', changed)
+    assert total == len(changed)
+    assert new < total // 10
+    output = io.BytesIO()
+    store.cat(recipe, output)
+    assert output.getvalue() == changed
+
+
+def test_boundaries_independent_of_reads(store):
+    data = _dump(2000)
+
+    class SmallReads(io.BytesIO):
+        def read(self, size=-1):
+            return super(SmallReads, self).read(min(size, 1000))
+
+    assert list(store.chunks(io.BytesIO(data))) == \
+        list(store.chunks(SmallReads(data)))
+
+
+def test_corrupt_chunk(store, tmp_path):
+    recipe, _, _ = _write(store, tmp_path, 'a.recipe', _dump(100))
+    with open(recipe) as f:
+        digest = f.read().splitlines()[1].split()[0]
+    chunk_file = os.path.join(store.store_dir, digest[:2], digest[2:])
+    with open(chunk_file, 'wb') as f:
+        f.write(zlib.compress(b'garbage'))
+    with pytest.raises(Exception):
+        store.cat(recipe, io.BytesIO())
+
+
+def test_gc(store, tmp_path):
+    old, _, _ = _write(store, tmp_path, 'old.recipe', _dump(3000, seed=1))
+    new, _, _ = _write(store, tmp_path, 'new.recipe', _dump(3000, seed=2))
+    # A temporary file left by an interrupted write
+    os.makedirs(os.path.join(store.store_dir, 'ab'), exist_ok=True)
+    with open(os.path.join(store.store_dir, 'ab', 'tmp1234'), 'wb') as f:
+        f.write(b'partial')
+    with open(old) as f:
+        old_digests = {line.split()[0] for line in f.read().splitlines()[1:]}
+    with open(new) as f:
+        new_digests = {line.split()[0] for line in f.read().splitlines()[1:]}
+    removed, freed = store.gc([new])
+    assert removed == len(old_digests - new_digests) + 1
+    assert freed > 0
+    output = io.BytesIO()
+    store.cat(new, output)
+    assert output.getvalue() == _dump(3000, seed=2)
+    with pytest.raises(OSError):
+        store.cat(old, io.BytesIO())
+    assert store.gc([new]) == (0, 0)
+
+
+def test_gc_missing_store(tmp_path):
+    store = ChunkStore(str(tmp_path / '.chunks'))
+    assert store.gc([]) == (0, 0)
+
+
+def test_gc_invalid_recipe(store, tmp_path):
+    recipe, _, _ = _write(store, tmp_path, 'a.recipe', _dump(100))
+    invalid = tmp_path / 'invalid.recipe'
+    invalid.write_text('not a recipe\n')
+    with pytest.raises(Exception):
+        store.gc([recipe, str(invalid)])
+    store.cat(recipe, io.BytesIO())
+
+
+def test_from_config(tmp_path):
+    assert ChunkStore.from_config(str(tmp_path), None) is None
+    store = ChunkStore.from_config(str(tmp_path), True)
+    assert store.store_dir == str(tmp_path / '.chunks')
+    store = ChunkStore.from_config(str(tmp_path), {'min-size': '64K',
+                                                   'max-size': '1M'})
+    assert (store.min_size, store.max_size) == (64 * 1024, 1024 * 1024)
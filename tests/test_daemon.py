@@ -0,0 +1,159 @@
+import errno
+import os
+from unittest import mock
+
+import pytest
+
+from extbackup.daemon import LUKS_MAGIC
+from extbackup.daemon import LUKS_UUID_OFFSET
+from extbackup.daemon import BackupDaemon
+from extbackup.daemon import CachedFile
+from extbackup.daemon import luks_uuid
+from extbackup.daemon import parse_uevent
+from extbackup.daemon import uevents
+
+MOCK_UUID = '0ad7e4a2-2a3b-4b6c-8d9e-0f1a2b3c4d5e'
+MOCK_CONFIG = '''
+include: |
+  /**
+
+daemon:
+  uuids:
+    - {}
+  key-file: /root/extbackup.key
+'''.format(MOCK_UUID)
+
+
+def _event(action='add', subsystem='block', devname='sdz1'):
+    return {'ACTION': action, 'SUBSYSTEM': subsystem, 'DEVNAME': devname}
+
+
+@pytest.fixture
+def config_file(tmp_path):
+    config_file = tmp_path / 'extbackup.yaml'
+    config_file.write_text(MOCK_CONFIG)
+    return str(config_file)
+
+
+@pytest.fixture
+def mock_fstab():
+    with mock.patch('extbackup.daemon.fstab_mount_points') as patched_object:
+        patched_object.return_value = ['/']
+        yield patched_object
+
+
+def test_parse_uevent():
+    data = b'\0'.join([
+        b'add@/devices/pci0000:00/usb1/1-1/block/sdz/sdz1',
+        b'ACTION=add',
+        b'DEVPATH=/devices/pci0000:00/usb1/1-1/block/sdz/sdz1',
+        b'SUBSYSTEM=block',
+        b'DEVNAME=sdz1',
+        b'DEVTYPE=partition',
+        b'',
+    ])
+    assert parse_uevent(data) == {
+        'ACTION': 'add',
+        'DEVPATH': '/devices/pci0000:00/usb1/1-1/block/sdz/sdz1',
+        'SUBSYSTEM': 'block',
+        'DEVNAME': 'sdz1',
+        'DEVTYPE': 'partition',
+    }
+
+
+def test_uevents_overflow():
+    sock = mock.MagicMock()
+    sock.recv.side_effect = [OSError(errno.ENOBUFS, 'No buffer space'),
+                             b'add@/block/sdy\0ACTION=add\0DEVNAME=sdy\0',
+                             OSError(errno.EBADF, 'Bad file descriptor')]
+    with mock.patch('socket.socket', return_value=sock), \
+            mock.patch('os.listdir', return_value=['sdz1', 'sda']):
+        events = uevents()
+        assert [event['DEVNAME'] for event in
+                [next(events), next(events), next(events)]] == \
+            ['sda', 'sdz1', 'sdy']
+        with pytest.raises(OSError):
+            next(events)
+    sock.close.assert_called_once_with()
+
+
+@pytest.mark.parametrize(['header', 'expected_uuid'], [
+    (LUKS_MAGIC + b'\0\2' + b'\0' * (LUKS_UUID_OFFSET - 8) +
+     MOCK_UUID.encode() + b'\0' * 4, MOCK_UUID),
+    (b'\0' * 512, None),
+])
+def test_luks_uuid(header, expected_uuid, tmp_path):
+    device = tmp_path / 'device'
+    device.write_bytes(header)
+    assert luks_uuid(str(device)) == expected_uuid
+
+
+def test_luks_uuid_missing(tmp_path):
+    assert luks_uuid(str(tmp_path / 'missing')) is None
+
+
+def test_cached_file(tmp_path):
+    loader = mock.MagicMock(side_effect=lambda f: open(f).read())
+    file_name = tmp_path / 'file'
+    file_name.write_text('one')
+    cached = CachedFile(str(file_name), loader)
+    assert cached.get() == 'one'
+    assert cached.get() == 'one'
+    assert loader.call_count == 1
+    file_name.write_text('two')
+    os.utime(str(file_name), ns=(0, 0))
+    assert cached.get() == 'two'
+    assert loader.call_count == 2
+
+
+@pytest.mark.parametrize(['event', 'uuid', 'expected_device'], [
+    (_event(), MOCK_UUID, '/dev/sdz1'),
+    (_event(), 'other-uuid', None),
+    (_event(), None, None),
+    (_event(action='remove'), MOCK_UUID, None),
+    (_event(subsystem='usb'), MOCK_UUID, None),
+])
+def test_run(event, uuid, expected_device, config_file, mock_fstab):
+    app = mock.MagicMock()
+    daemon = BackupDaemon(app, config_file, events=[event, event])
+    with mock.patch('os.path.exists', return_value=True), \
+            mock.patch('extbackup.daemon.luks_uuid', return_value=uuid):
+        daemon.run()
+    if not expected_device:
+        app.backup_device.assert_not_called()
+        return
+    assert app.backup_device.call_count == 2
+    app.backup_device.assert_called_with(
+        expected_device, config=daemon.config.get(), mounts=['/'],
+        key_file='/root/extbackup.key')
+    # The config and mount table are parsed once and reused between runs
+    mock_fstab.assert_called_once_with()
+
+
+def test_run_backup_failure(config_file, mock_fstab):
+    app = mock.MagicMock()
+    app.backup_device.side_effect = Exception('failed')
+    daemon = BackupDaemon(app, config_file, events=[_event(), _event()])
+    with mock.patch('os.path.exists', return_value=True), \
+            mock.patch('extbackup.daemon.luks_uuid', return_value=MOCK_UUID):
+        daemon.run()
+    assert app.backup_device.call_count == 2
+
+
+def test_run_no_uuids(tmp_path):
+    config_file = tmp_path / 'extbackup.yaml'
+    config_file.write_text('include: /**')
+    with pytest.raises(Exception):
+        BackupDaemon(mock.MagicMock(), str(config_file), events=[]).run()
+
+
+def test_run_rescan(config_file, mock_fstab):
+    app = mock.MagicMock()
+    rescan = dict(_event(), RESCAN='1')
+    daemon = BackupDaemon(app, config_file, events=[
+        _event(), rescan, _event(action='remove'), rescan])
+    with mock.patch('os.path.exists', return_value=True), \
+            mock.patch('extbackup.daemon.luks_uuid', return_value=MOCK_UUID):
+        daemon.run()
+    # The disk is only backed up again after being removed
+    assert app.backup_device.call_count == 2
@@ -0,0 +1,122 @@
+import os
+
+import pytest
+
+from extbackup.delta import HOLE_DIGEST
+from extbackup.delta import BlockIndex
+from extbackup.delta import DeltaCopy
+from extbackup.delta import data_segments
+from extbackup.delta import hash_blocks
+
+BLOCK_SIZE = 4096
+
+
+@pytest.fixture
+def paths(tmp_path):
+    return (str(tmp_path / 'source'), str(tmp_path / 'dest'),
+            str(tmp_path / 'index' / 'dest.idx'))
+
+
+def _write_blocks(path, blocks):
+    with open(path, 'wb') as f:
+        for block in blocks:
+            if block is None:
+                f.seek(BLOCK_SIZE, os.SEEK_CUR)
+            else:
+                f.write(block * BLOCK_SIZE)
+        f.truncate()
+
+
+def _copy(paths):
+    return DeltaCopy(*paths, block_size=BLOCK_SIZE, jobs=2).run()
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_data_segments_whole_file(paths):
+    _write_blocks(paths[0], [b'a', b'b'])
+    fd = os.open(paths[0], os.O_RDONLY)
+    try:
+        segments = list(data_segments(fd, 2 * BLOCK_SIZE))
+    finally:
+        os.close(fd)
+    assert segments[0][0] == 0
+    assert segments[-1][1] == 2 * BLOCK_SIZE
+
+
+def test_hash_blocks(paths):
+    _write_blocks(paths[0], [b'a', b'b', b'a'])
+    fd = os.open(paths[0], os.O_RDONLY)
+    try:
+        digests = hash_blocks(fd, 3 * BLOCK_SIZE, BLOCK_SIZE, jobs=2)
+    finally:
+        os.close(fd)
+    assert len(digests) == 3
+    assert digests[0] == digests[2] != digests[1]
+    assert HOLE_DIGEST not in digests
+
+
+def test_initial_copy(paths):
+    _write_blocks(paths[0], [b'a', b'b', b'c'])
+    os.utime(paths[0], ns=(1000000000, 2000000000))
+    assert _copy(paths) == 3 * BLOCK_SIZE
+    assert _read(paths[1]) == _read(paths[0])
+    assert os.stat(paths[1]).st_mtime_ns == 2000000000
+    index = BlockIndex.load(paths[2])
+    assert index.size == 3 * BLOCK_SIZE
+    assert len(index.digests) == 3
+
+
+def test_changed_block(paths):
+    _write_blocks(paths[0], [b'a', b'b', b'c'])
+    _copy(paths)
+    _write_blocks(paths[0], [b'a', b'x', b'c'])
+    assert _copy(paths) == BLOCK_SIZE
+    assert _read(paths[1]) == _read(paths[0])
+
+
+def test_unchanged(paths):
+    _write_blocks(paths[0], [b'a', b'b'])
+    _copy(paths)
+    assert _copy(paths) == 0
+
+
+def test_resize(paths):
+    _write_blocks(paths[0], [b'a', b'b', b'c'])
+    _copy(paths)
+    _write_blocks(paths[0], [b'a', b'b'])
+    assert _copy(paths) == 0
+    assert _read(paths[1]) == _read(paths[0])
+    _write_blocks(paths[0], [b'a', b'b', b'c', b'd'])
+    assert _copy(paths) == 2 * BLOCK_SIZE
+    assert _read(paths[1]) == _read(paths[0])
+
+
+def test_sparse(paths):
+    _write_blocks(paths[0], [b'a', None, None, b'b'])
+    _copy(paths)
+    assert _read(paths[1]) == _read(paths[0])
+    # Replace data with a hole
+    _write_blocks(paths[0], [None, None, None, b'b'])
+    _copy(paths)
+    assert _read(paths[1]) == _read(paths[0])
+
+
+def test_stale_index(paths):
+    _write_blocks(paths[0], [b'a', b'b'])
+    _copy(paths)
+    # Modify the target copy behind the index's back
+    _write_blocks(paths[1], [b'a', b'z'])
+    assert _copy(paths) == BLOCK_SIZE
+    assert _read(paths[1]) == _read(paths[0])
+
+
+def test_missing_index(paths):
+    _write_blocks(paths[0], [b'a', b'b'])
+    _copy(paths)
+    os.unlink(paths[2])
+    assert _copy(paths) == 0
+    assert BlockIndex.load(paths[2]) is not None
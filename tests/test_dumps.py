@@ -0,0 +1,127 @@
+import os
+import sqlite3
+from unittest import mock
+
+import pytest
+
+from extbackup import dumps
+
+
+def _runcmd(commands):
+    def runcmd(cmd, stdout=None):
+        commands.append(cmd)
+    return runcmd
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    snapshot = tmp_path / '20180101-0000'
+    snapshot.mkdir()
+    return str(snapshot)
+
+
+@pytest.mark.parametrize('config,which,expected', [
+    ({}, True, ['mysql']),
+    ({}, False, []),
+    ({'postgresql': {}, 'sqlite': {'databases': []}}, True,
+     ['mysql', 'postgresql', 'sqlite']),
+    ({'postgresql': None}, False, []),
+])
+def test_dump_providers(config, which, expected):
+    with mock.patch('shutil.which', return_value='/usr/bin/x' if which
+                    else None):
+        providers = dumps.dump_providers(config, '/target', '/snapshot',
+                                         None)
+    assert [provider.name for provider in providers] == expected
+
+
+def test_postgresql_dump(snapshot):
+    commands = []
+    provider = dumps.PostgresqlProvider(
+        '/target', snapshot, _runcmd(commands),
+        config={'jobs': 8, 'user': 'postgres'})
+    with mock.patch('subprocess.check_output',
+                    return_value='app\nwiki\n') as mock_output:
+        provider.dump()
+    assert mock_output.call_args[0][0][:4] == ['psql', '-At', '-U',
+                                               'postgres']
+    output_dir = os.path.join(snapshot, 'postgresql')
+    assert os.path.isdir(output_dir)
+    assert commands == [
+        ['pg_dumpall', '--globals-only', '-U', 'postgres',
+         '-f', os.path.join(output_dir, 'globals.sql')],
+        ['pg_dump', '-Fd', '-j', '8', '-U', 'postgres',
+         '-f', os.path.join(output_dir, 'app'), 'app'],
+        ['pg_dump', '-Fd', '-j', '8', '-U', 'postgres',
+         '-f', os.path.join(output_dir, 'wiki'), 'wiki'],
+    ]
+
+
+def test_postgresql_databases_configured():
+    provider = dumps.PostgresqlProvider('/target', '/snapshot', None,
+                                        config={'databases': ['app']})
+    with mock.patch('subprocess.check_output') as mock_output:
+        assert provider.databases() == ['app']
+    mock_output.assert_not_called()
+
+
+def test_sqlite_dump(tmp_path, snapshot):
+    source_dir = tmp_path / 'data'
+    source_dir.mkdir()
+    source = str(source_dir / 'app.db')
+    conn = sqlite3.connect(source)
+    conn.execute('CREATE TABLE t (x INTEGER)')
+    conn.executemany('INSERT INTO t VALUES (?)',
+                     [(i,) for i in range(5000)])
+    conn.commit()
+    # Keep the source open with a writer while copying
+    conn.execute('INSERT INTO t VALUES (-1)')
+    provider = dumps.SqliteProvider(
+        '/target', snapshot, None,
+        config={'databases': [str(source_dir / '*.db')]})
+    provider.PAGES_PER_STEP = 1
+    provider.STEP_SLEEP = 0
+    provider.dump()
+    conn.rollback()
+    conn.close()
+    dest = os.path.join(snapshot, 'sqlite', source.lstrip(os.sep))
+    copy = sqlite3.connect(dest)
+    assert copy.execute('SELECT COUNT(*), MIN(x) FROM t').fetchone() == \
+        (5000, 0)
+    copy.close()
+
+
+def test_sqlite_copy_special_characters(tmp_path):
+    # Characters with a meaning in URIs are quoted
+    source = str(tmp_path / 'app?mode=rwc#1 %20.db')
+    conn = sqlite3.connect(source)
+    conn.execute('CREATE TABLE t (x INTEGER)')
+    conn.commit()
+    conn.close()
+    dest = str(tmp_path / 'copy.db')
+    dumps.SqliteProvider('/target', str(tmp_path), None).copy(source, dest)
+    copy = sqlite3.connect(dest)
+    assert copy.execute('SELECT COUNT(*) FROM t').fetchone() == (0,)
+    copy.close()
+
+
+def test_provider_abstract():
+    with pytest.raises(TypeError):
+        dumps.DumpProvider('/target', '/snapshot', None)
+
+
+def test_recipe_files(tmp_path):
+    for path in ['20180101-0000/mysql/mysqldump.sql.gz.recipe',
+                 '20180101-0000/sqlite/srv/app.db.recipe',
+                 '20180101-0000/root/etc/other.recipe',
+                 '20180102-0000/postgresql/app/toc.dat.recipe',
+                 '20180102-0000/postgresql/app/toc.dat.recipe.tmp',
+                 '20180103-0000/postgresql/app/toc.dat.recipe']:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text('')
+    assert list(dumps.recipe_files(str(tmp_path), ['20180101-0000',
+                                                   '20180102-0000'])) == [
+        str(tmp_path / '20180101-0000/mysql/mysqldump.sql.gz.recipe'),
+        str(tmp_path / '20180101-0000/sqlite/srv/app.db.recipe'),
+        str(tmp_path / '20180102-0000/postgresql/app/toc.dat.recipe'),
+    ]
@@ -0,0 +1,120 @@
+import gzip
+import inspect
+import io
+import os
+import sys
+import tarfile
+from unittest import mock
+
+import pytest
+
+from extbackup.export import SnapshotExporter
+from extbackup.export import _LinkTargets
+from extbackup.export import walk_inode_order
+
+GZIP = ['gzip', '-c']
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    snapshot = tmp_path / '20180101-0000'
+    (snapshot / 'root' / 'etc').mkdir(parents=True)
+    (snapshot / 'root' / 'etc' / 'hosts').write_text('hosts')
+    (snapshot / 'root' / 'big').write_bytes(b'x' * 100000)
+    os.link(str(snapshot / 'root' / 'etc' / 'hosts'),
+            str(snapshot / 'root' / 'hosts-link'))
+    # A file hard-linked from outside the snapshot
+    (snapshot / 'root' / 'shared').write_text('shared')
+    os.link(str(snapshot / 'root' / 'shared'), str(tmp_path / 'other'))
+    os.symlink('etc/hosts', str(snapshot / 'root' / 'symlink'))
+    return snapshot
+
+
+def _read_members(files):
+    data = b''.join(gzip.open(f).read() for f in files)
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        return {m.name: m for m in tar.getmembers()}
+
+
+def test_walk_inode_order(snapshot):
+    paths = [os.path.relpath(e.path, str(snapshot))
+             for e in walk_inode_order(str(snapshot))]
+    assert sorted(paths) == sorted([
+        'root', 'root/etc', 'root/etc/hosts', 'root/big',
+        'root/hosts-link', 'root/shared', 'root/symlink'])
+    assert paths.index('root') < paths.index('root/etc') < \
+        paths.index('root/etc/hosts')
+
+
+def test_walk_inode_order_deep(tmp_path):
+    path = str(tmp_path)
+    for _ in range(100):
+        path = os.path.join(path, 'd')
+        os.mkdir(path)
+    limit = sys.getrecursionlimit()
+    # Leave less room than the tree's depth
+    sys.setrecursionlimit(len(inspect.stack()) + 50)
+    try:
+        entries = list(walk_inode_order(str(tmp_path)))
+    finally:
+        sys.setrecursionlimit(limit)
+    assert len(entries) == 100
+
+
+def test_link_targets():
+    targets = _LinkTargets({1})
+    targets[(1, 10)] = 'a'
+    targets[(2, 10)] = 'b'
+    assert (1, 10) in targets
+    assert (2, 10) not in targets
+
+
+def test_export(snapshot, tmp_path):
+    outfile = str(tmp_path / 'export.tar.gz')
+    files = SnapshotExporter(str(snapshot), outfile, compressor=GZIP).export()
+    assert files == [outfile]
+    members = _read_members(files)
+    base = '20180101-0000'
+    assert members[base].isdir()
+    assert members[base + '/root/big'].size == 100000
+    assert members[base + '/root/shared'].isreg()
+    assert members[base + '/root/symlink'].issym()
+    links = [m for m in members.values() if m.islnk()]
+    assert len(links) == 1
+    assert {links[0].name, links[0].linkname} == {
+        base + '/root/etc/hosts', base + '/root/hosts-link'}
+
+
+def test_export_members_not_kept(snapshot, tmp_path):
+    sizes = []
+    add = SnapshotExporter._add
+
+    def _add(self, tar, *args):
+        add(self, tar, *args)
+        sizes.append(len(tar.members))
+
+    with mock.patch.object(SnapshotExporter, '_add', _add):
+        SnapshotExporter(str(snapshot), str(tmp_path / 'export.tar.gz'),
+                         compressor=GZIP).export()
+    assert sizes == [0] * 7
+
+
+def test_export_chunked(snapshot, tmp_path):
+    outfile = str(tmp_path / 'export.tar.gz')
+    files = SnapshotExporter(str(snapshot), outfile, compressor=GZIP,
+                             chunk_size=10000, index=True).export()
+    assert len(files) > 1
+    assert files[0] == '{}.000'.format(outfile)
+    members = _read_members(files)
+    assert len(members) == 8
+    with open('{}.index'.format(outfile)) as f:
+        index = [line.rstrip('\n').split('\t') for line in f]
+    assert len(index) == 7
+    # Members can be read from their chunk using the index
+    for chunk, offset, size, name in index:
+        with gzip.open(files[int(chunk)]) as f:
+            f.seek(int(offset))
+            header = tarfile.TarInfo.frombuf(f.read(512), 'utf-8',
+                                             'surrogateescape')
+        if header.type != tarfile.XHDTYPE:
+            assert header.name == name
@@ -0,0 +1,108 @@
+import os
+
+import pytest
+import yaml
+
+from extbackup.flagprobe import FLAG_PROBE_FILE
+from extbackup.flagprobe import FlagProbe
+from extbackup.flagprobe import choose_flags
+from extbackup.flagprobe import flag_args
+from extbackup.flagprobe import mount_info
+from extbackup.flagprobe import scan
+
+MOUNTINFO = '''\
+22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw,errors=remount-ro
+30 22 8:2 / /home rw,relatime shared:2 - ext4 /dev/sda2 rw,noacl
+31 22 8:3 / /boot/efi rw,relatime shared:3 - vfat /dev/sda3 rw,fmask=0077
+32 22 8:4 / /mnt/my\\040disk rw shared:4 - xfs /dev/sdb1 rw
+'''
+
+
+def _xattrs_supported(path):
+    try:
+        os.setxattr(path, 'user.extbackup', b'1')
+        os.removexattr(path, 'user.extbackup')
+        return True
+    except OSError:
+        return False
+
+
+@pytest.fixture
+def mountinfo(tmp_path):
+    mountinfo_file = tmp_path / 'mountinfo'
+    mountinfo_file.write_text(MOUNTINFO)
+    return str(mountinfo_file)
+
+
+def test_mount_info(mountinfo):
+    assert mount_info('/home/user', mountinfo) == \
+        ('ext4', ['noacl', 'relatime', 'rw'])
+    assert mount_info('/boot/efi', mountinfo)[0] == 'vfat'
+    assert mount_info('/boot', mountinfo)[0] == 'ext4'
+    assert mount_info('/mnt/my disk/a', mountinfo)[0] == 'xfs'
+
+
+def test_scan(tmp_path):
+    (tmp_path / 'a' / 'b').mkdir(parents=True)
+    (tmp_path / 'a' / 'b' / 'file').write_text('file')
+    (tmp_path / 'c').write_text('c')
+    assert scan(str(tmp_path), 100) == ({}, True, 2)
+    assert scan(str(tmp_path), 1) == ({}, False, 1)
+    os.link(str(tmp_path / 'c'), str(tmp_path / 'a' / 'c.link'))
+    found, complete, _ = scan(str(tmp_path), 100)
+    assert os.path.samefile(found['hard_links'], str(tmp_path / 'c'))
+    assert complete
+    if _xattrs_supported(str(tmp_path)):
+        os.setxattr(str(tmp_path / 'a' / 'b'), 'user.comment', b'b')
+        found, _, _ = scan(str(tmp_path), 100)
+        assert found['xattrs'] == str(tmp_path / 'a' / 'b')
+
+
+@pytest.mark.parametrize(['fs_type', 'options', 'found', 'complete',
+                          'args'], [
+    ('ext4', [], {}, True,
+     ['--no-hard-links', '--no-acls', '--no-xattrs']),
+    ('ext4', [], {}, False, []),
+    ('ext4', ['noacl'], {'hard_links': '/a'}, False, ['--no-acls']),
+    ('ext4', [], {'xattrs': '/a', 'acls': '/b'}, True, ['--no-hard-links']),
+    ('vfat', [], {}, False, ['--no-hard-links', '--no-acls', '--no-xattrs']),
+])
+def test_choose_flags(fs_type, options, found, complete, args):
+    flags = choose_flags(fs_type, options, found, complete, 10)
+    assert flag_args(flags) == args
+    assert set(flags.reasons) == {'hard_links', 'acls', 'xattrs'}
+
+
+def test_probe_cache(tmp_path, mountinfo):
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'file').write_text('file')
+    probe = FlagProbe(str(tmp_path), mountinfo_file=mountinfo)
+    flags = probe.probe('/root', str(source))
+    assert not flags.needed['hard_links']
+    assert flags.reasons['hard_links'] == 'none in 1 files'
+    probe.save()
+    os.link(str(source / 'file'), str(source / 'link'))
+    # Cached results are used until the rescan interval
+    probe = FlagProbe(str(tmp_path), mountinfo_file=mountinfo)
+    probe.load()
+    flags = probe.probe('/root', str(source))
+    assert not flags.needed['hard_links']
+    # ACLs and extended attributes are only dropped by a fresh scan
+    assert flags.needed['acls'] and flags.needed['xattrs']
+    assert flags.reasons['xattrs'] == 'kept until the next scan'
+    probe = FlagProbe(str(tmp_path), rescan_days=0, mountinfo_file=mountinfo)
+    probe.load()
+    assert probe.probe('/root', str(source)).needed['hard_links']
+    probe.save()
+    with open(str(tmp_path / FLAG_PROBE_FILE)) as f:
+        cached = yaml.safe_load(f)
+    assert cached['/root']['fs-type'] == 'ext4'
+    assert cached['/root']['needed']['hard_links']
+
+
+def test_from_config(tmp_path):
+    assert FlagProbe.from_config(None, str(tmp_path)) is None
+    probe = FlagProbe.from_config({'max-files': 10}, str(tmp_path))
+    assert probe.max_files == 10
+    assert FlagProbe.from_config(True, str(tmp_path)).max_files == 100000
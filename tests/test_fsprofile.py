@@ -0,0 +1,72 @@
+import os
+from unittest import mock
+
+import pytest
+
+from extbackup import fsprofile
+
+
+@pytest.mark.parametrize(['profile_name'], [(name,) for name in
+                                            fsprofile.PROFILES])
+def test_mkfs_cmds(profile_name):
+    profile = fsprofile.PROFILES[profile_name]
+    mkfs, tune2fs = fsprofile.mkfs_cmds('/dev/unittest0', profile_name)
+    assert mkfs == ['mkfs.ext4'] + profile.mkfs_args + ['/dev/unittest0']
+    assert tune2fs == ['tune2fs', '-m', '0',
+                       '-E', 'mount_opts={}'.format(profile.mount_opts),
+                       '/dev/unittest0']
+
+
+def test_mkfs_cmds_force():
+    mkfs, _ = fsprofile.mkfs_cmds('/tmp/fs.img', 'mixed', force=True)
+    assert mkfs[:3] == ['mkfs.ext4', '-F', '-q']
+
+
+def test_metadata_workload(tmp_path):
+    assert fsprofile._metadata_workload(str(tmp_path), 250,
+                                        files_per_dir=100) == 756
+    snapshot_file = tmp_path / 'snapshot' / 'd000002' / 'f00000249'
+    assert os.stat(str(snapshot_file)).st_nlink == 2
+
+
+def test_profile_inode_ratio():
+    assert fsprofile.PROFILES['many-small-files'].mkfs_args[:2] == [
+        '-i', str(fsprofile.PROFILES['many-small-files'].inode_ratio)]
+    assert fsprofile.PROFILES['mixed'].mkfs_args[:2] == [
+        '-i', str(fsprofile.PROFILES['mixed'].inode_ratio)]
+
+
+def test_profile_mount_opts():
+    for profile in fsprofile.PROFILES.values():
+        assert 'data=writeback' not in profile.mount_opts
+
+
+def test_max_files():
+    # 2 GiB with the largefile ratio has 2048 inodes
+    assert fsprofile._max_files(2048) == 1992
+    assert fsprofile._max_files(1) == 0
+
+
+def test_benchmark_scales_files(tmp_path):
+    with mock.patch('subprocess.check_call'), \
+            mock.patch('extbackup.fsprofile.mount'), \
+            mock.patch('extbackup.fsprofile.unmount'), \
+            mock.patch('extbackup.fsprofile._metadata_workload',
+                       return_value=1000) as mock_workload:
+        fsprofile.benchmark(work_dir=str(tmp_path))
+    assert {args[0][1] for args in mock_workload.call_args_list} == {1992}
+
+
+def test_benchmark(tmp_path):
+    with mock.patch('subprocess.check_call') as mock_call, \
+            mock.patch('extbackup.fsprofile.mount') as mock_mount, \
+            mock.patch('extbackup.fsprofile.unmount') as mock_unmount, \
+            mock.patch('extbackup.fsprofile._metadata_workload',
+                       return_value=1000):
+        results = fsprofile.benchmark(work_dir=str(tmp_path), size_mb=1)
+    assert list(results) == list(fsprofile.PROFILES)
+    assert all(ops > 0 for ops in results.values())
+    assert mock_call.call_count == 2 * len(fsprofile.PROFILES)
+    assert mock_mount.call_count == len(fsprofile.PROFILES)
+    assert mock_mount.call_args[1]['options'] == 'loop,noatime'
+    assert mock_unmount.call_count == len(fsprofile.PROFILES)
@@ -0,0 +1,52 @@
+import array
+
+from extbackup.inodes import InodeTable
+from extbackup.inodes import find_duplicates
+
+
+def _table(entries, dir_bytes=0):
+    return InodeTable.from_entries(
+        list(entries) + ([(None, dir_bytes)] if dir_bytes else []))
+
+
+def test_from_entries_sorted_and_deduplicated(monkeypatch):
+    monkeypatch.setattr(InodeTable, 'CHUNK_SIZE', 2)
+    table = _table([(5, 50), (3, 30), (9, 90), (3, 30), (1, 10)],
+                   dir_bytes=4096)
+    assert list(table.inodes) == [1, 3, 5, 9]
+    assert list(table.sizes) == [10, 30, 50, 90]
+    assert table.dir_bytes == 4096
+    assert table.total_bytes == 180 + 4096
+
+
+def test_shared_bytes():
+    first = _table([(1, 10), (2, 20), (3, 30)], dir_bytes=100)
+    second = _table([(2, 20), (3, 30), (4, 40)])
+    third = _table([(3, 30), (5, 50)])
+    assert second.shared_bytes(first) == 50
+    assert second.shared_bytes(third) == 30
+
+
+def test_read_entries(tmp_path, monkeypatch):
+    monkeypatch.setattr(InodeTable, 'CHUNK_SIZE', 2)
+    table = _table([(5, 50), (3, 30), (9, 90), (1, 10), (7, 70)])
+    file_name = str(tmp_path / 'table.inodes')
+    table.save(file_name)
+    assert list(InodeTable.read_entries(file_name)) == [
+        (1, 10), (3, 30), (5, 50), (7, 70), (9, 90)]
+
+
+def test_save_load(tmp_path):
+    table = InodeTable(array.array('Q', [1, 2]), array.array('Q', [10, 20]),
+                       dir_bytes=4096)
+    file_name = str(tmp_path / 'table.inodes')
+    table.save(file_name)
+    loaded = InodeTable.load(file_name)
+    assert list(loaded.inodes) == [1, 2]
+    assert list(loaded.sizes) == [10, 20]
+    assert loaded.dir_bytes == 4096
+
+
+def test_find_duplicates():
+    assert find_duplicates([5, 3, 9, 3, 1, 5, 5], chunk_size=2) == {3, 5}
+    assert find_duplicates([]) == set()
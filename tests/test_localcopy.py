@@ -0,0 +1,339 @@
+import datetime
+import os
+import shutil
+import stat
+import struct
+import subprocess
+from unittest import mock
+
+import pytest
+
+from extbackup.localcopy import LocalCopy
+from extbackup.localcopy import RsyncFilter
+from extbackup.localcopy import parse_rsync_args
+from extbackup.routing import route_filter_args
+from extbackup.shards import hide_filter_args
+from extbackup.shards import shard_filter_args
+
+ACL_XATTR = 'system.posix_acl_access'
+# user::rw- user:1000:r-- group::r-- mask::r-- other::---
+ACL_VALUE = struct.pack('<I', 2) + b''.join(
+    struct.pack('<HHI', tag, perm, uid) for tag, perm, uid in [
+        (0x01, 6, 0xffffffff), (0x02, 4, 1000), (0x04, 4, 0xffffffff),
+        (0x10, 4, 0xffffffff), (0x20, 0, 0xffffffff)])
+
+
+def _xattrs_supported(path):
+    try:
+        os.setxattr(path, 'user.extbackup', b'1')
+        os.removexattr(path, 'user.extbackup')
+        return True
+    except OSError:
+        return False
+
+
+def _make_tree(root):
+    (root / 'etc').mkdir(parents=True)
+    (root / 'etc' / 'hosts').write_text('127.0.0.1 localhost\n')
+    (root / 'etc' / 'shadow').write_text('root:*:17000::::::\n')
+    os.chmod(str(root / 'etc' / 'shadow'), 0o640)
+    os.symlink('hosts', str(root / 'etc' / 'hosts.link'))
+    (root / 'srv' / 'data').mkdir(parents=True)
+    (root / 'srv' / 'data' / 'a').write_text('a')
+    os.link(str(root / 'srv' / 'data' / 'a'), str(root / 'srv' / 'a.link'))
+    with open(str(root / 'srv' / 'sparse.img'), 'wb') as f:
+        f.seek(8 * 1024 * 1024)
+        f.write(b'end')
+    (root / 'tmp').mkdir()
+    (root / 'tmp' / 'session').write_text('s')
+    os.mkfifo(str(root / 'srv' / 'fifo'))
+    if _xattrs_supported(str(root / 'etc' / 'hosts')):
+        os.setxattr(str(root / 'etc' / 'hosts'), 'user.comment', b'hosts')
+        try:
+            os.setxattr(str(root / 'etc' / 'shadow'), ACL_XATTR, ACL_VALUE)
+        except OSError:
+            pass
+    os.utime(str(root / 'srv' / 'data'), (1000000000, 1000000000))
+
+
+def _xattrs(path):
+    try:
+        return {name: os.getxattr(path, name, follow_symlinks=False)
+                for name in os.listxattr(path, follow_symlinks=False)}
+    except OSError:
+        return {}
+
+
+def _tree(root):
+    # Everything rsync -aHSAX preserves, with hard links as groups
+    entries = {}
+    inodes = {}
+    for dir_name, dirs, files in os.walk(root):
+        for name in dirs + files:
+            path = os.path.join(dir_name, name)
+            rel = os.path.relpath(path, root)
+            st = os.lstat(path)
+            inodes.setdefault(st.st_ino, []).append(rel)
+            content = None
+            if stat.S_ISLNK(st.st_mode):
+                content = os.readlink(path)
+            elif stat.S_ISREG(st.st_mode):
+                with open(path, 'rb') as f:
+                    content = f.read()
+            entries[rel] = (st.st_mode, st.st_uid, st.st_gid,
+                            None if stat.S_ISDIR(st.st_mode) else st.st_size,
+                            None if stat.S_ISLNK(st.st_mode)
+                            else st.st_mtime_ns, content, _xattrs(path))
+    links = sorted(sorted(paths) for paths in inodes.values()
+                   if len(paths) > 1)
+    return entries, links
+
+
+@pytest.fixture
+def source(tmp_path):
+    root = tmp_path / 'source'
+    _make_tree(root)
+    return root
+
+
+@pytest.mark.parametrize(['rules', 'path', 'is_dir', 'included'], [
+    (['- /tmp/'], 'tmp', True, False),
+    (['- /tmp/'], 'tmp', False, True),
+    (['- /tmp/'], 'srv/tmp', True, True),
+    (['- tmp/'], 'srv/tmp', True, False),
+    (['- *.log'], 'var/log/syslog.log', False, False),
+    (['- /var/log/*.log'], 'var/log/syslog.log', False, False),
+    (['- /var/*.log'], 'var/log/syslog.log', False, True),
+    (['- /var/**.log'], 'var/log/syslog.log', False, False),
+    (['+ /srv/***', '- *'], 'srv/a/b', False, True),
+    (['+ /srv/***', '- *'], 'srv', True, True),
+    (['+ /srv/***', '- *'], 'etc', True, False),
+    (['- /data\\[1]'], 'data[1]', False, False),
+    (['- /data[12]'], 'data2', False, False),
+    (['- /data[!12]'], 'data2', False, True),
+    (['H /srv/*'], 'srv/a', False, False),
+    (['P /srv/*'], 'srv/a', False, True),
+])
+def test_filter_included(rules, path, is_dir, included):
+    rsync_filter = RsyncFilter()
+    for rule in rules:
+        rsync_filter.add(rule)
+    assert rsync_filter.included(path, is_dir) is included
+
+
+def test_filter_generated_rules():
+    rsync_filter = parse_rsync_args(
+        shard_filter_args('/srv/data', ['b']))['filter']
+    assert rsync_filter.included('srv', True)
+    assert rsync_filter.included('srv/data', True)
+    assert rsync_filter.included('srv/data/a', False)
+    assert not rsync_filter.included('srv/data/b', False)
+    assert not rsync_filter.included('srv/other', True)
+    assert not rsync_filter.included('etc', True)
+    assert rsync_filter.protected('srv/data/b', False)
+    assert rsync_filter.protected('etc', True)
+    assert not rsync_filter.protected('srv/data/a', False)
+
+    rsync_filter = parse_rsync_args(
+        hide_filter_args('/srv') + route_filter_args(['/etc/hosts']))['filter']
+    assert not rsync_filter.included('srv/a', False)
+    assert rsync_filter.included('etc/hosts', False)
+    assert not rsync_filter.included('etc/shadow', False)
+    assert rsync_filter.protected('etc/shadow', False)
+
+
+def test_parse_rsync_args(tmp_path):
+    exclude_file = tmp_path / 'rsync-exclude'
+    exclude_file.write_text('# comment\n/tmp/\n+ /srv/keep\n/srv/*\n')
+    options = parse_rsync_args(['--one-file-system', '--max-size=1M',
+                                '--exclude-from={}'.format(exclude_file)])
+    assert options['one_file_system']
+    assert options['max_size'] == 1024 * 1024
+    assert not options['filter'].included('tmp', True)
+    assert options['filter'].included('srv/keep', False)
+    assert not options['filter'].included('srv/other', False)
+    with pytest.raises(Exception):
+        parse_rsync_args(['--checksum'])
+
+
+@pytest.mark.parametrize('rule', [
+    '-s /tmp/', 'exclude,s /tmp/', '+! /srv/', '. /etc/rsync-filter',
+    'merge /etc/rsync-filter', 'dir-merge .rsync-filter', ': .rsync-filter',
+    '!', 'clear',
+])
+def test_filter_unsupported(rule):
+    with pytest.raises(Exception):
+        RsyncFilter().add(rule)
+
+
+def test_copy(tmp_path, source):
+    dest = tmp_path / 'dest'
+    failed = LocalCopy(str(source), str(dest), jobs=4).run()
+    assert failed == {}
+    assert _tree(str(dest)) == _tree(str(source))
+    assert _tree(str(dest))[1] == [['srv/a.link', 'srv/data/a']]
+    sparse = os.stat(str(dest / 'srv' / 'sparse.img'))
+    assert sparse.st_blocks * 512 < 1024 * 1024
+
+
+def test_copy_small_batches(tmp_path, source):
+    dest = tmp_path / 'dest'
+    with mock.patch('extbackup.localcopy.SCAN_BATCH', 1):
+        copy = LocalCopy(str(source), str(dest), jobs=2)
+        assert copy.run() == {}
+    assert _tree(str(dest)) == _tree(str(source))
+    assert copy.first_links == {}
+
+
+def test_copy_link_dest(tmp_path, source):
+    prev = tmp_path / 'prev'
+    LocalCopy(str(source), str(prev)).run()
+    (source / 'etc' / 'hosts').write_text('changed\n')
+    dest = tmp_path / 'dest'
+    copy = LocalCopy(str(source), str(dest), link_dests=[str(prev)])
+    assert copy.run() == {}
+    assert _tree(str(dest)) == _tree(str(source))
+    for rel in ['etc/shadow', 'srv/data/a', 'srv/a.link']:
+        assert os.path.samefile(str(dest / rel), str(prev / rel))
+    assert not os.path.samefile(str(dest / 'etc' / 'hosts'),
+                                str(prev / 'etc' / 'hosts'))
+    assert copy.stats['copied'] == 1
+
+
+def test_copy_delete(tmp_path, source):
+    dest = tmp_path / 'dest'
+    LocalCopy(str(source), str(dest)).run()
+    (dest / 'extra').write_text('extra')
+    (dest / 'srv' / 'kept').write_text('kept')
+    # Excluded files are deleted unless protected
+    copy = LocalCopy(str(source), str(dest),
+                     args=['--filter=- /tmp/', '--filter=P /srv/kept'])
+    assert copy.run() == {}
+    assert not (dest / 'extra').exists()
+    assert not (dest / 'tmp').exists()
+    assert (dest / 'srv' / 'kept').exists()
+    assert copy.stats['deleted'] == 3
+    assert copy.stats['unchanged'] == 6
+
+
+def test_copy_delete_protected_below(tmp_path, source):
+    dest = tmp_path / 'dest'
+    LocalCopy(str(source), str(dest)).run()
+    (dest / 'old' / 'keep').mkdir(parents=True)
+    (dest / 'old' / 'keep' / 'a').write_text('a')
+    (dest / 'old' / 'b').write_text('b')
+    copy = LocalCopy(str(source), str(dest), args=['--filter=P /old/keep/'])
+    assert copy.run() == {}
+    assert (dest / 'old' / 'keep' / 'a').exists()
+    assert not (dest / 'old' / 'b').exists()
+
+
+def test_copy_max_size(tmp_path, source):
+    dest = tmp_path / 'dest'
+    LocalCopy(str(source), str(dest)).run()
+    (source / 'srv' / 'sparse.img').write_text('changed')
+    with open(str(source / 'srv' / 'sparse.img'), 'ab') as f:
+        f.truncate(8 * 1024 * 1024)
+    copy = LocalCopy(str(source), str(dest), args=['--max-size=1M'])
+    assert copy.run() == {}
+    # Larger files are neither copied nor deleted
+    assert (dest / 'srv' / 'sparse.img').read_bytes().endswith(b'end')
+    assert copy.stats['deleted'] == 0
+
+
+def test_copy_no_options(tmp_path, source):
+    dest = tmp_path / 'dest'
+    assert LocalCopy(str(source), str(dest),
+                     args=['--no-hard-links', '--no-xattrs']).run() == {}
+    assert _tree(str(dest))[1] == []
+    assert _xattrs(str(dest / 'etc' / 'hosts')) == {}
+    assert _xattrs(str(dest / 'etc' / 'shadow')) == \
+        _xattrs(str(source / 'etc' / 'shadow'))
+
+
+def test_copy_files(tmp_path, source):
+    dest = tmp_path / 'dest'
+    dest.mkdir()
+    (dest / 'extra').write_text('extra')
+    assert LocalCopy(str(source), str(dest)).run(
+        files=['srv/data/a', 'missing']) == {
+            'missing': 'No such file or directory'}
+    assert (dest / 'srv' / 'data' / 'a').read_text() == 'a'
+    assert sorted(os.listdir(str(dest))) == ['extra', 'srv']
+
+
+def test_copy_files_directory(tmp_path, source):
+    dest = tmp_path / 'dest'
+    (dest / 'srv').mkdir(parents=True)
+    (dest / 'srv' / 'extra').write_text('extra')
+    copy = LocalCopy(str(source), str(dest))
+    # Listed directories are copied with their contents, once
+    assert copy.run(files=['srv', 'srv/data']) == {}
+    assert (dest / 'srv' / 'data' / 'a').read_text() == 'a'
+    assert os.path.samefile(str(dest / 'srv' / 'data' / 'a'),
+                            str(dest / 'srv' / 'a.link'))
+    assert sorted(os.listdir(str(dest / 'srv'))) == [
+        'a.link', 'data', 'extra', 'fifo', 'sparse.img']
+    assert copy.stats['copied'] == 3
+    assert not (dest / 'etc').exists()
+
+
+def test_copy_retry_directory(tmp_path, source):
+    dest = tmp_path / 'dest'
+    scan_dir = LocalCopy._scan_dir
+
+    def failing_scan_dir(self, rel):
+        if rel == 'srv/data':
+            self._fail(rel, PermissionError(13, 'Permission denied'))
+            return None
+        return scan_dir(self, rel)
+
+    with mock.patch.object(LocalCopy, '_scan_dir', failing_scan_dir):
+        failed = LocalCopy(str(source), str(dest)).run()
+    assert failed == {'srv/data': 'Permission denied'}
+    assert not (dest / 'srv' / 'data' / 'a').exists()
+    assert LocalCopy(str(source), str(dest)).run(files=sorted(failed)) == {}
+    assert (dest / 'srv' / 'data' / 'a').read_text() == 'a'
+
+
+def test_copy_stop_at(tmp_path, source):
+    dest = tmp_path / 'dest'
+    copy = LocalCopy(str(source), str(dest), stop_at=(
+        datetime.datetime.now() - datetime.timedelta(minutes=1)).strftime(
+            '%Y-%m-%dT%H:%M'))
+    assert copy.run() == {}
+    assert copy.stopped
+    assert copy.stats['copied'] == 0
+
+
+def test_copy_pretend(tmp_path, source):
+    dest = tmp_path / 'dest'
+    copy = LocalCopy(str(source), str(dest), pretend=True)
+    assert copy.run() == {}
+    assert not dest.exists()
+    assert copy.stats['copied'] == 7
+
+
+@pytest.mark.skipif(not shutil.which('rsync'), reason='rsync not installed')
+@pytest.mark.parametrize(['args'], [
+    ([],),
+    (['--filter=- /tmp/', '--filter=- *.img'],),
+    (shard_filter_args('/srv/data', []),),
+])
+def test_copy_matches_rsync(args, tmp_path, source):
+    prev = tmp_path / 'prev'
+    LocalCopy(str(source), str(prev)).run()
+    (source / 'etc' / 'hosts').write_text('changed\n')
+    (source / 'srv' / 'new').write_text('new')
+    rsync_dest = tmp_path / 'rsync'
+    native_dest = tmp_path / 'native'
+    for dest in [rsync_dest, native_dest]:
+        shutil.copytree(str(prev), str(dest), symlinks=True)
+        (dest / 'stale').write_text('stale')
+    subprocess.check_call(
+        ['rsync', '-aHSAX', '--numeric-ids', '--delete',
+         '--delete-excluded'] + args +
+        ['--link-dest={}'.format(prev), str(source) + '/', str(rsync_dest)])
+    assert LocalCopy(str(source), str(native_dest), args=args,
+                     link_dests=[str(prev)]).run() == {}
+    assert _tree(str(native_dest)) == _tree(str(rsync_dest))
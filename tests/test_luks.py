@@ -0,0 +1,99 @@
+from unittest import mock
+
+import pytest
+
+from extbackup import luks
+
+MOCK_BENCHMARK = '''
+# Tests are approximate using memory only (no storage IO).
+PBKDF2-sha1      1771378 iterations per second for 256-bit key
+argon2id      4 iterations, 1048576 memory, 4 parallel threads (CPUs) \
+for 256-bit key (requested 2000 ms time)
+#     Algorithm |       Key |      Encryption |      Decryption
+        aes-cbc        128b      1241.5 MiB/s      3925.0 MiB/s
+        aes-xts        256b      3421.8 MiB/s      3418.2 MiB/s
+    serpent-xts        512b       692.2 MiB/s       700.5 MiB/s
+        aes-xts        512b      2860.3 MiB/s      2870.9 MiB/s
+xchacha20,aes-adiantum 256b       980.2 MiB/s       960.4 MiB/s
+'''
+
+MOCK_BENCHMARK_NO_AESNI = '''
+        aes-cbc        128b      2541.5 MiB/s      2925.0 MiB/s
+        aes-xts        512b       160.3 MiB/s       158.9 MiB/s
+    twofish-xts        512b       310.3 MiB/s       320.9 MiB/s
+xchacha20,aes-adiantum 256b       480.2 MiB/s       460.4 MiB/s
+'''
+
+
+def test_parse_benchmark():
+    results = luks.parse_benchmark(MOCK_BENCHMARK)
+    assert len(results) == 5
+    assert results[0] == luks.BenchmarkResult('aes-cbc', 128, 1241.5, 3925.0)
+    assert results[-1] == luks.BenchmarkResult(
+        'xchacha20,aes-adiantum', 256, 980.2, 960.4)
+
+
+@pytest.mark.parametrize(['output', 'expected_cipher', 'expected_key_size'], [
+    (MOCK_BENCHMARK, 'aes-xts', 256),
+    (MOCK_BENCHMARK_NO_AESNI, 'xchacha20,aes-adiantum', 256),
+])
+def test_select_cipher(output, expected_cipher, expected_key_size):
+    result = luks.select_cipher(luks.parse_benchmark(output))
+    assert result.cipher == expected_cipher
+    assert result.key_size == expected_key_size
+
+
+def test_select_cipher_none():
+    with pytest.raises(Exception):
+        luks.select_cipher(luks.parse_benchmark(
+            '        aes-cbc        128b      1241.5 MiB/s      3925.0 MiB/s'))
+
+
+@pytest.mark.parametrize(['rotational', 'expected_args'], [
+    (1, []),
+    (None, []),
+    (0, ['--perf-no_read_workqueue', '--perf-no_write_workqueue']),
+])
+def test_open_args(rotational, expected_args):
+    with mock.patch('extbackup.luks._read_queue_attribute',
+                    return_value=rotational), \
+            mock.patch('extbackup.luks.kernel_version',
+                       return_value=(5, 10)):
+        assert luks.open_args('/dev/unittest0') == expected_args
+
+
+def test_open_args_old_kernel():
+    with mock.patch('extbackup.luks._read_queue_attribute',
+                    return_value=0), \
+            mock.patch('os.uname') as mock_uname:
+        mock_uname.return_value.release = '5.4.0-150-generic'
+        assert luks.open_args('/dev/unittest0') == []
+
+
+@pytest.mark.parametrize(['supported', 'expected_sector_args'], [
+    (True, ['--sector-size', '4096']),
+    (False, []),
+])
+def test_format_args(supported, expected_sector_args):
+    result = luks.BenchmarkResult('aes-xts', 512, 2860.3, 2870.9)
+    with mock.patch('extbackup.luks.supports_sector_size',
+                    return_value=supported):
+        assert luks.format_args('/dev/unittest0', result) == [
+            '--type', 'luks2',
+            '--cipher', 'aes-xts-plain64',
+            '--hash', 'sha512',
+            '--key-size', '512',
+        ] + expected_sector_args
+
+
+@pytest.mark.parametrize(['size', 'logical_block_size', 'expected'], [
+    (4096 * 100, 512, True),
+    (4096 * 100 + 512, 512, False),
+    (4096 * 100, 8192, False),
+])
+def test_supports_sector_size(size, logical_block_size, expected, tmp_path):
+    device = tmp_path / 'device'
+    device.write_bytes(b'\0' * size)
+    with mock.patch('extbackup.luks._read_queue_attribute',
+                    return_value=logical_block_size):
+        assert luks.supports_sector_size(str(device)) is expected
@@ -1,8 +1,10 @@
 import os
+import subprocess
 from unittest import mock
 
 import pytest
 
+from extbackup import luks
 from extbackup.main import MAPPER_NAME
 from extbackup.main import MOUNT_DIR
 from extbackup.main import Action
@@ -83,7 +85,52 @@ def test_mount(mock_exists, mock_isdir, mock_ismount, mock_mkdir,
         ['cryptsetup', 'luksOpen', '/dev/unittest0', MAPPER_NAME])
     mock_mkdir.assert_called_once_with(MOUNT_DIR)
     mock_mount.assert_called_once_with(
-        MOUNT_DIR, source=os.path.join('/dev/mapper', MAPPER_NAME))
+        MOUNT_DIR, source=os.path.join('/dev/mapper', MAPPER_NAME),
+        options='noatime')
+
+
+def test_mount_non_rotational(mock_exists, mock_isdir, mock_ismount,
+                              mock_mkdir, mock_mount, mock_call):
+    mock_ismount.return_value = False
+    mock_isdir.return_value = False
+    mock_exists.side_effect = [True, False]
+    with mock.patch('extbackup.luks.is_rotational', return_value=False), \
+            mock.patch('extbackup.luks.kernel_version',
+                       return_value=(5, 10)):
+        app = App(mock.MagicMock(action=Action.MOUNT,
+                                 device='/dev/unittest0'))
+        app.run()
+    mock_call.assert_called_once_with(
+        ['cryptsetup', 'luksOpen', '--perf-no_read_workqueue',
+         '--perf-no_write_workqueue', '/dev/unittest0', MAPPER_NAME])
+
+
+@pytest.mark.parametrize(['returncode', 'retried'], [(1, True), (2, False)])
+def test_mount_workqueue_unsupported(mock_exists, mock_isdir, mock_ismount,
+                                     mock_mkdir, mock_mount, mock_call,
+                                     returncode, retried):
+    mock_ismount.return_value = False
+    mock_isdir.return_value = False
+    mock_exists.side_effect = [True, False]
+    mock_call.side_effect = [
+        subprocess.CalledProcessError(returncode, 'cryptsetup'), None]
+    with mock.patch('extbackup.luks.is_rotational', return_value=False), \
+            mock.patch('extbackup.luks.kernel_version',
+                       return_value=(5, 10)):
+        app = App(mock.MagicMock(action=Action.MOUNT,
+                                 device='/dev/unittest0'))
+        if retried:
+            app.run()
+        else:
+            with pytest.raises(subprocess.CalledProcessError):
+                app.run()
+    calls = [mock.call(['cryptsetup', 'luksOpen', '--perf-no_read_workqueue',
+                        '--perf-no_write_workqueue', '/dev/unittest0',
+                        MAPPER_NAME])]
+    if retried:
+        calls.append(mock.call(['cryptsetup', 'luksOpen', '/dev/unittest0',
+                                MAPPER_NAME]))
+    assert mock_call.call_args_list == calls
 
 
 def test_mount_doesnt_exist(mock_exists, mock_isdir, mock_ismount,
@@ -113,7 +160,8 @@ def test_mount_mapper_exists(mock_exists, mock_isdir, mock_ismount,
     mock_call.assert_not_called()
     mock_mkdir.assert_called_once_with(MOUNT_DIR)
     mock_mount.assert_called_once_with(
-        MOUNT_DIR, source=os.path.join('/dev/mapper', MAPPER_NAME))
+        MOUNT_DIR, source=os.path.join('/dev/mapper', MAPPER_NAME),
+        options='noatime')
 
 
 def test_unmount(mock_isdir, mock_ismount, mock_exists, mock_unmount,
@@ -153,3 +201,55 @@ def test_unmount_not_mounted_no_mapper(mock_isdir, mock_ismount,
     mock_unmount.assert_not_called()
     mock_rmdir.assert_not_called()
     mock_call.assert_not_called()
+
+
+def test_create(mock_exists, mock_ismount, mock_call):
+    mock_ismount.return_value = False
+    mock_exists.side_effect = [True, False, False, True, True]
+    result = luks.BenchmarkResult('aes-xts', 512, 2860.3, 2870.9)
+    with mock.patch('extbackup.luks.benchmark', return_value=[result]), \
+            mock.patch('extbackup.luks.format_args',
+                       return_value=['--cipher', 'aes-xts-plain64']), \
+            mock.patch('extbackup.luks.open_args', return_value=[]):
+        app = App(mock.MagicMock(action=Action.CREATE,
+                                 device='/dev/unittest0',
+                                 fs_profile='large-media'))
+        app.run()
+    mapper_path = os.path.join('/dev/mapper', MAPPER_NAME)
+    assert mock_call.call_args_list == [
+        mock.call(['cryptsetup', '-y', '--cipher', 'aes-xts-plain64',
+                   'luksFormat', '/dev/unittest0']),
+        mock.call(['cryptsetup', 'luksOpen', '/dev/unittest0', MAPPER_NAME]),
+        mock.call(['mkfs.ext4', '-T', 'largefile', '-O', 'dir_index',
+                   '-J', 'size=256', '-E', 'lazy_itable_init=1',
+                   mapper_path]),
+        mock.call(['tune2fs', '-m', '0',
+                   '-E', 'mount_opts=commit=60,data=ordered',
+                   mapper_path]),
+        mock.call(['cryptsetup', 'luksClose', MAPPER_NAME]),
+    ]
+
+
+def test_backup_device(mock_exists, mock_isdir, mock_ismount, mock_mount,
+                       mock_unmount, mock_call):
+    mock_exists.side_effect = [True, False, True]
+    mock_isdir.return_value = True
+    mock_ismount.side_effect = [False, True]
+    app = App(mock.MagicMock(action=Action.DAEMON, pretend=False,
+                             deadline='06:00'))
+    with mock.patch('extbackup.main.ExternalBackup') as mock_backup, \
+            mock.patch('extbackup.main.parse_deadline') as mock_deadline:
+        app.backup_device('/dev/unittest0', config={'include': '/**'},
+                          mounts=['/'], key_file='/root/extbackup.key')
+    mock_deadline.assert_called_once_with('06:00')
+    mock_backup.assert_called_once_with(
+        pretend=False, config_file=app.args.config_file,
+        config={'include': '/**'}, mounts=['/'],
+        deadline=mock_deadline.return_value)
+    mock_backup.return_value.backup.assert_called_once_with()
+    mock_unmount.assert_called_once_with(MOUNT_DIR)
+    assert mock_call.call_args_list == [
+        mock.call(['cryptsetup', 'luksOpen', '--key-file',
+                   '/root/extbackup.key', '/dev/unittest0', MAPPER_NAME]),
+        mock.call(['cryptsetup', 'luksClose', MAPPER_NAME]),
+    ]
@@ -137,6 +137,15 @@ class TestHelpers(object):
         mock_call.assert_called_once_with(['mount', '--bind', source,
                                            MOCK_MOUNT_POINT])
 
+    def test_mount_options(self, mock_ismount, mock_listdir, mock_isdir,
+                           mock_call):
+        source = '/dev/unittest0'
+        mock_ismount.side_effect = [False, True]
+        assert extbackup.mount.mount(
+            MOCK_MOUNT_POINT, source=source, options='noatime') is True
+        mock_call.assert_called_once_with(['mount', '-o', 'noatime', source,
+                                           MOCK_MOUNT_POINT])
+
     def test_mount_bind_no_source(self, mock_ismount, mock_listdir, mock_isdir,
                                   mock_call):
         with pytest.raises(Exception):
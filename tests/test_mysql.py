@@ -0,0 +1,185 @@
+import datetime
+import gzip
+import os
+import subprocess
+from unittest import mock
+
+import pytest
+import yaml
+
+from extbackup import mysql
+from extbackup.chunkstore import CHUNK_STORE_DIR
+from extbackup.chunkstore import ChunkStore
+
+MOCK_DUMP = '''-- MySQL dump 10.13
+--
+-- Position to start replication or point-in-time recovery from
+--
+
+-- CHANGE MASTER TO MASTER_LOG_FILE='binlog.000002', MASTER_LOG_POS=155;
+
+CREATE DATABASE test;
+'''
+
+
+class FakeServer(object):
+    def __init__(self):
+        self.binlogs = ['binlog.000001', 'binlog.000002']
+        self.commands = []
+
+    def check_output(self, cmd, **kwargs):
+        assert cmd[:4] == ['mysql', '-N', '-B', '-e']
+        return ''.join('{}\t1000\tNo\n'.format(b) for b in self.binlogs)
+
+    def check_call(self, cmd, **kwargs):
+        assert cmd == ['mysql', '-e', 'FLUSH BINARY LOGS']
+        self.binlogs.append('binlog.{:06d}'.format(len(self.binlogs) + 1))
+
+    def runcmd(self, cmd, stdout=None):
+        self.commands.append(cmd)
+        if cmd[0] == 'mysqldump':
+            stdout.write(MOCK_DUMP)
+        elif cmd[0] == 'mysqlbinlog':
+            result_dir = cmd[3].split('=', 1)[1]
+            for binlog in cmd[4:]:
+                with open(os.path.join(result_dir, binlog), 'wb') as f:
+                    f.write(binlog.encode())
+        elif cmd[0] == 'gzip':
+            subprocess.check_call(cmd)
+
+
+@pytest.fixture
+def server():
+    server = FakeServer()
+    with mock.patch('subprocess.check_output', server.check_output), \
+            mock.patch('extbackup.mysql._which', return_value=True), \
+            mock.patch('subprocess.check_call', wraps=subprocess.check_call) \
+            as mock_call:
+        mock_call.side_effect = lambda cmd, **kwargs: (
+            server.check_call(cmd, **kwargs) if cmd[0] == 'mysql'
+            else subprocess.call(cmd, **kwargs))
+        yield server
+
+
+def _snapshot(target, name):
+    snapshot = target / name
+    snapshot.mkdir()
+    return str(snapshot)
+
+
+def _manifest(snapshot):
+    with open(os.path.join(snapshot, mysql.MYSQL_DIR,
+                           mysql.MANIFEST_FILE)) as f:
+        return yaml.safe_load(f)
+
+
+def test_parse_dump_position(tmp_path):
+    dump_file = tmp_path / 'dump.sql'
+    dump_file.write_text(MOCK_DUMP)
+    assert mysql.parse_dump_position(str(dump_file)) == {
+        'file': 'binlog.000002', 'pos': 155}
+    dump_file.write_text(
+        "-- CHANGE REPLICATION SOURCE TO SOURCE_LOG_FILE='binlog.000009', "
+        "SOURCE_LOG_POS=4;\n")
+    assert mysql.parse_dump_position(str(dump_file)) == {
+        'file': 'binlog.000009', 'pos': 4}
+    dump_file.write_text('CREATE DATABASE test;\n')
+    assert mysql.parse_dump_position(str(dump_file)) is None
+
+
+def test_backup_chain(tmp_path, server):
+    first = _snapshot(tmp_path, '20180101-0000')
+    mysql.MysqlBackup(str(tmp_path), first, server.runcmd).backup()
+    assert server.commands[0] == [
+        'mysqldump', '--all-databases', '--single-transaction',
+        '--flush-logs', '--master-data=2']
+    assert _manifest(first) == {
+        'type': 'full', 'chain': ['20180101-0000'],
+        'end': {'file': 'binlog.000002', 'pos': 155}}
+    with gzip.open(os.path.join(first, 'mysql', mysql.DUMP_FILE + '.gz'),
+                   'rt') as f:
+        assert f.read() == MOCK_DUMP
+
+    second = _snapshot(tmp_path, '20180102-0000')
+    mysql.MysqlBackup(str(tmp_path), second, server.runcmd).backup()
+    assert _manifest(second) == {
+        'type': 'incremental',
+        'chain': ['20180101-0000', '20180102-0000'],
+        'start': {'file': 'binlog.000002', 'pos': 155},
+        'end': {'file': 'binlog.000003', 'pos': 4},
+        'binlogs': ['binlog.000002'],
+    }
+    assert sorted(os.listdir(os.path.join(second, 'mysql'))) == \
+        ['binlog.000002.gz', 'manifest.yaml']
+
+    third = _snapshot(tmp_path, '20180103-0000')
+    mysql.MysqlBackup(str(tmp_path), third, server.runcmd).backup()
+    assert _manifest(third)['chain'] == [
+        '20180101-0000', '20180102-0000', '20180103-0000']
+    assert _manifest(third)['binlogs'] == ['binlog.000003']
+
+
+def test_backup_full_interval(tmp_path, server):
+    first = _snapshot(tmp_path, '20180101-0000')
+    mysql.MysqlBackup(str(tmp_path), first, server.runcmd).backup()
+    with open(str(tmp_path / mysql.STATE_FILE)) as f:
+        state = yaml.safe_load(f)
+    state['last_full'] = (datetime.datetime.now() -
+                          datetime.timedelta(days=8)).strftime(
+                              '%Y-%m-%dT%H:%M:%S')
+    with open(str(tmp_path / mysql.STATE_FILE), 'w') as f:
+        yaml.safe_dump(state, f)
+    second = _snapshot(tmp_path, '20180109-0000')
+    mysql.MysqlBackup(str(tmp_path), second, server.runcmd).backup()
+    assert _manifest(second)['type'] == 'full'
+
+
+def test_backup_purged_binlog(tmp_path, server):
+    first = _snapshot(tmp_path, '20180101-0000')
+    mysql.MysqlBackup(str(tmp_path), first, server.runcmd).backup()
+    server.binlogs = ['binlog.000005']
+    second = _snapshot(tmp_path, '20180102-0000')
+    mysql.MysqlBackup(str(tmp_path), second, server.runcmd).backup()
+    assert _manifest(second)['type'] == 'full'
+
+
+def test_replay(tmp_path, server):
+    snapshots = [_snapshot(tmp_path, '2018010{}-0000'.format(i))
+                 for i in range(1, 3)]
+    for snapshot in snapshots:
+        mysql.MysqlBackup(str(tmp_path), snapshot, server.runcmd).backup()
+    output_file = tmp_path / 'replay.sql'
+    with open(str(output_file), 'wb') as output, \
+            mock.patch('subprocess.check_call') as mock_call:
+        mysql.replay(str(tmp_path), '20180102-0000',
+                     stop_datetime='2018-01-02 12:00:00', output=output)
+    assert output_file.read_text() == MOCK_DUMP
+    cmd = mock_call.call_args[0][0]
+    assert cmd[:3] == ['mysqlbinlog', '--start-position=155',
+                       '--stop-datetime=2018-01-02 12:00:00']
+    assert [os.path.basename(f) for f in cmd[3:]] == ['binlog.000002']
+
+
+def test_replay_missing(tmp_path):
+    _snapshot(tmp_path, '20180101-0000')
+    with pytest.raises(Exception):
+        mysql.replay(str(tmp_path), '20180101-0000')
+
+
+def test_replay_chunk_store(tmp_path, server):
+    store = ChunkStore(str(tmp_path / CHUNK_STORE_DIR))
+    snapshots = [_snapshot(tmp_path, '2018010{}-0000'.format(i))
+                 for i in range(1, 3)]
+    for snapshot in snapshots:
+        mysql.MysqlBackup(str(tmp_path), snapshot, server.runcmd,
+                          store=store).backup()
+    assert sorted(os.listdir(os.path.join(snapshots[1], 'mysql'))) == \
+        ['binlog.000002.recipe', 'manifest.yaml']
+    assert not any(cmd[0] == 'gzip' for cmd in server.commands)
+    output_file = tmp_path / 'replay.sql'
+    with open(str(output_file), 'wb') as output, \
+            mock.patch('subprocess.check_call') as mock_call:
+        mysql.replay(str(tmp_path), '20180102-0000', output=output)
+    assert output_file.read_text() == MOCK_DUMP
+    binlog_file = mock_call.call_args[0][0][-1]
+    assert os.path.basename(binlog_file) == 'binlog.000002'
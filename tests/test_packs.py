@@ -0,0 +1,104 @@
+import os
+import tarfile
+from unittest import mock
+
+import pytest
+
+from extbackup.packs import DirectoryPack
+from extbackup.packs import manifest_digest
+from extbackup.packs import walk_sorted
+
+
+@pytest.fixture
+def maildir(tmp_path):
+    root = tmp_path / 'source' / 'Maildir'
+    for sub in ['cur', 'new', 'tmp']:
+        (root / sub).mkdir(parents=True)
+    for i in range(20):
+        (root / 'cur' / '{:03d}.eml'.format(i)).write_text(
+            'message {}\n'.format(i) * (i + 1))
+    os.link(str(root / 'cur' / '000.eml'), str(root / 'new' / 'link.eml'))
+    os.symlink('cur', str(root / 'current'))
+    return root
+
+
+def test_manifest_digest(maildir):
+    digest = manifest_digest(str(maildir))
+    assert manifest_digest(str(maildir)) == digest
+    os.utime(str(maildir / 'cur' / '005.eml'), (0, 0))
+    changed = manifest_digest(str(maildir))
+    assert changed != digest
+    (maildir / 'tmp' / 'new.eml').write_text('new')
+    assert manifest_digest(str(maildir)) != changed
+
+
+def test_walk_sorted_included(maildir):
+    def included(rel, is_dir):
+        return not (rel == 'tmp' and is_dir) and not rel.endswith('9.eml')
+
+    paths = list(walk_sorted(str(maildir), included))
+    assert 'tmp' not in paths
+    assert 'cur/009.eml' not in paths
+    assert 'cur/010.eml' in paths
+    # A symlink to a directory is not a directory to the filter
+    assert 'current' in list(walk_sorted(
+        str(maildir), lambda rel, is_dir: not (is_dir and rel == 'current')))
+    digest = manifest_digest(str(maildir), included)
+    (maildir / 'tmp' / 'new.eml').write_text('new')
+    assert manifest_digest(str(maildir), included) == digest
+    assert manifest_digest(str(maildir)) != digest
+
+
+def test_build_members_not_kept(tmp_path, maildir):
+    sizes = []
+    addfile = tarfile.TarFile.addfile
+
+    def _addfile(tar, *args):
+        addfile(tar, *args)
+        sizes.append(len(tar.members))
+
+    pack = DirectoryPack(str(tmp_path / 'snapshot'), '/home/user/Maildir')
+    with mock.patch.object(tarfile.TarFile, 'addfile', _addfile):
+        pack.build(str(maildir), 'abc')
+    assert len(sizes) == 25
+    assert set(sizes) == {1}
+
+
+def test_build_extract(tmp_path, maildir):
+    pack = DirectoryPack(str(tmp_path / 'snapshot'), '/home/user/Maildir')
+    assert pack.digest() is None
+    pack.build(str(maildir), 'abc')
+    assert pack.tar_file == str(
+        tmp_path / 'snapshot' / 'packs' / 'home' / 'user' / 'Maildir.tar')
+    assert pack.digest() == 'abc'
+    members = {name: size for _, size, name in pack.members()}
+    assert members['cur/007.eml'] == len('message 7\n') * 8
+    assert members['new/link.eml'] == members['cur/000.eml']
+    assert members['cur'] == 0
+
+    dest = tmp_path / 'dest'
+    assert pack.extract('cur/007.eml', str(dest)) == ['cur/007.eml']
+    assert (dest / 'cur' / '007.eml').read_text() == \
+        (maildir / 'cur' / '007.eml').read_text()
+    assert os.listdir(str(dest / 'cur')) == ['007.eml']
+    # Hard-linked files are stored in full
+    pack.extract('new', str(dest))
+    assert (dest / 'new' / 'link.eml').read_text() == 'message 0\n'
+    pack.extract('current', str(dest))
+    assert os.readlink(str(dest / 'current')) == 'cur'
+    with pytest.raises(Exception):
+        pack.extract('missing', str(dest))
+
+
+def test_find_link_from(tmp_path, maildir):
+    prev = DirectoryPack(str(tmp_path / 'prev'), '/home/user/Maildir')
+    prev.build(str(maildir), 'abc')
+    pack = DirectoryPack(str(tmp_path / 'snapshot'), '/home/user/Maildir')
+    pack.link_from(prev)
+    assert os.path.samefile(pack.tar_file, prev.tar_file)
+    assert pack.digest() == 'abc'
+    found = DirectoryPack.find(str(tmp_path / 'snapshot'),
+                               '/home/user/Maildir/cur/001.eml')
+    assert found.path == '/home/user/Maildir'
+    assert DirectoryPack.find(str(tmp_path / 'snapshot'),
+                              '/home/user/other') is None
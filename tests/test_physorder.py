@@ -0,0 +1,63 @@
+import os
+from unittest import mock
+
+import pytest
+
+from extbackup import physorder
+
+
+def test_physical_order_inode(tmp_path):
+    for name in ['c', 'a', 'b']:
+        (tmp_path / name).write_text(name)
+    inodes = {name: os.stat(str(tmp_path / name)).st_ino
+              for name in ['a', 'b', 'c']}
+    assert physorder.physical_order(
+        str(tmp_path), ['a', 'b', 'c', 'missing'], method='inode') == \
+        sorted(inodes, key=inodes.get)
+
+
+def test_physical_order_fiemap(tmp_path):
+    (tmp_path / 'empty').write_text('')
+    (tmp_path / 'data').write_bytes(b'x' * 65536)
+    with mock.patch('extbackup.physorder.first_extent',
+                    side_effect=[4096, OSError]) as mock_extent:
+        # Files that cannot be mapped sort first, by inode
+        assert physorder.physical_order(str(tmp_path),
+                                        ['data', 'empty']) == \
+            ['empty', 'data']
+    assert mock_extent.call_count == 2
+    with pytest.raises(Exception):
+        physorder.physical_order(str(tmp_path), ['data'], method='random')
+
+
+def test_batches():
+    assert list(physorder.batches(['a', 'b', 'c'], 2)) == [['a', 'b'],
+                                                           ['c']]
+
+
+def test_write_files(tmp_path):
+    paths = physorder._write_files(str(tmp_path), 20, files_per_dir=10,
+                                   file_size=16)
+    assert len(paths) == 20
+    assert paths == sorted(paths)
+    assert sorted(os.listdir(str(tmp_path))) == ['d0000', 'd0001']
+    assert os.path.getsize(str(tmp_path / paths[0])) == 16
+
+
+def test_benchmark(tmp_path):
+    with mock.patch('subprocess.check_call') as mock_call, \
+            mock.patch('extbackup.physorder.mount') as mock_mount, \
+            mock.patch('extbackup.physorder.unmount') as mock_unmount, \
+            mock.patch('extbackup.physorder._write_files',
+                       return_value=['a', 'b']), \
+            mock.patch('extbackup.physorder.physical_order',
+                       return_value=['b', 'a']), \
+            mock.patch('extbackup.physorder._read_throughput',
+                       side_effect=[1000, 4000, 3000]) as mock_read:
+        results = physorder.benchmark(work_dir=str(tmp_path), size_mb=1)
+    assert results == {'directory': 1000, 'fiemap': 4000, 'inode': 3000}
+    assert mock_read.call_args_list[0][0][1] == ['a', 'b']
+    assert mock_read.call_args_list[1][0][1] == ['b', 'a']
+    assert mock_call.call_count == 2
+    assert mock_mount.call_args[1]['options'] == 'loop,noatime'
+    mock_unmount.assert_called_once_with(mock_mount.call_args[0][0])
@@ -0,0 +1,124 @@
+import signal
+from unittest import mock
+
+import pytest
+
+from extbackup.pressure import PressureThrottle
+from extbackup.pressure import read_pressure
+
+MOCK_PGID = 1234
+
+
+def _pressure(some, full=0.0):
+    return '\n'.join([
+        'some avg10={:.2f} avg60=0.00 avg300=0.00 total=100'.format(some),
+        'full avg10={:.2f} avg60=0.00 avg300=0.00 total=50'.format(full),
+    ])
+
+
+@pytest.fixture
+def pressure_dir(tmp_path):
+    for resource in PressureThrottle.RESOURCES:
+        (tmp_path / resource).write_text(_pressure(0.0))
+    return tmp_path
+
+
+@pytest.fixture
+def mock_killpg():
+    with mock.patch('os.killpg') as patched_object:
+        yield patched_object
+
+
+def test_read_pressure(pressure_dir):
+    (pressure_dir / 'io').write_text(_pressure(12.5, full=3.0))
+    assert read_pressure('io', str(pressure_dir)) == 12.5
+
+
+def test_read_pressure_invalid(pressure_dir):
+    (pressure_dir / 'io').write_text('')
+    with pytest.raises(Exception):
+        read_pressure('io', str(pressure_dir))
+
+
+@pytest.mark.parametrize(['config', 'available', 'expected_targets'], [
+    (None, True, None),
+    ({}, True, None),
+    ({'io': 10}, False, None),
+    ({'io': 10}, True, {'io': 10}),
+    ({'io': 10, 'cpu': 50}, True, {'io': 10, 'cpu': 50}),
+])
+def test_from_config(config, available, expected_targets):
+    with mock.patch.object(PressureThrottle, 'available',
+                           return_value=available):
+        throttle = PressureThrottle.from_config(config)
+    if expected_targets is None:
+        assert throttle is None
+    else:
+        assert throttle.targets == expected_targets
+
+
+@pytest.mark.parametrize(['readings', 'expected_signals'], [
+    # Quiet system
+    ([(1.0, 1.0)], []),
+    # I/O pressure above target
+    ([(20.0, 1.0)], [signal.SIGSTOP]),
+    # Pressure drops, but not enough to resume
+    ([(20.0, 1.0), (8.0, 1.0)], [signal.SIGSTOP]),
+    # Pressure drops below the resume threshold
+    ([(20.0, 1.0), (4.0, 1.0)], [signal.SIGSTOP, signal.SIGCONT]),
+    # CPU pressure above target
+    ([(1.0, 60.0), (1.0, 10.0)], [signal.SIGSTOP, signal.SIGCONT]),
+])
+def test_update(readings, expected_signals, pressure_dir, mock_killpg):
+    throttle = PressureThrottle(io=10, cpu=50,
+                                pressure_dir=str(pressure_dir))
+    for io, cpu in readings:
+        (pressure_dir / 'io').write_text(_pressure(io))
+        (pressure_dir / 'cpu').write_text(_pressure(cpu))
+        throttle.update(MOCK_PGID)
+    assert mock_killpg.call_args_list == [
+        mock.call(MOCK_PGID, sig) for sig in expected_signals]
+
+
+def test_update_max_pause(pressure_dir, mock_killpg):
+    throttle = PressureThrottle(io=10, max_pause=0,
+                                pressure_dir=str(pressure_dir))
+    (pressure_dir / 'io').write_text(_pressure(50.0))
+    throttle.update(MOCK_PGID)
+    throttle.update(MOCK_PGID)
+    assert mock_killpg.call_args_list == [
+        mock.call(MOCK_PGID, signal.SIGSTOP),
+        mock.call(MOCK_PGID, signal.SIGCONT),
+    ]
+
+
+def test_watch_resumes_on_exit(pressure_dir, mock_killpg):
+    throttle = PressureThrottle(io=10, interval=60,
+                                pressure_dir=str(pressure_dir))
+    proc = mock.MagicMock(pid=MOCK_PGID)
+    proc.poll.return_value = None
+    (pressure_dir / 'io').write_text(_pressure(50.0))
+    with throttle.watch(proc):
+        throttle.update(MOCK_PGID)
+    assert mock_killpg.call_args_list == [
+        mock.call(MOCK_PGID, signal.SIGSTOP),
+        mock.call(MOCK_PGID, signal.SIGCONT),
+    ]
+
+
+def test_update_concurrent_groups(pressure_dir, mock_killpg):
+    # Each process group is resumed on its own, whoever paused first
+    throttle = PressureThrottle(io=10, pressure_dir=str(pressure_dir))
+    (pressure_dir / 'io').write_text(_pressure(50.0))
+    throttle.update(MOCK_PGID)
+    throttle.update(MOCK_PGID + 1)
+    (pressure_dir / 'io').write_text(_pressure(1.0))
+    throttle.update(MOCK_PGID + 1)
+    throttle.update(MOCK_PGID)
+    assert mock_killpg.call_args_list == [
+        mock.call(MOCK_PGID, signal.SIGSTOP),
+        mock.call(MOCK_PGID + 1, signal.SIGSTOP),
+        mock.call(MOCK_PGID + 1, signal.SIGCONT),
+        mock.call(MOCK_PGID, signal.SIGCONT),
+    ]
+    assert throttle.paused_at == {}
@@ -0,0 +1,79 @@
+import pytest
+
+from extbackup.profiles import SourceProfile
+from extbackup.profiles import load_profiles
+from extbackup.profiles import run_concurrently
+
+
+def test_load_profiles(tmp_path):
+    config = {
+        'include': '/**',
+        'profiles': {
+            'web': {'root': str(tmp_path), 'include': '/**'},
+            'db': {'root': str(tmp_path), 'target': 'containers/db'},
+        },
+    }
+    assert load_profiles(config) == [
+        SourceProfile('db', str(tmp_path), 'containers/db',
+                      config['profiles']['db']),
+        SourceProfile('web', str(tmp_path), 'web',
+                      config['profiles']['web']),
+    ]
+
+
+def test_load_profiles_none():
+    assert load_profiles({'include': '/**'}) == []
+
+
+@pytest.mark.parametrize(['profile_config'], [
+    (None,),
+    ({},),
+    ({'root': '/nonexistent/extbackup/root'},),
+    ({'target': '/absolute'},),
+    ({'target': '../escape'},),
+])
+def test_load_profiles_invalid(profile_config, tmp_path):
+    if profile_config and 'target' in profile_config:
+        profile_config['root'] = str(tmp_path)
+    with pytest.raises(Exception):
+        load_profiles({'profiles': {'web': profile_config}})
+
+
+@pytest.mark.parametrize(['targets'], [
+    ({'web': 'containers/web', 'db': 'containers/web/'},),
+    ({'web': 'containers', 'db': 'containers/db'},),
+    ({'web': 'testhost1'},),
+    ({'web': 'testhost1/web'},),
+])
+def test_load_profiles_target_clash(targets, tmp_path):
+    config = {'profiles': {name: {'root': str(tmp_path), 'target': target}
+                           for name, target in targets.items()}}
+    with pytest.raises(Exception) as e:
+        load_profiles(config, host_target='testhost1')
+    assert 'overlaps' in str(e.value)
+
+
+def test_load_profiles_target_prefix(tmp_path):
+    config = {'profiles': {'web': {'root': str(tmp_path),
+                                   'target': 'testhost10'}}}
+    assert load_profiles(config, host_target='testhost1')[0].target == \
+        'testhost10'
+
+
+def test_run_concurrently():
+    results = []
+    run_concurrently([(str(i), lambda i=i: results.append(i))
+                      for i in range(4)], concurrency=2)
+    assert sorted(results) == [0, 1, 2, 3]
+
+
+def test_run_concurrently_failure():
+    results = []
+
+    def fail():
+        raise Exception('failed')
+
+    with pytest.raises(Exception) as e:
+        run_concurrently([('a', fail), ('b', lambda: results.append('b'))])
+    assert 'a' in str(e.value)
+    assert results == ['b']
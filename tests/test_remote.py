@@ -0,0 +1,144 @@
+import os
+import shutil
+import socket
+import subprocess
+import time
+from unittest import mock
+
+import pytest
+
+from extbackup.remote import RemoteTarget
+
+
+def test_parse_url():
+    remote = RemoteTarget('ssh://backup@server:2222/srv/backups/')
+    assert remote.ssh
+    assert remote.host == 'backup@server'
+    assert remote.join('host1', '20180101-0000') == \
+        '/srv/backups/host1/20180101-0000'
+    assert remote.url('/srv/backups/host1') == \
+        'backup@server:/srv/backups/host1'
+    assert remote.ssh_cmd() == ['ssh', '-p', '2222']
+    remote = RemoteTarget('rsync://server:8873/backups')
+    assert not remote.ssh
+    assert remote.url(remote.join('host1')) == \
+        'rsync://server:8873/backups/host1'
+    for url in ['/srv/backups', 'ftp://server/backups', 'ssh://server/']:
+        with pytest.raises(Exception):
+            RemoteTarget(url)
+
+
+def test_from_config():
+    assert RemoteTarget.from_config(None) is None
+    remote = RemoteTarget.from_config('rsync://server/backups')
+    assert remote.rsync_args() == []
+    remote = RemoteTarget.from_config({'url': 'rsync://server/backups',
+                                       'compress': 'zstd',
+                                       'state-dir': '/tmp/state'})
+    assert remote.rsync_args() == ['--compress', '--compress-choice=zstd']
+    assert remote.state_dir == '/tmp/state'
+    remote = RemoteTarget.from_config({'url': 'rsync://server/backups',
+                                       'compress': True})
+    assert remote.rsync_args() == ['--compress']
+
+
+def test_control_master():
+    remote = RemoteTarget('ssh://server/srv/backups', control_persist='1m')
+    with mock.patch('subprocess.check_call') as check_call, \
+            mock.patch('subprocess.call') as call:
+        with remote:
+            control_path = remote.ssh_cmd()[2]
+            assert control_path.startswith('ControlPath=')
+            check_call.assert_called_once_with(
+                ['ssh', '-o', control_path, '-o', 'ControlMaster=yes',
+                 '-o', 'ControlPersist=1m', '-fN', 'server'])
+            # Every rsync run reuses the master connection
+            assert remote.rsync_args() == [
+                '-e', 'ssh -o {}'.format(control_path)]
+        assert call.call_args[0][0] == ['ssh', '-o', control_path, '-O',
+                                        'exit', 'server']
+    assert remote.control_dir is None
+    assert not os.path.exists(control_path.split('=', 1)[1])
+
+
+def test_list_dirs():
+    remote = RemoteTarget('rsync://server/backups')
+    output = (
+        'drwx------          4,096 2018/01/02 00:00:00 .\n'
+        '-rw-r--r--         12,288 2018/01/02 00:00:00 .catalog.sqlite\n'
+        'drwxr-xr-x          4,096 2018/01/01 00:00:00 20180101-0000\n'
+        'drwxr-xr-x          4,096 2018/01/01 00:00:00 single\n')
+    with mock.patch('subprocess.check_output',
+                    return_value=output) as check_output:
+        assert remote.list_dirs('/backups/host1') == ['20180101-0000',
+                                                      'single']
+    assert check_output.call_args[0][0] == [
+        'rsync', '--list-only', 'rsync://server/backups/host1/']
+
+
+def test_walk():
+    remote = RemoteTarget('ssh://server/srv/backups')
+    output = (b'root/etc/hosts\x0012\x00100\x001515000000.5000000000\x00'
+              b'root/my file\x0013\x000\x001515000000\x00')
+    with mock.patch('subprocess.check_output',
+                    return_value=output) as check_output:
+        assert list(remote.walk('/srv/backups/host1/20180101-0000')) == [
+            ('/root/etc/hosts', 12, 100, 1515000000500000000),
+            ('/root/my file', 13, 0, 1515000000000000000)]
+    assert check_output.call_args[0][0][:4] == [
+        'ssh', 'server', 'find', '/srv/backups/host1/20180101-0000']
+    with pytest.raises(Exception):
+        list(RemoteTarget('rsync://server/backups').walk('/backups/host1'))
+
+
+@pytest.fixture
+def rsync_daemon(tmp_path):
+    module_dir = tmp_path / 'server'
+    module_dir.mkdir()
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    config = tmp_path / 'rsyncd.conf'
+    config.write_text(
+        'use chroot = no\nuid = {}\ngid = {}\nlog file = {}\n'
+        '[backups]\npath = {}\nread only = no\n'.format(
+            os.getuid(), os.getgid(), tmp_path / 'rsyncd.log', module_dir))
+    daemon = subprocess.Popen(['rsync', '--daemon', '--no-detach',
+                               '--address=127.0.0.1', '--port={}'.format(port),
+                               '--config={}'.format(config)])
+    try:
+        for _ in range(50):
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        yield 'rsync://127.0.0.1:{}/backups'.format(port), module_dir
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+
+@pytest.mark.skipif(not shutil.which('rsync'), reason='rsync not installed')
+def test_rsync_daemon(tmp_path, rsync_daemon):
+    url, module_dir = rsync_daemon
+    remote = RemoteTarget(url)
+    storage = remote.join('hosts', 'host1')
+    remote.makedirs(remote.join(storage, '20180101-0000'))
+    state = tmp_path / 'state'
+    state.mkdir()
+    (state / '.schedule-state.yaml').write_text('last-complete: x\n')
+    (state / 'other').write_text('other')
+    remote.push_state(str(state), storage)
+    assert sorted(os.listdir(str(module_dir / 'hosts' / 'host1'))) == [
+        '.schedule-state.yaml', '20180101-0000']
+    assert remote.list_dirs(storage) == ['20180101-0000']
+    pulled = tmp_path / 'pulled'
+    pulled.mkdir()
+    remote.pull_state(storage, str(pulled))
+    assert os.listdir(str(pulled)) == ['.schedule-state.yaml']
+    assert remote.fetch(remote.join(storage, '.schedule-state.yaml'),
+                        str(tmp_path)) == str(
+                            tmp_path / '.schedule-state.yaml')
+    assert remote.fetch(remote.join(storage, 'missing'),
+                        str(tmp_path)) is None
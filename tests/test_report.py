@@ -0,0 +1,29 @@
+import yaml
+
+from extbackup.report import Report
+
+
+def test_report(tmp_path):
+    report = Report('testhost1')
+    with report.phase('versioned'):
+        pass
+    report.add('versioned', 'files', 10)
+    report.add('single', 'files', 2)
+    report.add('single', 'read_bytes', 3 * 1024 * 1024)
+    assert report.get('versioned', 'files') == 10
+    assert report.get('mysql', 'seconds', 0) == 0
+    assert report.summary().splitlines() == [
+        'Report for testhost1:',
+        '  versioned: files 10, seconds 0.0',
+        '  single: files 2, read 3.0 MiB',
+    ]
+    report_file = str(tmp_path / 'report.yaml')
+    report.save(report_file)
+    with open(report_file) as f:
+        assert yaml.safe_load(f) == {
+            'name': 'testhost1',
+            'phases': {
+                'versioned': {'seconds': 0.0, 'files': 10},
+                'single': {'files': 2, 'read_bytes': 3 * 1024 * 1024},
+            },
+        }
@@ -0,0 +1,119 @@
+import datetime
+import os
+
+import pytest
+
+from extbackup.catalog import CATALOG_FILE
+from extbackup.catalog import Catalog
+from extbackup.routing import ROUTING_STATE_FILE
+from extbackup.routing import ChurnRouter
+from extbackup.routing import Route
+from extbackup.routing import route_filter_args
+from extbackup.routing import skip_filter_args
+
+
+def _write(path, contents):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(contents)
+
+
+@pytest.fixture
+def target(tmp_path):
+    # vm.img is replaced in every snapshot, notes.txt never changes
+    target = tmp_path / 'target'
+    with Catalog(str(tmp_path / 'catalog.sqlite')) as catalog:
+        prev = None
+        for day in range(1, 5):
+            snapshot = str(target / '2018010{}-0000'.format(day))
+            _write(os.path.join(snapshot, 'srv', 'vm.img'), 'x' * 100)
+            if prev:
+                os.link(os.path.join(prev, 'srv', 'notes.txt'),
+                        os.path.join(snapshot, 'srv', 'notes.txt'))
+            else:
+                _write(os.path.join(snapshot, 'srv', 'notes.txt'), 'y' * 100)
+            catalog.add_snapshot(os.path.basename(snapshot), snapshot)
+            prev = snapshot
+    os.rename(str(tmp_path / 'catalog.sqlite'), str(target / CATALOG_FILE))
+    return target
+
+
+@pytest.fixture
+def bind_dir(tmp_path):
+    bind_dir = tmp_path / 'bind'
+    _write(str(bind_dir / 'srv' / 'vm.img'), 'x' * 120)
+    _write(str(bind_dir / 'srv' / 'notes.txt'), 'y' * 100)
+    _write(str(bind_dir / 'srv' / 'old.log'), 'z' * 10)
+    return bind_dir
+
+
+def test_route_filter_args():
+    assert route_filter_args(['/srv/vm/disk.img', '/srv/mail[1].db']) == [
+        '--filter=+ /srv/',
+        '--filter=+ /srv/vm/',
+        '--filter=+ /srv/mail\\[1].db',
+        '--filter=+ /srv/vm/disk.img',
+        '--filter=H *',
+        '--filter=P *',
+    ]
+
+
+def test_skip_filter_args():
+    assert skip_filter_args(['/srv/vm.img']) == [
+        '--filter=H /srv/vm.img', '--filter=P /srv/vm.img']
+
+
+@pytest.mark.parametrize(['config', 'expected'], [
+    ({}, [Route('/srv/vm.img', 120, 3, True)]),
+    ({'min-changes': 4, 'window': 5}, []),
+    ({'min-size': '1K'}, []),
+    ({'versioned': ['/srv/*.img']}, []),
+])
+def test_router_route(config, expected, target, bind_dir):
+    config = dict({'min-size': 50, 'min-changes': 2, 'window': 4}, **config)
+    router = ChurnRouter.from_config(config, str(target))
+    assert router.route(str(bind_dir)) == expected
+
+
+def test_router_sticky(target, bind_dir):
+    routed = datetime.date.today() - datetime.timedelta(days=29)
+    (target / ROUTING_STATE_FILE).write_text(
+        '/srv/old.log: {0}\n/srv/gone.log: {0}\n'.format(routed))
+    router = ChurnRouter(str(target), min_size=50, min_changes=2, window=4)
+    routes = router.route(str(bind_dir))
+    # Previously routed files stay routed while they exist in the source
+    assert routes == [Route('/srv/old.log', 10, None, False),
+                      Route('/srv/vm.img', 120, 3, True)]
+    assert router.expired == []
+    router.save(routes)
+    router = ChurnRouter(str(target), min_size=50, min_changes=2, window=4)
+    assert router.state == {'/srv/old.log': routed,
+                            '/srv/vm.img': datetime.date.today()}
+
+
+def test_router_expired(target, bind_dir):
+    (target / ROUTING_STATE_FILE).write_text(
+        '/srv/old.log: 2018-01-01\n/srv/vm.img: 2018-01-01\n')
+    router = ChurnRouter.from_config(
+        {'min-size': 50, 'min-changes': 2, 'window': 4, 'recheck-days': 7},
+        str(target))
+    # Expired files return to the versioned backup, even if their earlier
+    # churn is still in the catalog
+    assert router.route(str(bind_dir)) == []
+    assert router.expired == ['/srv/old.log', '/srv/vm.img']
+    router.save([])
+    router = ChurnRouter(str(target), min_size=50, min_changes=2, window=4)
+    assert router.state == {}
+    assert router.route(str(bind_dir)) == [Route('/srv/vm.img', 120, 3, True)]
+
+
+def test_router_invalid_config(tmp_path):
+    assert ChurnRouter.from_config(None, str(tmp_path)) is None
+    with pytest.raises(Exception):
+        ChurnRouter.from_config({'min-changes': 5, 'window': 5},
+                                str(tmp_path))
+
+
+def test_router_no_catalog(tmp_path, bind_dir):
+    router = ChurnRouter.from_config(True, str(tmp_path))
+    assert router.route(str(bind_dir)) == []
@@ -4,6 +4,7 @@ from unittest import mock
 import pytest
 
 from extbackup.rsync import RsyncPaths
+from extbackup.rsync import parse_failed_paths
 
 MOCK_TEMP_DIR = '/tmp/tmp.unittest'
 MOCK_CONFIG_PATH = '.extbackup'
@@ -183,3 +184,47 @@ def test_rsync_empty_config_file():
         with pytest.raises(Exception):
             RsyncPaths(MOCK_CONFIG_PATH, MOCK_TEMP_DIR)
             mock_open.assert_called_once_with(MOCK_CONFIG_PATH, 'r')
+
+
+def test_rsync_add_excludes(mock_isfile):
+    mock_isfile.return_value = True
+    with mock.patch('builtins.open',
+                    mock.mock_open(read_data=MOCK_CONFIG_FILE_PARTIAL)) \
+            as mock_open:
+        rsync = RsyncPaths(MOCK_CONFIG_PATH, MOCK_TEMP_DIR)
+        mock_open.reset_mock()
+        rsync.add_excludes(['/root/.cache/', '/srv/build/'])
+        mock_open.assert_has_calls(
+            [
+                mock.call(os.path.join(MOCK_TEMP_DIR, 'rsync-exclude'), 'a'),
+                mock.call(os.path.join(MOCK_TEMP_DIR,
+                                       'rsync-exclude-single'), 'a'),
+            ],
+            any_order=True)
+        handle = mock_open()
+        handle.write.assert_has_calls([
+            mock.call('/root/.cache/'), mock.call('\n'),
+            mock.call('/srv/build/'), mock.call('\n')])
+
+
+def test_parse_failed_paths():
+    lines = [
+        'root/etc/hosts',
+        'rsync: [sender] send_files failed to open "/tmp/bind/root/etc/'
+        'shadow": Permission denied (13)',
+        'rsync: read errors mapping "/tmp/bind/root/srv/disk.img": '
+        'Input/output error (5)',
+        'file has vanished: "/tmp/bind/root/tmp/sess"',
+        'rsync: [generator] recv_generator: mkdir "/dest/root/var/cache" '
+        'failed: No space left on device (28)',
+        'ERROR: root/srv/vm.img failed verification -- update discarded.',
+        'rsync: link_stat "/elsewhere/file" failed: No such file (2)',
+        'rsync error: some files/attrs were not transferred (see previous '
+        'errors) (code 23) at main.c(1338) [sender=3.2.7]',
+    ]
+    assert parse_failed_paths(lines, '/tmp/bind', '/dest') == {
+        'root/etc/shadow': 'Permission denied (13)',
+        'root/srv/disk.img': 'Input/output error (5)',
+        'root/var/cache': 'No space left on device (28)',
+        'root/srv/vm.img': 'failed verification',
+    }
@@ -0,0 +1,88 @@
+import datetime
+
+import pytest
+import yaml
+
+from extbackup.schedule import SCHEDULE_STATE_FILE
+from extbackup.schedule import DeadlineScheduler
+from extbackup.schedule import parse_deadline
+
+NOW = datetime.datetime(2018, 1, 1, 12, 0)
+
+
+@pytest.mark.parametrize(['value', 'expected'], [
+    ('13:30', datetime.datetime(2018, 1, 1, 13, 30)),
+    ('6:00', datetime.datetime(2018, 1, 2, 6, 0)),
+    ('12:00', datetime.datetime(2018, 1, 2, 12, 0)),
+    ('2018-01-03T05:00', datetime.datetime(2018, 1, 3, 5, 0)),
+    ('2018-01-03 05:00', datetime.datetime(2018, 1, 3, 5, 0)),
+])
+def test_parse_deadline(value, expected):
+    assert parse_deadline(value, now=NOW) == expected
+
+
+def test_parse_deadline_invalid():
+    with pytest.raises(Exception):
+        parse_deadline('tomorrow', now=NOW)
+
+
+def test_no_deadline(tmp_path):
+    scheduler = DeadlineScheduler(None, str(tmp_path),
+                                  estimates={'single': 1e9})
+    assert scheduler.should_run('single')
+    scheduler.finished('single')
+    assert not scheduler.partial
+    assert scheduler.stop_at() is None
+    scheduler.save('20180101-0000')
+    assert DeadlineScheduler(None, str(tmp_path)).last_complete == \
+        '20180101-0000'
+
+
+def test_deadline(tmp_path):
+    deadline = datetime.datetime.now() + datetime.timedelta(minutes=10)
+    scheduler = DeadlineScheduler(deadline, str(tmp_path),
+                                  estimates={'versioned': 300,
+                                             'single': 3600})
+    assert scheduler.stop_at() == deadline.strftime('%Y-%m-%dT%H:%M')
+    assert scheduler.should_run('versioned:/root/home', required=True)
+    assert scheduler.should_run('versioned')
+    assert not scheduler.should_run('single')
+    assert scheduler.should_run('dumps')
+    assert scheduler.partial
+    scheduler.save('20180102-0000')
+    with open(str(tmp_path / SCHEDULE_STATE_FILE)) as f:
+        assert yaml.safe_load(f) == {'skipped': ['single'],
+                                     'last-complete': None}
+
+
+def test_stopped_before_deadline(tmp_path):
+    deadline = datetime.datetime.now() + datetime.timedelta(seconds=30)
+    scheduler = DeadlineScheduler(deadline, str(tmp_path))
+    scheduler.finished('versioned')
+    assert not scheduler.partial
+    scheduler.finished('single', stopped=True)
+    assert scheduler.stopped == ['single']
+
+
+def test_deadline_passed(tmp_path):
+    (tmp_path / SCHEDULE_STATE_FILE).write_text(
+        'last-complete: 20180101-0000\n')
+    deadline = datetime.datetime.now() - datetime.timedelta(seconds=1)
+    scheduler = DeadlineScheduler(deadline, str(tmp_path))
+    assert scheduler.should_run('versioned:/srv', required=True)
+    scheduler.finished('versioned:/srv', required=True)
+    scheduler.finished('versioned')
+    assert not scheduler.should_run('single')
+    scheduler.save('20180102-0000')
+    state = DeadlineScheduler(None, str(tmp_path)).state
+    assert state == {'skipped': ['single', 'versioned'],
+                     'last-complete': '20180101-0000'}
+
+
+def test_order(tmp_path):
+    (tmp_path / SCHEDULE_STATE_FILE).write_text('skipped: [single]\n')
+    scheduler = DeadlineScheduler(None, str(tmp_path))
+    units = [('versioned:/srv', None, True), ('versioned', None, False),
+             ('single', None, False), ('dumps', None, False)]
+    assert [unit[0] for unit in scheduler.order(units)] == [
+        'single', 'versioned:/srv', 'versioned', 'dumps']
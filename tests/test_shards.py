@@ -0,0 +1,101 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+import yaml
+
+from extbackup import shards
+
+
+def _tree(root, layout):
+    for name, count in layout.items():
+        directory = root / name
+        directory.mkdir(parents=True)
+        for i in range(count):
+            (directory / 'f{}'.format(i)).write_text(name)
+
+
+def test_count_entries(tmp_path):
+    _tree(tmp_path, {'a': 3, 'a/b': 2})
+    assert shards.count_entries(str(tmp_path / 'a')) == 7
+    assert shards.count_entries(str(tmp_path / 'a' / 'f0')) == 1
+
+
+def test_scan_estimates(tmp_path):
+    _tree(tmp_path, {'a': 3, 'b': 1})
+    (tmp_path / 'file').write_text('x')
+    assert shards.scan_estimates(str(tmp_path)) == {
+        'a': 4, 'b': 2, 'file': 1}
+
+
+def test_plan_shards():
+    estimates = {'a': 100, 'b': 60, 'c': 50, 'd': 30, 'e': 10, 'f': 10}
+    plan = shards.plan_shards(estimates, 2)
+    assert sorted(name for shard in plan for name in shard) == \
+        sorted(estimates)
+    weights = [sum(estimates[name] for name in shard) for shard in plan]
+    assert sorted(weights) == [130, 130]
+    assert shards.plan_shards({'a': 1}, 4) == [['a']]
+
+
+def test_escape_pattern():
+    assert shards.escape_pattern('a*b?[c]') == 'a\\*b\\?\\[c]'
+    assert shards.escape_pattern('plain') == 'plain'
+
+
+def test_filter_args():
+    assert shards.hide_filter_args('/srv/') == [
+        '--filter=H /srv/*', '--filter=P /srv/*']
+    assert shards.shard_filter_args('/data/projects', ['b']) == [
+        '--filter=H /data/projects/b',
+        '--filter=P /data/projects/b',
+        '--filter=+ /data/',
+        '--filter=+ /data/projects/',
+        '--filter=H /data/*',
+        '--filter=P /data/*',
+        '--filter=H /*',
+        '--filter=P /*',
+    ]
+
+
+def test_planner_cache(tmp_path):
+    bind_dir = tmp_path / 'bind'
+    target = tmp_path / 'target'
+    target.mkdir()
+    _tree(bind_dir, {'srv/a': 10, 'srv/b': 2, 'srv/c': 2})
+    planner = shards.ShardPlanner(str(target), jobs=2)
+    plans = planner.plan(str(bind_dir), ['/srv', '/missing'])
+    assert plans == [shards.ShardPlan('/srv', [['a'], ['b', 'c']])]
+    with open(str(target / shards.SHARD_ESTIMATES_FILE)) as f:
+        cache = yaml.safe_load(f)
+    assert cache['/srv']['entries'] == {'a': 11, 'b': 3, 'c': 3}
+    # Cached estimates are used until the rescan interval passes
+    _tree(bind_dir, {'srv/d': 20})
+    plans = planner.plan(str(bind_dir), ['/srv'])
+    assert sorted(name for shard in plans[0].shards for name in shard) == \
+        ['a', 'b', 'c', 'd']
+    with open(str(target / shards.SHARD_ESTIMATES_FILE)) as f:
+        assert 'd' not in yaml.safe_load(f)['/srv']['entries']
+
+
+@pytest.mark.skipif(shutil.which('rsync') is None,
+                    reason='rsync is not installed')
+def test_sharded_rsync(tmp_path):
+    source = tmp_path / 'source'
+    dest = tmp_path / 'dest'
+    _tree(source, {'etc': 2, 'srv/a': 2, 'srv/b': 2, 'srv/c/x': 1})
+    (source / 'srv' / 'b' / 'skip').write_text('skip')
+    dest.mkdir()
+    base = ['rsync', '-a', '--delete', '--delete-excluded',
+            '--exclude=/srv/b/skip']
+    src = os.path.join(str(source), '')
+    subprocess.check_call(base + shards.hide_filter_args('/srv') +
+                          [src, str(dest)])
+    assert os.listdir(str(dest / 'srv')) == []
+    for others in [['b', 'c'], ['a']]:
+        subprocess.check_call(base + shards.shard_filter_args('/srv', others)
+                              + [src, str(dest)])
+    for path in ['etc/f0', 'srv/a/f1', 'srv/b/f0', 'srv/c/x/f0']:
+        assert (dest / path).is_file()
+    assert not (dest / 'srv' / 'b' / 'skip').exists()
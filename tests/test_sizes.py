@@ -0,0 +1,32 @@
+import pytest
+
+from extbackup.sizes import format_size
+from extbackup.sizes import parse_size
+
+
+@pytest.mark.parametrize(['size', 'expected'], [
+    (0, '0 B'),
+    (1023, '1023 B'),
+    (1536, '1.5 KiB'),
+    (5 * 1024 ** 3, '5.0 GiB'),
+])
+def test_format_size(size, expected):
+    assert format_size(size) == expected
+
+
+@pytest.mark.parametrize(['value', 'expected'], [
+    (4096, 4096),
+    ('4096', 4096),
+    ('1K', 1024),
+    ('1.5M', 1536 * 1024),
+    ('2GiB', 2 * 1024 ** 3),
+    ('1 t', 1024 ** 4),
+])
+def test_parse_size(value, expected):
+    assert parse_size(value) == expected
+
+
+@pytest.mark.parametrize(['value'], [('',), ('1X',), ('big',)])
+def test_parse_size_invalid(value):
+    with pytest.raises(Exception):
+        parse_size(value)
@@ -0,0 +1,75 @@
+import datetime
+
+import pytest
+import yaml
+
+from extbackup.tiers import TIER_STATE_FILE
+from extbackup.tiers import Tier
+from extbackup.tiers import TierSchedule
+from extbackup.tiers import load_tiers
+
+TODAY = datetime.date(2018, 1, 8)
+WEEKLY = Tier('weekly', 7, ['/root/usr', '/root/opt'])
+MONTHLY = Tier('monthly', 30, ['/srv/archive'])
+
+
+def test_load_tiers():
+    assert load_tiers(None) == []
+    assert load_tiers({
+        'weekly': {'interval': 7, 'paths': ['/root/usr', '/root/opt']},
+        'monthly': {'interval': 30, 'paths': ['/srv/archive']},
+    }) == [MONTHLY, WEEKLY]
+
+
+@pytest.mark.parametrize('config', [
+    {'weekly': {'paths': ['/root/usr']}},
+    {'weekly': {'interval': 0, 'paths': ['/root/usr']}},
+    {'weekly': {'interval': 7, 'paths': ['root/usr']}},
+])
+def test_load_tiers_invalid(config):
+    with pytest.raises(Exception):
+        load_tiers(config)
+
+
+@pytest.fixture
+def prev_snapshot(tmp_path):
+    snapshot = tmp_path / '20180107-0200'
+    for path in ['root/usr', 'root/opt', 'srv/archive']:
+        (snapshot / path).mkdir(parents=True)
+    return str(snapshot)
+
+
+def _schedule(tmp_path, state):
+    (tmp_path / TIER_STATE_FILE).write_text(yaml.safe_dump(state))
+    return TierSchedule(str(tmp_path), [MONTHLY, WEEKLY], today=TODAY)
+
+
+def test_carried(tmp_path, prev_snapshot):
+    schedule = _schedule(tmp_path, {'weekly': datetime.date(2018, 1, 2),
+                                    'monthly': datetime.date(2017, 12, 1)})
+    assert schedule.carried(prev_snapshot) == [WEEKLY]
+    schedule = _schedule(tmp_path, {'weekly': datetime.date(2018, 1, 1),
+                                    'monthly': datetime.date(2017, 12, 20)})
+    assert schedule.carried(prev_snapshot) == [MONTHLY]
+    assert schedule.carried(None) == []
+
+
+def test_carried_missing_path(tmp_path, prev_snapshot):
+    (tmp_path / '20180107-0200' / 'root' / 'opt').rmdir()
+    schedule = _schedule(tmp_path, {'weekly': datetime.date(2018, 1, 7),
+                                    'monthly': datetime.date(2018, 1, 7)})
+    assert schedule.carried(prev_snapshot) == [MONTHLY]
+
+
+def test_never_run(tmp_path, prev_snapshot):
+    schedule = TierSchedule(str(tmp_path), [MONTHLY, WEEKLY], today=TODAY)
+    assert schedule.carried(prev_snapshot) == []
+
+
+def test_save(tmp_path):
+    schedule = _schedule(tmp_path, {'weekly': datetime.date(2018, 1, 2),
+                                    'monthly': datetime.date(2017, 12, 20)})
+    schedule.save([MONTHLY])
+    with open(str(tmp_path / TIER_STATE_FILE)) as f:
+        assert yaml.safe_load(f) == {'weekly': datetime.date(2018, 1, 8),
+                                     'monthly': datetime.date(2017, 12, 20)}
@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+from extbackup.usage import USAGE_CACHE_DIR
+from extbackup.usage import UsageCalculator
+
+SNAPSHOTS = ['20180101-0000', '20180102-0000']
+
+
+@pytest.fixture
+def target(tmp_path):
+    first = tmp_path / SNAPSHOTS[0]
+    second = tmp_path / SNAPSHOTS[1]
+    first.mkdir()
+    second.mkdir()
+    (first / 'shared').write_bytes(b'x' * 8192)
+    (first / 'old').write_bytes(b'x' * 8192)
+    os.link(str(first / 'shared'), str(second / 'shared'))
+    (second / 'new').write_bytes(b'x' * 8192)
+    return tmp_path
+
+
+def test_usage(target):
+    usage = UsageCalculator(str(target), SNAPSHOTS).calculate()
+    assert [u.name for u in usage] == SNAPSHOTS
+    shared = os.stat(str(target / SNAPSHOTS[0] / 'shared')).st_blocks * 512
+    old = os.stat(str(target / SNAPSHOTS[0] / 'old')).st_blocks * 512
+    new = os.stat(str(target / SNAPSHOTS[1] / 'new')).st_blocks * 512
+    assert usage[0].unique == old
+    assert usage[0].shared_prev == 0
+    assert usage[0].shared_next == shared
+    assert usage[1].unique == new
+    assert usage[1].shared_prev == shared
+    assert usage[1].shared_next == 0
+    assert usage[1].total == shared + new
+
+
+def test_usage_cached(target):
+    UsageCalculator(str(target), SNAPSHOTS).calculate()
+    cache_dir = target / USAGE_CACHE_DIR
+    assert sorted(os.listdir(str(cache_dir))) == [
+        '{}.inodes'.format(name) for name in SNAPSHOTS]
+    (target / SNAPSHOTS[0] / 'old').unlink()
+    usage = UsageCalculator(str(target), SNAPSHOTS).calculate()
+    assert usage[0].unique > 0
+    # Cached tables of removed snapshots are pruned
+    UsageCalculator(str(target), SNAPSHOTS[1:]).calculate()
+    assert os.listdir(str(cache_dir)) == [
+        '{}.inodes'.format(SNAPSHOTS[1])]
+
+
+def test_usage_skipped_snapshot(target):
+    # A snapshot linked from the one before its predecessor
+    third = target / '20180103-0000'
+    third.mkdir()
+    os.link(str(target / SNAPSHOTS[0] / 'old'), str(third / 'old'))
+    snapshots = SNAPSHOTS + ['20180103-0000']
+    usage = UsageCalculator(str(target), snapshots).calculate()
+    new = os.stat(str(target / SNAPSHOTS[1] / 'new')).st_blocks * 512
+    assert usage[0].unique == 0
+    assert usage[1].unique == new
+    assert usage[2].unique == 0
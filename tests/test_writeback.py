@@ -0,0 +1,63 @@
+import os
+import threading
+from unittest import mock
+
+import pytest
+
+from extbackup.writeback import WritebackLimits
+from extbackup.writeback import bdi_name
+
+
+@pytest.fixture
+def bdi_dir(tmp_path):
+    bdi_path = tmp_path / 'bdi' / bdi_name(str(tmp_path))
+    bdi_path.mkdir(parents=True)
+    for key, value in [('max_ratio', '100'), ('max_bytes', '0'),
+                       ('strict_limit', '0')]:
+        (bdi_path / key).write_text('{}\n'.format(value))
+    return tmp_path / 'bdi'
+
+
+def test_bdi_name(tmp_path):
+    dev = os.stat(str(tmp_path)).st_dev
+    assert bdi_name(str(tmp_path)) == '{}:{}'.format(os.major(dev),
+                                                     os.minor(dev))
+
+
+@pytest.mark.parametrize(['kwargs', 'expected'], [
+    ({'max_ratio': 2}, {'max_ratio': '2', 'max_bytes': '0',
+                        'strict_limit': '0'}),
+    ({'max_bytes': '256M', 'strict_limit': True},
+     {'max_ratio': '100', 'max_bytes': str(256 * 1024 ** 2),
+      'strict_limit': '1'}),
+])
+def test_limits(kwargs, expected, tmp_path, bdi_dir):
+    bdi_path = bdi_dir / bdi_name(str(tmp_path))
+    writeback = WritebackLimits(str(tmp_path), bdi_dir=str(bdi_dir), **kwargs)
+    with writeback:
+        assert {key: (bdi_path / key).read_text().strip()
+                for key in expected} == expected
+    assert (bdi_path / 'max_ratio').read_text() == '100'
+    assert (bdi_path / 'strict_limit').read_text().strip() == '0'
+
+
+def test_from_config(tmp_path):
+    assert WritebackLimits.from_config(None, str(tmp_path)) is None
+    # Limits are dropped without the bdi, periodic syncs still run
+    with mock.patch.object(WritebackLimits, 'available',
+                           return_value=False):
+        writeback = WritebackLimits.from_config(
+            {'max-ratio': 1, 'sync-interval': 10}, str(tmp_path))
+    assert writeback.limits == []
+    assert writeback.sync_interval == 10
+
+
+def test_sync_interval(tmp_path):
+    synced = threading.Event()
+    writeback = WritebackLimits(str(tmp_path), sync_interval=0.01)
+    with mock.patch('extbackup.writeback.syncfs',
+                    side_effect=lambda path: synced.set()) as mock_syncfs:
+        with writeback:
+            assert synced.wait(5)
+    mock_syncfs.assert_called_with(str(tmp_path))
+    assert writeback.thread is None